@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the quick check which rejects images without QR code.
+
+Measures the time spent by "may_contain_qrcode()" on images without
+QR code, compared to a full decode attempt, and the fraction of images
+with a QR code that are wrongly rejected, for several settings.
+
+Test images with QR code are generated with "qrrender.py".
+
+Usage: bench_prefilter.py [--count N] [--seed S]
+"""
+
+import argparse
+import random
+import time
+import numpy as np
+import qrdecode
+import qrrender
+
+
+def make_negative_image(rng, width=640, height=480):
+    """Return a random greyscale image without QR code."""
+
+    kind = rng.randrange(3)
+    if kind == 0:
+        # Random noise.
+        data = np.random.RandomState(rng.randrange(2**31)).randint(
+            0, 256, size=(height, width)).astype(np.uint8)
+    elif kind == 1:
+        # Random rectangles.
+        data = np.full((height, width), 255, dtype=np.uint8)
+        for i in range(40):
+            x = rng.randrange(width)
+            y = rng.randrange(height)
+            w = rng.randrange(2, 80)
+            h = rng.randrange(2, 80)
+            data[y:y+h, x:x+w] = rng.randrange(256)
+    else:
+        # Text-like stripes of short black runs.
+        data = np.full((height, width), 255, dtype=np.uint8)
+        for y in range(10, height - 20, 24):
+            x = 10
+            while x < width - 20:
+                w = rng.randrange(1, 6)
+                data[y:y+12, x:x+w] = 0
+                x += w + rng.randrange(1, 8)
+    return data
+
+
+def make_positive_image(rng, width=640, height=480):
+    """Return a greyscale image containing a random QR code."""
+
+    version = rng.randrange(1, 11)
+    box_size = rng.randrange(1, 5)
+    matrix = qrrender.encode_qr_matrix(
+        bytes(rng.randrange(256) for i in range(10)), version)
+    qrimg = qrrender.render_qr_image(matrix, box_size)
+    (h, w) = qrimg.shape
+    data = np.full((height, width), 255, dtype=np.uint8)
+    x = rng.randrange(width - w)
+    y = rng.randrange(height - h)
+    data[y:y+h, x:x+w] = qrimg
+    return data
+
+
+def time_call(func, images):
+    """Return average time per image in seconds, and the results."""
+    t0 = time.perf_counter()
+    results = [func(img) for img in images]
+    t1 = time.perf_counter()
+    return ((t1 - t0) / len(images), results)
+
+
+def decode_or_none(img):
+    try:
+        return qrdecode.decode_qrcode(img, prefilter_step=None)
+    except qrdecode.QRDecodeError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the quick rejection of images without QR code.")
+    parser.add_argument("--count", type=int, default=30,
+                        help="Number of images of each kind.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    negatives = [make_negative_image(rng) for i in range(args.count)]
+    positives = [make_positive_image(rng) for i in range(args.count)]
+
+    neg_bw = [qrdecode.quantize_image(img) for img in negatives]
+    pos_bw = [qrdecode.quantize_image(img) for img in positives]
+
+    (t_full, results) = time_call(decode_or_none, negatives)
+    print("full decode, no QR code:   {:8.2f} ms/image".format(1000 * t_full))
+
+    print()
+    print("row_step  tolerance  time (ms)  speedup  rejected  "
+          "false negatives")
+    for row_step in (1, 2, 3, 4, 6):
+        for tolerance in (0.5, 0.75):
+            def check(img_bw):
+                return qrdecode.may_contain_qrcode(img_bw, row_step, tolerance)
+            (t_neg, neg_res) = time_call(check, neg_bw)
+            (t_pos, pos_res) = time_call(check, pos_bw)
+            print("{:8d}  {:9.2f}  {:9.3f}  {:7.1f}  {:8d}  {:15d}".format(
+                row_step, tolerance, 1000 * t_neg, t_full / t_neg,
+                neg_res.count(False), pos_res.count(False)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+"""
+Reproducible performance benchmark of the QR decoder.
+
+Generates a fixed corpus from a random seed: every combination of
+QR version (1 .. 40) and error correction level (L, M, Q, H), with
+varying scale factors (including non-integer and non-uniform scaling),
+rotations, placement in a large canvas, and injected codeword errors
+up to the correction capacity of each block.
+
+Reports throughput, the success rate and latency percentiles of the
+complete decode and of each decoding stage. With "--memory", each image
+is decoded once more with memory tracing to report percentiles of the
+peak memory use of each stage. Results can be saved as JSON and compared
+with an earlier run.
+
+Test images are generated with "qrrender.py".
+
+Usage: bench_qrdecode.py [--seed S] [--versions A-B] [--levels LMQH]
+                         [--repeat N] [--memory] [--output FILE]
+                         [--compare FILE]
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import numpy as np
+import qrdecode
+import qrrender
+
+
+# Scale factors as (X, Y) pixels per module.
+SCALES = [(1, 1), (2, 2), (3, 3), (1.7, 1.7), (2.3, 1.9)]
+
+# Size of the canvas for codes placed in a large image.
+CANVAS_SIZE = (1280, 960)
+
+PERCENTILES = (50, 90, 99)
+
+
+def inject_errors(rng, matrix, version, level):
+    """Corrupt data codewords in each block of the QR matrix,
+    up to the number of correctable errors.
+
+    Returns:
+        Total number of corrupted codewords.
+    """
+
+    (n_codewords, n_check_words, n_blocks, max_errors
+        ) = qrdecode.get_block_structure(version, level)
+    n_data_words_per_block = (n_codewords - n_check_words) // n_blocks
+    locations = qrdecode.get_data_locations(version)
+
+    n_errors = 0
+    for i in range(n_blocks):
+        count = rng.randint(0, max_errors)
+        for j in rng.sample(range(n_data_words_per_block), count):
+            # Codeword j of block i in placement order.
+            k = i + n_blocks * j
+            bits = rng.randrange(1, 256)
+            for b in range(8):
+                if (bits >> b) & 1:
+                    (x, y) = locations[8 * k + b]
+                    matrix[y, x] ^= 1
+        n_errors += count
+
+    return n_errors
+
+
+def render_image(matrix, scale, rotation, canvas, rng):
+    """Render a QR matrix as a greyscale image array.
+
+    Parameters:
+        matrix (ndarray): QR matrix with 1 for dark modules.
+        scale: Tuple (X, Y) of pixels per module.
+        rotation (int): Rotation in degrees (0, 90, 180 or 270).
+        canvas (bool): Place the code at a random location
+            in a large canvas.
+        rng: Random generator.
+    """
+
+    matrix = np.rot90(matrix, rotation // 90)
+    img = qrrender.render_qr_image(matrix, scale)
+
+    (height, width) = img.shape
+    (canvas_width, canvas_height) = CANVAS_SIZE
+    if canvas and width < canvas_width and height < canvas_height:
+        data = np.full((canvas_height, canvas_width), 255, dtype=np.uint8)
+        x = rng.randrange(canvas_width - width)
+        y = rng.randrange(canvas_height - height)
+        data[y:y+height, x:x+width] = img
+        img = data
+
+    return np.ascontiguousarray(img)
+
+
+def make_corpus(seed, versions, levels):
+    """Generate the benchmark corpus.
+
+    Returns:
+        List of tuples (case, image, expected_data), where "case"
+        is a dictionary describing the test case.
+    """
+
+    rng = random.Random(seed)
+    corpus = []
+
+    for version in versions:
+        for level in levels:
+            # Random data, filling up to the data capacity.
+            (n_codewords, n_check_words, n_blocks, max_errors
+                ) = qrdecode.get_block_structure(version, level)
+            capacity = n_codewords - n_check_words - 3
+            nbytes = rng.randint(1, capacity)
+            data = bytes(rng.randrange(256) for i in range(nbytes))
+
+            scale = rng.choice(SCALES)
+            rotation = rng.choice((0, 90, 180, 270))
+            canvas = rng.random() < 0.33
+            damaged = rng.random() < 0.5
+
+            matrix = qrrender.encode_qr_matrix(data, version, level)
+            n_errors = 0
+            if damaged:
+                n_errors = inject_errors(rng, matrix, version, level)
+            img = render_image(matrix, scale, rotation, canvas, rng)
+
+            case = {"version": version,
+                    "level": level,
+                    "nbytes": nbytes,
+                    "scale": list(scale),
+                    "rotation": rotation,
+                    "canvas": canvas,
+                    "errors": n_errors,
+                    "height": img.shape[0],
+                    "width": img.shape[1]}
+            corpus.append((case, img, data))
+
+    return corpus
+
+
+def summarize(values, scale=1000):
+    """Return a dictionary of percentiles.
+
+    The values are multiplied by "scale", by default to convert
+    latencies from seconds to milliseconds.
+    """
+    values = scale * np.array(values)
+    summary = {"p{}".format(p): float(np.percentile(values, p))
+               for p in PERCENTILES}
+    summary["max"] = float(np.max(values))
+    summary["mean"] = float(np.mean(values))
+    return summary
+
+
+def run_benchmark(corpus, repeat):
+    """Decode each image of the corpus and collect timings.
+
+    Returns:
+        Tuple (results, summary) where "results" is a list with
+        a dictionary per image and "summary" describes the whole run.
+    """
+
+    results = []
+    decode_times = []
+    stage_times = {}
+    num_ok = 0
+    num_pixels = 0
+
+    t_start = time.perf_counter()
+
+    for (case, img, expected_data) in corpus:
+        for i in range(repeat):
+            tracer = qrdecode.QRTracer()
+            try:
+                data = qrdecode.decode_qrcode(img, tracer=tracer)
+                error = None if data == expected_data else "Wrong data"
+            except qrdecode.QRDecodeError as exc:
+                error = str(exc)
+
+            per_stage = {}
+            for event in tracer.events:
+                stage = event["stage"]
+                per_stage[stage] = (per_stage.get(stage, 0.0)
+                                    + event["duration"])
+            for (stage, duration) in per_stage.items():
+                stage_times.setdefault(stage, []).append(duration)
+            decode_times.append(per_stage["decode"])
+            num_pixels += img.size
+
+        result = dict(case)
+        result["error"] = error
+        result["decode_ms"] = 1000 * per_stage["decode"]
+        results.append(result)
+        if error is None:
+            num_ok += 1
+
+    t_total = time.perf_counter() - t_start
+
+    summary = {
+        "images": len(corpus),
+        "decodes": len(decode_times),
+        "success_rate": num_ok / len(corpus),
+        "images_per_second": len(decode_times) / sum(decode_times),
+        "megapixels_per_second": num_pixels / sum(decode_times) / 1e6,
+        "wall_time": t_total,
+        "decode": summarize(decode_times),
+        "stages": {stage: summarize(values)
+                   for (stage, values) in stage_times.items()
+                   if stage != "decode"}}
+
+    return (results, summary)
+
+
+def run_memory_benchmark(corpus, results):
+    """Decode each image of the corpus with memory tracing.
+
+    The peak memory of each image is added to "results".
+
+    Returns:
+        Dictionary mapping stage name to percentiles of the peak
+        memory use of the stage in bytes.
+    """
+
+    stage_peaks = {}
+
+    for ((case, img, expected_data), result) in zip(corpus, results):
+        with qrdecode.QRMemoryTracer() as tracer:
+            try:
+                qrdecode.decode_qrcode(img, tracer=tracer)
+            except qrdecode.QRDecodeError:
+                pass
+        memory = tracer.get_stage_memory()
+        for (stage, (peak, retained)) in memory.items():
+            stage_peaks.setdefault(stage, []).append(peak)
+        result["peak_bytes"] = memory["decode"][0]
+
+    return {stage: summarize(values, scale=1)
+            for (stage, values) in stage_peaks.items()}
+
+
+def print_summary(summary, baseline=None):
+    """Print a summary table, optionally compared with a baseline."""
+
+    print("images: {}  decodes: {}  success: {:.1f}%".format(
+        summary["images"], summary["decodes"],
+        100 * summary["success_rate"]))
+    print("throughput: {:.1f} images/s, {:.2f} Mpixel/s".format(
+        summary["images_per_second"], summary["megapixels_per_second"]))
+    print()
+
+    header = "{:<20s}".format("stage (ms)")
+    for p in PERCENTILES:
+        header += " {:>9s}".format("p{}".format(p))
+    header += " {:>9s}".format("max")
+    if baseline is not None:
+        header += " {:>12s}".format("p50 change")
+    print(header)
+
+    rows = [("decode", summary["decode"])]
+    rows += list(summary["stages"].items())
+    for (stage, stats) in rows:
+        line = "{:<20s}".format(stage)
+        for p in PERCENTILES:
+            line += " {:9.3f}".format(stats["p{}".format(p)])
+        line += " {:9.3f}".format(stats["max"])
+        if baseline is not None:
+            if stage == "decode":
+                old = baseline["decode"]
+            else:
+                old = baseline["stages"].get(stage)
+            if old is not None and old["p50"] > 0:
+                change = 100 * (stats["p50"] / old["p50"] - 1)
+                line += " {:+11.1f}%".format(change)
+            else:
+                line += " {:>12s}".format("-")
+        print(line)
+
+    if baseline is not None:
+        print()
+        print("baseline throughput: {:.1f} images/s, success {:.1f}%".format(
+            baseline["images_per_second"], 100 * baseline["success_rate"]))
+
+    if "memory" in summary:
+        print()
+        print_memory(summary["memory"],
+                     baseline.get("memory") if baseline is not None else None)
+
+
+def print_memory(memory, baseline=None):
+    """Print a table of peak memory per stage in kB,
+    optionally compared with a baseline."""
+
+    header = "{:<20s}".format("peak memory (kB)")
+    for p in PERCENTILES:
+        header += " {:>9s}".format("p{}".format(p))
+    header += " {:>9s}".format("max")
+    if baseline is not None:
+        header += " {:>12s}".format("max change")
+    print(header)
+
+    for (stage, stats) in memory.items():
+        line = "{:<20s}".format(stage)
+        for p in PERCENTILES:
+            line += " {:9.1f}".format(stats["p{}".format(p)] / 1024)
+        line += " {:9.1f}".format(stats["max"] / 1024)
+        if baseline is not None:
+            old = baseline.get(stage)
+            if old is not None and old["max"] > 0:
+                change = 100 * (stats["max"] / old["max"] - 1)
+                line += " {:+11.1f}%".format(change)
+            else:
+                line += " {:>12s}".format("-")
+        print(line)
+
+
+def parse_range(text):
+    """Parse a range "A-B" or a single number."""
+    (first, sep, last) = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the QR decoder on a generated corpus.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed of the corpus.")
+    parser.add_argument("--versions", type=parse_range, default="1-40",
+                        help="Range of QR code versions, for example 1-10.")
+    parser.add_argument("--levels", type=str, default="LMQH",
+                        help="Error correction levels.")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of decodes per image.")
+    parser.add_argument("--memory", action="store_true",
+                        help="Also measure peak memory per stage.")
+    parser.add_argument("--output", type=str,
+                        help="Save results to a JSON file.")
+    parser.add_argument("--compare", type=str,
+                        help="Compare with results from a JSON file.")
+    args = parser.parse_args()
+
+    if not args.levels or any(c not in "LMQH" for c in args.levels):
+        print("ERROR: Invalid error correction levels", file=sys.stderr)
+        return 1
+
+    config = {"seed": args.seed,
+              "versions": [args.versions.start, args.versions.stop - 1],
+              "levels": args.levels,
+              "repeat": args.repeat}
+
+    t0 = time.perf_counter()
+    corpus = make_corpus(args.seed, args.versions, args.levels)
+    t1 = time.perf_counter()
+    print("corpus: {} images generated in {:.1f} s".format(len(corpus),
+                                                           t1 - t0))
+
+    (results, summary) = run_benchmark(corpus, args.repeat)
+    if args.memory:
+        summary["memory"] = run_memory_benchmark(corpus, results)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_report = json.load(f)
+        baseline = baseline_report["summary"]
+        if baseline_report["config"] != config:
+            print("WARNING: The baseline was measured on a different corpus.")
+            print()
+
+    print_summary(summary, baseline)
+
+    failures = [r for r in results if r["error"] is not None]
+    if failures:
+        print()
+        print("failed cases:")
+        for r in failures:
+            print("  version {version}{level} scale {scale} rotation "
+                  "{rotation} errors {errors}: {error}".format(**r))
+
+    if args.output:
+        report = {"config": config,
+                  "environment": {"python": platform.python_version(),
+                                  "numpy": np.__version__,
+                                  "machine": platform.machine(),
+                                  "time": time.strftime(
+                                      "%Y-%m-%dT%H:%M:%S")},
+                  "summary": summary,
+                  "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
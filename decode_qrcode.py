@@ -1,11 +1,310 @@
 #!/usr/bin/env python3
 
-"""Decode a QR code from an image file."""
+"""Decode a QR code from an image file, or a stream of images."""
 
+import os
 import sys
+import json
+import queue
 import argparse
+import threading
+import multiprocessing
 from PIL import Image
 import qrdecode
+import qrdecode_server
+
+
+def profile_decode(img, repeat=1, **decode_args):
+    """Decode an image repeatedly and collect per-stage timings.
+
+    The timed runs are followed by one extra run with a
+    "qrdecode.QRMemoryTracer" to measure peak and retained memory
+    per stage, so that memory tracing does not slow down the timed runs.
+
+    Parameters:
+        img (PIL.Image): Input image.
+        repeat (int): Number of timed runs.
+        decode_args: Keyword arguments for "qrdecode.decode_qrcode()".
+
+    Returns:
+        Tuple (data, error, report), where "data" is the decoded data
+        or None, "error" is the error message or None, and "report"
+        is a dictionary that can be formatted as JSON.
+    """
+
+    data = None
+    error = None
+    stages = {}
+    decode_times = []
+
+    for i in range(repeat):
+        tracer = qrdecode.QRTracer()
+        try:
+            data = qrdecode.decode_qrcode(img, tracer=tracer, **decode_args)
+            error = None
+        except qrdecode.QRDecodeError as exc:
+            data = None
+            error = str(exc)
+        for (stage, (count, duration)) in tracer.get_stage_times().items():
+            (total_count, total_duration) = stages.get(stage, (0, 0.0))
+            stages[stage] = (total_count + count, total_duration + duration)
+        decode_times.extend(event["duration"] for event in tracer.events
+                            if event["stage"] == "decode")
+
+    # Sizes and counts from the last run.
+    counts = {"num_patterns": 0,
+              "num_triplets": 0,
+              "triplets_tried": 0,
+              "qr_version": None,
+              "num_blocks": 0,
+              "blocks_corrected": 0,
+              "errors_corrected": 0}
+    for event in tracer.events:
+        stage = event["stage"]
+        if stage == "decode_triplet":
+            counts["triplets_tried"] += 1
+        elif "error" in event:
+            # Failed stages do not report sizes and counts.
+            continue
+        elif stage == "find_patterns":
+            counts["num_patterns"] = event["num_patterns"]
+        elif stage == "make_triplets":
+            counts["num_triplets"] += event["num_triplets"]
+        elif stage == "locate":
+            counts["qr_version"] = event["qr_version"]
+        elif stage == "error_correction":
+            counts["num_blocks"] = event["num_blocks"]
+            counts["blocks_corrected"] = event["blocks_corrected"]
+            counts["errors_corrected"] = event["errors_corrected"]
+
+    # Measure memory in a separate run.
+    with qrdecode.QRMemoryTracer() as memory_tracer:
+        try:
+            qrdecode.decode_qrcode(img, tracer=memory_tracer, **decode_args)
+        except qrdecode.QRDecodeError:
+            pass
+    memory = memory_tracer.get_stage_memory()
+
+    report = {"width": img.width,
+              "height": img.height,
+              "repeat": repeat,
+              "error": error,
+              "decode_ms": {"min": 1000 * min(decode_times),
+                            "mean": 1000 * sum(decode_times) / repeat,
+                            "max": 1000 * max(decode_times)},
+              "stages": {stage: {"calls": count / repeat,
+                                 "mean_ms": 1000 * duration / repeat,
+                                 "peak_bytes": memory.get(stage, (0, 0))[0],
+                                 "retained_bytes": memory.get(stage,
+                                                              (0, 0))[1]}
+                         for (stage, (count, duration)) in stages.items()},
+              "peak_memory": memory["decode"][0]}
+    report.update(counts)
+
+    return (data, error, report)
+
+
+def format_profile(report):
+    """Format a profile report as a table."""
+
+    lines = []
+    lines.append("Image: {} x {} pixels, {} runs"
+                 .format(report["width"], report["height"], report["repeat"]))
+    if report["error"] is not None:
+        lines.append("Result: failed - " + report["error"])
+    lines.append("Decode time: min {min:.3f} ms, mean {mean:.3f} ms,"
+                 " max {max:.3f} ms".format(**report["decode_ms"]))
+    lines.append("")
+
+    total = report["decode_ms"]["mean"]
+    lines.append("{:<20s} {:>8s} {:>12s} {:>8s} {:>10s} {:>10s}"
+                 .format("stage", "calls", "time (ms)", "share",
+                         "peak kB", "kept kB"))
+    for (stage, info) in report["stages"].items():
+        if stage == "decode":
+            continue
+        share = 100 * info["mean_ms"] / total if total > 0 else 0
+        lines.append("{:<20s} {:>8.1f} {:>12.3f} {:>7.1f}%"
+                     " {:>10.1f} {:>10.1f}"
+                     .format(stage, info["calls"], info["mean_ms"], share,
+                             info["peak_bytes"] / 1024,
+                             info["retained_bytes"] / 1024))
+    lines.append("(decode_triplet includes the stages from locate"
+                 " to decode_data,")
+    lines.append(" find_patterns includes scan_rows and scan_columns)")
+    lines.append("")
+
+    lines.append("Peak memory:        {:.1f} kB"
+                 .format(report["peak_memory"] / 1024))
+    lines.append("Finder candidates:  {}".format(report["num_patterns"]))
+    lines.append("Finder triplets:    {} ({} tried)"
+                 .format(report["num_triplets"], report["triplets_tried"]))
+    if report["qr_version"] is not None:
+        lines.append("QR version:         {}".format(report["qr_version"]))
+    lines.append("RS blocks:          {} ({} corrected, {} errors)"
+                 .format(report["num_blocks"],
+                         report["blocks_corrected"],
+                         report["errors_corrected"]))
+
+    return "\n".join(lines)
+
+
+def read_paths(stream, separator=b"\n"):
+    """Read file names from a binary stream.
+
+    Parameters:
+        stream: Binary input stream, such as "sys.stdin.buffer".
+        separator (bytes): Separator between file names,
+            for example newline or NUL.
+
+    Yields:
+        Items for "qrdecode_server.decode_item()".
+    """
+    buffer = b""
+    while True:
+        # Use the data available so far, so that names from a slow
+        # pipeline are decoded without waiting for a full buffer.
+        chunk = stream.read1(65536)
+        if not chunk:
+            break
+        buffer += chunk
+        names = buffer.split(separator)
+        buffer = names.pop()
+        for name in names:
+            if name.strip():
+                yield {"path": name.decode("utf-8", "surrogateescape")}
+    if buffer.strip():
+        yield {"path": buffer.decode("utf-8", "surrogateescape")}
+
+
+def read_blobs(stream):
+    """Read length-prefixed image blobs from a binary stream.
+
+    Each blob is preceded by a line containing its length in bytes
+    as a decimal number.
+
+    Yields:
+        Items for "qrdecode_server.decode_item()".
+
+    Raises:
+        ValueError: If the input is not correctly formatted.
+    """
+    while True:
+        line = stream.readline()
+        if not line.strip():
+            if not line:
+                break
+            continue
+        length = int(line)
+        if length < 0:
+            raise ValueError("Invalid blob length")
+        blob = stream.read(length)
+        if len(blob) != length:
+            raise ValueError("Incomplete blob")
+        yield {"image": blob}
+
+
+def stream_decode(items, options, n_workers=1, ordered=False,
+                  output=sys.stdout):
+    """Decode a stream of images and write one JSON line per image.
+
+    With more than one worker, images are decoded in a pool of worker
+    processes. Input is read in a separate thread, which keeps at most
+    2 * n_workers images in flight, so results are written as soon as
+    they are available and memory use stays bounded.
+
+    Parameters:
+        items: Iterable of items for "qrdecode_server.decode_item()".
+        options (dict): Options for "qrdecode_server.decode_item()".
+        n_workers (int): Number of worker processes.
+        ordered (bool): Write results in input order. Otherwise results
+            are written as soon as they are available.
+        output: Text stream for the JSON lines.
+
+    Returns:
+        Error message if the input is not correctly formatted, or None.
+
+    Raises:
+        Exception: Any other error raised while reading the input,
+            after the results of the images read so far are written.
+    """
+
+    def write_result(index, result):
+        line = {"index": index}
+        line.update(result)
+        output.write(json.dumps(line) + "\n")
+        output.flush()
+
+    if n_workers == 1:
+        qrdecode_server.init_worker()
+        try:
+            for (index, item) in enumerate(items):
+                write_result(index, qrdecode_server.decode_item(
+                    (item, options)))
+        except ValueError as exc:
+            return str(exc)
+        return None
+
+    results = queue.Queue()
+    slots = threading.Semaphore(2 * n_workers)
+    stop = threading.Event()
+    read_state = {"count": None, "error": None, "exception": None}
+
+    def submit_items(pool):
+        count = 0
+        try:
+            for item in items:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                pool.apply_async(
+                    qrdecode_server.decode_item, ((item, options),),
+                    callback=lambda r, i=count: results.put((i, r)),
+                    error_callback=lambda exc, i=count: results.put(
+                        (i, {"error": "Internal error: {}".format(exc)})))
+                count += 1
+        except ValueError as exc:
+            read_state["error"] = str(exc)
+        except Exception as exc:
+            read_state["exception"] = exc
+        finally:
+            # Always end the stream, so that the main loop can not
+            # wait forever for results which will never arrive.
+            read_state["count"] = count
+            results.put(None)
+
+    with multiprocessing.Pool(n_workers,
+                              initializer=qrdecode_server.init_worker
+                              ) as pool:
+        reader = threading.Thread(target=submit_items, args=(pool,),
+                                  daemon=True)
+        reader.start()
+        done = {}
+        num_written = 0
+        try:
+            while (read_state["count"] is None
+                   or num_written < read_state["count"]):
+                entry = results.get()
+                if entry is None:
+                    continue
+                (index, result) = entry
+                if not ordered:
+                    write_result(index, result)
+                    num_written += 1
+                    slots.release()
+                    continue
+                done[index] = result
+                while num_written in done:
+                    write_result(num_written, done.pop(num_written))
+                    num_written += 1
+                    slots.release()
+        finally:
+            stop.set()
+            slots.release()
+
+    if read_state["exception"] is not None:
+        raise read_state["exception"]
+    return read_state["error"]
 
 
 def main():
@@ -18,25 +317,136 @@ def main():
     parser.add_argument("--repr",
                         action="store_true",
                         help="show result in Python repr format")
+    parser.add_argument("--inverted",
+                        action="store_true",
+                        help="also decode light-on-dark QR codes")
+    parser.add_argument("--mirrored",
+                        action="store_true",
+                        help="also decode mirrored QR codes")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="show time and memory per decoding stage"
+                             " on stderr")
+    parser.add_argument("--repeat",
+                        type=int,
+                        help="number of decode runs to profile (default 1)")
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="write the profile and the decoded data"
+                             " as a JSON object to stdout (implies --profile)")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="decode a stream of images from stdin and"
+                             " write one JSON line per image to stdout")
+    parser.add_argument("--input",
+                        choices=("paths", "blobs"),
+                        default="paths",
+                        help="stream input: one file name per line (default)"
+                             " or length-prefixed image data")
+    parser.add_argument("--null",
+                        action="store_true",
+                        help="file names are separated by NUL characters"
+                             " (find -print0)")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="number of worker processes for --stream"
+                             " (default 1)")
+    parser.add_argument("--ordered",
+                        action="store_true",
+                        help="write stream results in input order")
     parser.add_argument("image_file",
                         type=str,
+                        nargs="?",
                         help="file name of image containing the QR code")
     args = parser.parse_args()
 
+    if args.json:
+        args.profile = True
+    if args.repeat is not None and not args.profile:
+        print("ERROR: --repeat requires --profile", file=sys.stderr)
+        return 1
+    if args.repeat is None:
+        args.repeat = 1
+    if args.repeat < 1:
+        print("ERROR: Invalid value for --repeat", file=sys.stderr)
+        return 1
+
+    if args.stream:
+        if args.image_file is not None or args.profile:
+            print("ERROR: --stream reads images from stdin",
+                  file=sys.stderr)
+            return 1
+        if args.debug is not None:
+            print("ERROR: --debug is not supported with --stream",
+                  file=sys.stderr)
+            return 1
+        if args.workers < 1:
+            print("ERROR: Invalid value for --workers", file=sys.stderr)
+            return 1
+        if args.input == "blobs":
+            items = read_blobs(sys.stdin.buffer)
+        else:
+            items = read_paths(sys.stdin.buffer,
+                               b"\0" if args.null else b"\n")
+        options = {"inverted": args.inverted,
+                   "mirrored": args.mirrored,
+                   "metrics": False}
+        try:
+            error = stream_decode(items, options, args.workers,
+                                  args.ordered)
+        except BrokenPipeError:
+            # The reader of the output has exited. Redirect the output
+            # to avoid another error when it is flushed at exit.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return 1
+        except OSError as exc:
+            print("ERROR: Can not read input -", exc, file=sys.stderr)
+            return 1
+        if error is not None:
+            print("ERROR: Invalid input -", error, file=sys.stderr)
+            return 1
+        return 0
+
+    if args.image_file is None:
+        print("ERROR: No image file specified", file=sys.stderr)
+        return 1
+
     try:
         img = Image.open(args.image_file, "r")
     except IOError as exc:
         print("ERROR: Can not read image file -", exc, file=sys.stderr)
         return 1
 
-    try:
-        if args.debug is not None:
-            data_bytes = qrdecode.decode_qrcode(img, debug_level=args.debug)
+    debug_level = args.debug if args.debug is not None else 0
+    decode_args = {"debug_level": debug_level,
+                   "detect_inverted": args.inverted,
+                   "detect_mirrored": args.mirrored}
+
+    if args.profile:
+        (data_bytes, error, report) = profile_decode(img,
+                                                     args.repeat,
+                                                     **decode_args)
+        report["image_file"] = args.image_file
+        if args.json:
+            # The decoded data is part of the JSON object on stdout.
+            report["text"] = (data_bytes.decode("iso8859-1")
+                              if data_bytes is not None else None)
+            print(json.dumps(report))
         else:
-            data_bytes = qrdecode.decode_qrcode(img)
-    except qrdecode.QRDecodeError as exc:
-        print("ERROR: Can not decode QR code -", exc, file=sys.stderr)
-        return 1
+            print(format_profile(report), file=sys.stderr)
+        if error is not None:
+            print("ERROR: Can not decode QR code -", error, file=sys.stderr)
+            return 1
+        if args.json:
+            return 0
+    else:
+        try:
+            data_bytes = qrdecode.decode_qrcode(img, **decode_args)
+        except qrdecode.QRDecodeError as exc:
+            print("ERROR: Can not decode QR code -", exc, file=sys.stderr)
+            return 1
 
     data_str = data_bytes.decode("iso8859-1")
     if args.repr:
@@ -49,4 +459,3 @@ def main():
 
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -10,8 +10,12 @@ Only Model 2 QR codes are supported.
 """
 
 import sys
+import time
+import hashlib
+import tracemalloc
+import collections
 import numpy as np
-import PIL
+import PIL.Image
 
 
 # The Reed-Solomon codes for QR error correction are computed over
@@ -42,14 +46,603 @@ reed_solomon_gf_log[1] = 0
 del k, v
 
 
+# Record type of a candidate position detection pattern:
+# center coordinates and pixels per module in X and Y direction.
+PATTERN_DTYPE = np.dtype([("x", np.float64),
+                          ("y", np.float64),
+                          ("dx", np.float64),
+                          ("dy", np.float64)])
+
+# Record type of a candidate finder triplet: the upper-left,
+# upper-right and lower-left position detection patterns,
+# followed by the keys used to rank the triplets, and the location
+# found by the pre-check (qr_version 0 if the triplet was not located).
+TRIPLET_DTYPE = np.dtype([("ul", PATTERN_DTYPE),
+                          ("ur", PATTERN_DTYPE),
+                          ("dl", PATTERN_DTYPE),
+                          ("priority", np.int8),
+                          ("check_score", np.float64),
+                          ("score", np.float64),
+                          ("qr_version", np.int8),
+                          ("transform", np.float64, (3, 3))])
+
+# Maximum number of finder triplets checked by the pre-check.
+# The remaining triplets keep their geometric rank.
+MAX_CHECKED_TRIPLETS = 8
+
+
 class QRDecodeError(Exception):
     """Raised when QR decoding fails."""
     pass
 
 
-def debug_msg(msg):
-    """Print a debug message."""
-    print(msg, file=sys.stderr)
+class QRDecodeTimeout(QRDecodeError):
+    """Raised when decoding exceeds its time or work budget.
+
+    Attributes:
+        progress (dict): Partial progress at the moment the budget
+            ran out. See "QRDecodeBudget.get_progress()".
+    """
+
+    def __init__(self, msg, progress):
+        super().__init__(msg)
+        self.progress = progress
+
+
+class QRDecodeCancelled(QRDecodeTimeout):
+    """Raised when decoding is cancelled with "QRDecodeBudget.cancel()"."""
+    pass
+
+
+class QRDecodeBudget:
+    """Limits on the time and work spent decoding a single image.
+
+    The budget is checked between decoding stages, before each
+    candidate finder triplet is checked and before each finder triplet
+    is decoded. It is not checked within other stages.
+    A decode running in another thread can be stopped by calling
+    "cancel()", which takes effect at the next check.
+
+    Attributes:
+        deadline (float): Value of "time.monotonic()" after which
+            decoding is aborted, or None.
+        max_triplets (int): Maximum number of finder triplets to decode,
+            or None. This does not limit the number of candidate triplets
+            which are checked to rank them; only the deadline does.
+        start_time (float): Value of "time.monotonic()" at creation.
+        stage (str): Name of the current decoding stage.
+        num_patterns (int): Number of position detection patterns found.
+        num_triplets (int): Number of candidate finder triplets.
+        triplets_tried (int): Number of finder triplets tried so far.
+        first_error (str): First error message from a failed triplet.
+        cancelled (bool): True if "cancel()" has been called.
+    """
+
+    def __init__(self, deadline=None, max_triplets=None):
+        """Start a new budget.
+
+        Parameters:
+            deadline (float): Maximum decoding time in seconds, or None.
+            max_triplets (int): Maximum number of finder triplets to try,
+                or None.
+        """
+
+        if max_triplets is not None and max_triplets < 1:
+            raise ValueError("Invalid max_triplets")
+
+        self.start_time = time.monotonic()
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = self.start_time + deadline
+        self.max_triplets = max_triplets
+        self.stage = "start"
+        self.num_patterns = None
+        self.num_triplets = None
+        self.triplets_tried = 0
+        self.first_error = None
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop decoding at the next check of the budget.
+
+        This may be called from another thread.
+        """
+        self.cancelled = True
+
+    def get_progress(self):
+        """Return a dictionary describing the progress so far."""
+        return {"stage": self.stage,
+                "elapsed": time.monotonic() - self.start_time,
+                "num_patterns": self.num_patterns,
+                "num_triplets": self.num_triplets,
+                "triplets_tried": self.triplets_tried,
+                "first_error": self.first_error}
+
+    def check(self, stage):
+        """Enter a new decoding stage if there is time left.
+
+        Raises:
+            QRDecodeCancelled: If the decode has been cancelled.
+            QRDecodeTimeout: If the deadline has passed.
+        """
+        self.stage = stage
+        if self.cancelled:
+            raise QRDecodeCancelled("Decode cancelled before stage " + stage,
+                                    self.get_progress())
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise QRDecodeTimeout(
+                "Decode deadline exceeded before stage " + stage,
+                self.get_progress())
+
+    def check_triplet(self):
+        """Check that another finder triplet may be tried.
+
+        Raises:
+            QRDecodeTimeout: If the deadline has passed or the maximum
+                number of triplets has been tried.
+        """
+        self.check("decode_triplet")
+        if (self.max_triplets is not None
+                and self.triplets_tried >= self.max_triplets):
+            raise QRDecodeTimeout(
+                "Work budget exhausted after {} finder triplets"
+                .format(self.triplets_tried),
+                self.get_progress())
+        self.triplets_tried += 1
+
+
+class QRTracer:
+    """Receives structured events with timings from the decoding stages.
+
+    Each completed stage produces an event, which is a dictionary
+    containing at least:
+        "stage": Name of the stage.
+        "start": Start time in seconds, relative to the creation
+            of the tracer.
+        "duration": Duration of the stage in seconds.
+
+    The other keys depend on the stage:
+        "decode": pixels, error (only if decoding failed).
+        "quantize": pixels, array_bytes.
+        "prefilter": pixels, rejected.
+        "find_patterns": pixels, num_patterns.
+        "scan_rows", "scan_columns": pixels, array_bytes.
+        "make_triplets": polarity, num_patterns, num_triplets.
+        "locate": qr_version, reused (True if the location from
+            "make_triplets" was used).
+        "refine": qr_version, num_alignment.
+        "sample": qr_version, modules, supersample, array_bytes.
+        "read_format": error_correction_level, mask_pattern.
+        "extract_codewords": num_codewords.
+        "error_correction": num_blocks, blocks_corrected,
+            errors_corrected.
+        "decode_data": num_bytes.
+        "decode_triplet": index.
+
+    If a stage fails with "QRDecodeError", its event contains the key
+    "error" with the error message, and may lack the other keys.
+    Debug messages (see "debug_level") are reported as events
+    of the stage "message", with duration 0 and the key "message".
+    Without a callback, debug messages are printed instead of stored.
+
+    The "decode" stage spans all other stages, each "decode_triplet"
+    stage spans the stages from "locate" to "decode_data", and
+    "find_patterns" spans "scan_rows" and "scan_columns".
+    The "array_bytes" field is the size of the arrays produced
+    by the stage.
+    Timings are based on "time.perf_counter()", which is monotonic.
+
+    Tracing is disabled unless a tracer is passed to the decoder,
+    in which case the cost is a few function calls per stage.
+
+    Attributes:
+        callback: Function called with each event, or None.
+        events (list): Events received so far, if no callback is set.
+        start_time (float): Value of "time.perf_counter()" at creation.
+    """
+
+    def __init__(self, callback=None):
+        """Create a tracer.
+
+        Parameters:
+            callback: Optional function which is called with each event.
+                If not specified, events are stored in "self.events".
+        """
+        self.callback = callback
+        self.events = []
+        self.start_time = time.perf_counter()
+
+    def begin(self, stage):
+        """Report the start of a stage.
+
+        Parameters:
+            stage (str): Name of the stage.
+
+        Returns:
+            Start time, to be passed to "emit()" at the end of the stage.
+        """
+        return time.perf_counter()
+
+    def emit(self, stage, start, **info):
+        """Report the completion of a stage.
+
+        Parameters:
+            stage (str): Name of the stage.
+            start (float): Value of "time.perf_counter()" at the start
+                of the stage.
+            info: Stage-specific sizes and results.
+        """
+        end = time.perf_counter()
+        event = {"stage": stage,
+                 "start": start - self.start_time,
+                 "duration": end - start}
+        event.update(info)
+        if self.callback is not None:
+            self.callback(event)
+        else:
+            self.events.append(event)
+
+    def message(self, msg):
+        """Report a debug message.
+
+        Parameters:
+            msg (str): Message text.
+        """
+        if self.callback is not None:
+            self.callback({"stage": "message",
+                           "start": time.perf_counter() - self.start_time,
+                           "duration": 0.0,
+                           "message": msg})
+        else:
+            print(msg, file=sys.stderr)
+
+    def get_stage_times(self):
+        """Return the total time spent in each stage.
+
+        Returns:
+            Dictionary mapping stage name to a tuple (count, duration),
+            in order of first occurrence.
+        """
+        totals = {}
+        for event in self.events:
+            (count, duration) = totals.get(event["stage"], (0, 0.0))
+            totals[event["stage"]] = (count + 1, duration + event["duration"])
+        return totals
+
+
+class QRMemoryTracer(QRTracer):
+    """Tracer which also measures the memory use of each stage.
+
+    Memory is measured with "tracemalloc", which accounts for Numpy
+    arrays as well as Python objects. In addition to the fields
+    of "QRTracer", each event contains:
+        "peak_bytes": Peak memory allocated during the stage,
+            relative to the memory in use at the start of the stage.
+        "retained_bytes": Memory still allocated at the end of
+            the stage, relative to the start of the stage.
+
+    Memory tracing slows down the decoder considerably, so timings
+    from this tracer are not representative.
+
+    The tracer starts "tracemalloc" if it is not already running.
+    Call "close()" or use the tracer as a context manager to stop it
+    again. Requires Python 3.9 or later.
+
+    Attributes:
+        open_stages (list): List [stage, start_bytes, peak_bytes]
+            for each stage which has begun but not yet completed.
+    """
+
+    def __init__(self, callback=None):
+        """Create a tracer and start memory tracing.
+
+        Parameters:
+            callback: Optional function which is called with each event.
+                If not specified, events are stored in "self.events".
+        """
+        super().__init__(callback)
+        self.open_stages = []
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def close(self):
+        """Stop memory tracing if it was started by this tracer."""
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def update_peak(self):
+        """Update the peak memory of all open stages.
+
+        Returns:
+            Current traced memory in bytes.
+        """
+        (current, peak) = tracemalloc.get_traced_memory()
+        for entry in self.open_stages:
+            entry[2] = max(entry[2], peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def begin(self, stage):
+        current = self.update_peak()
+        self.open_stages.append([stage, current, current])
+        return super().begin(stage)
+
+    def emit(self, stage, start, **info):
+        current = self.update_peak()
+        # Stages which were abandoned due to an exception are discarded.
+        while self.open_stages:
+            (name, start_bytes, peak_bytes) = self.open_stages.pop()
+            if name == stage:
+                info["peak_bytes"] = peak_bytes - start_bytes
+                info["retained_bytes"] = current - start_bytes
+                break
+        super().emit(stage, start, **info)
+
+    def get_stage_memory(self):
+        """Return the peak memory use of each stage.
+
+        Returns:
+            Dictionary mapping stage name to a tuple
+            (peak_bytes, retained_bytes), with the maximum values
+            over all occurrences of the stage.
+        """
+        totals = {}
+        for event in self.events:
+            if "peak_bytes" not in event:
+                continue
+            (peak, retained) = totals.get(event["stage"], (0, 0))
+            totals[event["stage"]] = (max(peak, event["peak_bytes"]),
+                                      max(retained, event["retained_bytes"]))
+        return totals
+
+
+class QRTraceStage:
+    """Context manager which reports a stage to a tracer.
+
+    Entering the context returns a dictionary, in which the stage
+    stores the fields of its event. The event is emitted when
+    the context exits, also if the stage fails with "QRDecodeError".
+    If the tracer is None, nothing is reported.
+
+    Example:
+        with QRTraceStage(tracer, "quantize") as info:
+            img_data = quantize_image(image)
+            info["pixels"] = img_data.size
+
+    Attributes:
+        tracer (QRTracer): Receiver of the event, or None.
+        stage (str): Name of the stage.
+        info (dict): Fields of the event.
+        start_time (float): Start time returned by "tracer.begin()".
+    """
+
+    def __init__(self, tracer, stage):
+        self.tracer = tracer
+        self.stage = stage
+        self.info = {}
+        self.start_time = None
+
+    def __enter__(self):
+        if self.tracer is not None:
+            self.start_time = self.tracer.begin(self.stage)
+        return self.info
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.tracer is None:
+            return False
+        if exc_value is not None:
+            # Stages abandoned due to other exceptions are not reported.
+            if not isinstance(exc_value, QRDecodeError):
+                return False
+            self.info["error"] = str(exc_value)
+        self.tracer.emit(self.stage, self.start_time, **self.info)
+        return False
+
+
+def debug_trace_event(event):
+    """Print a tracing event as a debug message.
+
+    This can be used as the callback of a "QRTracer".
+    """
+    if event["stage"] == "message":
+        debug_msg(event["message"])
+        return
+    info = " ".join("{}={}".format(key, value)
+                    for (key, value) in event.items()
+                    if key not in ("stage", "start", "duration"))
+    debug_msg("TRACE {}: {:.3f} ms {}".format(event["stage"],
+                                              1000 * event["duration"],
+                                              info).rstrip())
+
+
+class QRDecodeHints:
+    """Optional prior knowledge about the QR code in an image.
+
+    Hints allow the decoder to skip work. A hinted decode only considers
+    QR codes that match the hints. If the hinted decode fails,
+    "decode_qrcode()" falls back to a normal decode without hints.
+
+    Attributes:
+        versions: Tuple of allowed QR code versions, or None.
+            If specified, the version information field is not decoded.
+        error_correction_level (str): Expected error correction level
+            (L, M, Q or H), or None.
+        mask_pattern (int): Expected mask pattern (0 .. 7), or None.
+            If both error correction level and mask pattern are
+            specified, the format information field is not decoded.
+        bbox: Tuple (left, top, right, bottom) specifying the pixel
+            region of the image that contains the QR code, or None.
+        max_codes (int): Maximum number of candidate QR codes (finder
+            triplets) to try during the hinted decode, or None.
+    """
+
+    def __init__(self,
+                 versions=None,
+                 error_correction_level=None,
+                 mask_pattern=None,
+                 bbox=None,
+                 max_codes=None):
+
+        if versions is not None:
+            if isinstance(versions, int):
+                versions = (versions,)
+            versions = tuple(sorted(set(versions)))
+            if not versions or versions[0] < 1 or versions[-1] > 40:
+                raise ValueError("Invalid QR code version hint")
+
+        if error_correction_level not in (None, "L", "M", "Q", "H"):
+            raise ValueError("Invalid error correction level hint")
+
+        if mask_pattern is not None and not (0 <= mask_pattern <= 7):
+            raise ValueError("Invalid mask pattern hint")
+
+        if bbox is not None:
+            bbox = tuple(int(v) for v in bbox)
+            if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                raise ValueError("Invalid bounding box hint")
+
+        if max_codes is not None and max_codes < 1:
+            raise ValueError("Invalid max_codes hint")
+
+        self.versions = versions
+        self.error_correction_level = error_correction_level
+        self.mask_pattern = mask_pattern
+        self.bbox = bbox
+        self.max_codes = max_codes
+
+    def __repr__(self):
+        return ("QRDecodeHints(versions={!r}, error_correction_level={!r}, "
+                "mask_pattern={!r}, bbox={!r}, max_codes={!r})"
+                .format(self.versions,
+                        self.error_correction_level,
+                        self.mask_pattern,
+                        self.bbox,
+                        self.max_codes))
+
+
+class QRDecodeResult:
+    """Decoded data together with details and quality metrics
+    of the QR code.
+
+    Returned by "decode_qrcode()" if "return_result" is set.
+    The metrics show how close a QR code is to failing to decode,
+    for example because the print quality degrades.
+
+    Attributes:
+        data (bytes): Decoded data.
+        qr_version (int): QR code version.
+        error_correction_level (str): Error correction level
+            (L, M, Q or H).
+        mask_pattern (int): Mask pattern (0 .. 7).
+        transform (ndarray): Affine transform from module coordinates
+            to pixel coordinates in the input image.
+        inverted (bool): True for a light-on-dark QR code.
+        triplets_tried (int): Number of finder triplets tried,
+            including triplets that failed to decode.
+        block_errors (list): Number of errors corrected in each
+            Reed-Solomon block.
+        max_errors (int): Maximum number of errors that can be
+            corrected in a block.
+        threshold (int): Greyscale threshold between black and white.
+        dark_level (float): Median greyscale value at the center of
+            the dark modules.
+        light_level (float): Median greyscale value at the center of
+            the light modules. In an inverted QR code, the dark modules
+            have the higher greyscale level.
+        agreement (float): Mean fraction of 3 x 3 sample points in each
+            module that agree with the majority (0.5 .. 1.0).
+        unstable_modules (int): Number of modules where not all
+            sample points agree.
+    """
+
+    __slots__ = ("data",
+                 "qr_version",
+                 "error_correction_level",
+                 "mask_pattern",
+                 "transform",
+                 "inverted",
+                 "triplets_tried",
+                 "block_errors",
+                 "max_errors",
+                 "threshold",
+                 "dark_level",
+                 "light_level",
+                 "agreement",
+                 "unstable_modules")
+
+    def __init__(self):
+        self.data = None
+        self.qr_version = None
+        self.error_correction_level = None
+        self.mask_pattern = None
+        self.transform = None
+        self.inverted = False
+        self.triplets_tried = 0
+        self.block_errors = None
+        self.max_errors = None
+        self.threshold = None
+        self.dark_level = None
+        self.light_level = None
+        self.agreement = None
+        self.unstable_modules = None
+
+    @property
+    def error_margin(self):
+        """Number of additional errors that the worst Reed-Solomon
+        block could still correct."""
+        if self.block_errors is None:
+            return None
+        return self.max_errors - max(self.block_errors)
+
+    @property
+    def contrast(self):
+        """Difference between the greyscale levels of light and
+        dark modules."""
+        if self.dark_level is None:
+            return None
+        return abs(self.light_level - self.dark_level)
+
+    @property
+    def threshold_margin(self):
+        """Distance between the threshold and the closest of the
+        greyscale levels of light and dark modules."""
+        if self.dark_level is None:
+            return None
+        return min(abs(self.dark_level - self.threshold),
+                   abs(self.light_level - self.threshold))
+
+    def __repr__(self):
+        return ("QRDecodeResult(data={!r}, qr_version={!r}, "
+                "error_correction_level={!r}, mask_pattern={!r}, "
+                "block_errors={!r}, max_errors={!r})"
+                .format(self.data,
+                        self.qr_version,
+                        self.error_correction_level,
+                        self.mask_pattern,
+                        self.block_errors,
+                        self.max_errors))
+
+
+def debug_msg(msg, tracer=None):
+    """Report a debug message.
+
+    Parameters:
+        msg (str): Message text.
+        tracer (QRTracer): Optional receiver of the message.
+            If not specified, the message is printed to stderr.
+    """
+    if tracer is not None:
+        tracer.message(msg)
+    else:
+        print(msg, file=sys.stderr)
 
 
 def bits_to_word(bits):
@@ -136,34 +729,81 @@ def decode_format_word(raw_word):
     return raw_word >> 10
 
 
-def quantize_image(image):
-    """Quantize the specified image into black and white pixels.
+def get_greyscale_data(image):
+    """Return the greyscale pixel values of the specified image.
 
     Parameters:
-        image (PIL.Image): Input image.
+        image (PIL.Image or ndarray): Input image.
+            A Numpy array must contain either greyscale pixels (2D)
+            or RGB pixels (3D, uint8).
 
     Returns:
-        2D Numpy array where 0 = black, 1 = white.
+        2D Numpy array of greyscale pixel values.
+        A 2D input array is returned without copying.
     """
 
-    # Convert to greyscale.
-    img_grey = image.convert(mode="L")
+    if isinstance(image, np.ndarray):
+        if image.ndim == 2:
+            # Use greyscale pixel values without copying.
+            return image
+        # Convert to greyscale.
+        img_grey = PIL.Image.fromarray(image).convert(mode="L")
+    else:
+        # Convert to greyscale.
+        img_grey = image.convert(mode="L")
 
     # Extract pixel values.
-    data_grey = np.array(img_grey)
+    return np.array(img_grey)
 
-    # Quantize to black-and-white.
+
+def get_quantize_threshold(data_grey):
+    """Return the default black/white threshold for the greyscale image.
+
+    The threshold is halfway between the darkest and brightest pixel.
+    """
     min_pixel = np.min(data_grey)
     max_pixel = np.max(data_grey)
-    threshold = (min_pixel + max_pixel) // 2
-    data_bw = (data_grey > threshold).astype(np.uint8)
+    return (int(min_pixel) + int(max_pixel)) // 2
+
+
+def quantize_image(image, out=None, threshold=None):
+    """Quantize the specified image into black and white pixels.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+            A Numpy array must contain either greyscale pixels (2D)
+            or RGB pixels (3D, uint8).
+        out (ndarray): Optional 2D uint8 array to store the result.
+            It is only used if it matches the size of the image.
+        threshold (int): Optional greyscale threshold. Pixels brighter
+            than the threshold become white. By default the threshold
+            is halfway between the darkest and brightest pixel.
+
+    Returns:
+        2D Numpy array where 0 = black, 1 = white.
+    """
+
+    data_grey = get_greyscale_data(image)
+
+    # Quantize to black-and-white.
+    if threshold is None:
+        threshold = get_quantize_threshold(data_grey)
+    if out is not None and out.shape == data_grey.shape:
+        # Write 0/1 values directly into the uint8 output array.
+        np.greater(data_grey, threshold, out=out.view(np.bool_))
+        data_bw = out
+    else:
+        data_bw = (data_grey > threshold).astype(np.uint8)
 
     return data_bw
 
 
-def scan_boundaries(img_data):
+def scan_boundaries(img_data, out=None):
     """Scan horizontally to detect color boundaries.
 
+    The optional parameter "out" is a tuple (boundpos, boundmap) of
+    preallocated arrays to store the result.
+
     Returns (boundpos, boundmap).
 
     boundpos is a 2D array of shape (nrow, ncol+2).
@@ -178,17 +818,24 @@ def scan_boundaries(img_data):
 
     (nrow, ncol) = img_data.shape
 
-    boundpos = np.zeros((nrow, ncol + 2), dtype=np.uint32)
-    boundmap = np.zeros((nrow, ncol), dtype=np.uint32)
+    if out is not None:
+        (boundpos, boundmap) = out
+        assert boundpos.shape == (nrow, ncol + 2)
+        assert boundmap.shape == (nrow, ncol)
+    else:
+        boundpos = np.zeros((nrow, ncol + 2), dtype=np.uint32)
+        boundmap = np.zeros((nrow, ncol), dtype=np.uint32)
+
+    # steps[x] is True if there is a color boundary just before pixel x.
+    steps = np.zeros(ncol, dtype=np.bool_)
+
     for y in range(nrow):
-        (edges,) = np.where(img_data[y, 1:] != img_data[y, :-1])
+        np.not_equal(img_data[y, 1:], img_data[y, :-1], out=steps[1:])
+        (edges,) = np.nonzero(steps)
         boundpos[y, 0] = 0
-        if len(edges) > 0:
-            boundpos[y, 1:1+len(edges)] = edges + 1
+        boundpos[y, 1:1+len(edges)] = edges
         boundpos[y, 1+len(edges):] = ncol
-        steps = np.zeros(ncol)
-        steps[edges+1] = 1
-        boundmap[y] = np.cumsum(steps)
+        np.cumsum(steps, dtype=np.uint32, out=boundmap[y])
 
     return (boundpos, boundmap)
 
@@ -233,156 +880,503 @@ def check_position_detection(bounds):
     return (center, pitch)
 
 
-def find_position_detection_patterns(img_data):
-    """Locate QR code position detection patterns.
+def check_position_detection_windows(bound_rows, bound_pos, tolerance=0.5):
+    """Check all ranges of 5 intervals in a list of color boundaries
+    for the proportions of a position detection pattern.
+
+    This is a vectorized version of "check_position_detection()".
+
+    Parameters:
+        bound_rows (ndarray): Row index of each color boundary.
+        bound_pos (ndarray): X coordinate of the first pixel after each
+            color boundary, sorted by row and then by X coordinate.
+            Each row must start with X = 0 and end with X = ncol.
+        tolerance (float): Maximum deviation of each color boundary
+            from its expected position, in modules.
+
+    Returns:
+        Tuple (index, center, pitch) of 1D arrays, where "index"
+        is the position of the first boundary of each range that could
+        correspond to a position detection pattern.
+    """
+
+    nwin = len(bound_pos) - 5
+    if nwin <= 0:
+        empty = np.zeros(0)
+        return (empty.astype(np.intp), empty, empty)
+
+    # Only consider ranges of 5 intervals on the same row.
+    (index,) = np.nonzero(bound_rows[:nwin] == bound_rows[5:])
+    bounds = np.stack([bound_pos[index + k] for k in range(6)])
+
+    (good, center, pitch) = check_position_detection_bounds(bounds,
+                                                            tolerance)
+
+    (sel,) = np.nonzero(good)
+    return (index[sel], center[sel], pitch[sel])
+
+
+def check_position_detection_bounds(bounds, tolerance=0.5):
+    """Check many ranges of 5 intervals for the proportions of
+    a slice through a position detection pattern.
+
+    This is a vectorized version of "check_position_detection()".
+
+    Parameters:
+        bounds (ndarray): 2D array of shape (6, n) containing
+            the color boundaries of each range.
+        tolerance (float): Maximum deviation of each color boundary
+            from its expected position, in modules.
+
+    Returns:
+        Tuple (good, center, pitch) of 1D arrays, where "good"
+        is True for each range that could correspond to a
+        position detection pattern.
+    """
+
+    bounds = bounds.astype(np.float64)
+
+    pattern_width = bounds[5] - bounds[0]
+    middle_width = bounds[3] - bounds[2]
+    center = np.sum(bounds, axis=0) / 6.0
+    pitch = (pattern_width + middle_width) / 10.0
+
+    good = ((bounds[4] < bounds[5])
+            & (pattern_width >= 7)
+            & (middle_width >= 3))
+    expect_bound_pos = [-3.5, -2.5, -1.5, 1.5, 2.5, 3.5]
+    for k in range(6):
+        rel_bound_pos = (bounds[k] - center) / np.maximum(pitch, 1)
+        good &= np.abs(rel_bound_pos - expect_bound_pos[k]) < tolerance
+
+    return (good, center, pitch)
+
+
+def may_contain_qrcode(img_data, row_step=2, tolerance=0.75,
+                       inverted=False):
+    """Quickly check whether an image could contain a QR code.
+
+    This looks for horizontal slices through a position detection
+    pattern on a subset of rows, followed by a rough check in vertical
+    direction. It is much faster than a full scan for position
+    detection patterns.
+
+    The black center of a position detection pattern is at least
+    3 pixels high, so it is always crossed by a scan with "row_step"
+    up to 3. Larger steps may miss small QR codes.
 
     Parameters:
         img_data (ndarray): 2D Numpy array containing black-and-white image.
+        row_step (int): Scan every N-th row.
+        tolerance (float): Maximum deviation of each color boundary
+            from its expected position, in modules. Larger values
+            reject fewer images.
+        inverted (bool): Also accept light-on-dark QR codes.
 
     Returns:
-        List of tuples (x, y, dx, dy).
+        False if the image certainly contains no position detection
+        pattern, True if it may contain a QR code.
+    """
 
-    Note that integer values of X/Y coordinates refer to pixel corners.
-    The upper-left corner of the image has coordinates (0, 0).
-    The center of the upper-left pixel has coordinates (0.5, 0.5).
-    The lower-right corner of the image has coordinates (nrow, ncol).
+    (nrow, ncol) = img_data.shape
+    if (nrow < 7) or (ncol < 7):
+        return False
+
+    # Take a subset of rows, padded on both sides with a value that
+    # differs from black and white, to get a boundary at each end.
+    rows = img_data[::row_step]
+    padded = np.full((rows.shape[0], ncol + 2), 2, dtype=np.uint8)
+    padded[:, 1:-1] = rows
+
+    # Find all color boundaries.
+    # X coordinate "x" is the first pixel after the boundary.
+    (by, bx) = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    first_colors = padded[by[:-5], bx[:-5] + 1]
+
+    # Consider each range of five intervals with colors B,W,B,W,B
+    # (or W,B,W,B,W for inverted codes).
+    (index, center, pitch) = check_position_detection_windows(by, bx,
+                                                              tolerance)
+    if not inverted:
+        keep = (first_colors[index] == 0)
+        (index, center, pitch) = (index[keep], center[keep], pitch[keep])
+    if len(index) == 0:
+        return False
+
+    # Check for a vertical B,W,B,W,B sequence through the center of each
+    # candidate, sampling at half-module steps up to 5 modules away.
+    ys = by[index] * row_step + 0.5
+    xs = center.astype(np.intp)
+    offsets = 0.5 * np.arange(-10, 11)
+    sy = (ys[:, None] + offsets[None, :] * pitch[:, None]).astype(np.intp)
+    np.clip(sy, 0, nrow - 1, out=sy)
+    column = img_data[sy, xs[:, None]]
+    transitions = np.count_nonzero(column[:, 1:] != column[:, :-1], axis=1)
+
+    return bool(np.any(transitions >= 4))
+
+
+def find_position_detection_arrays(img_data,
+                                   workspace=None,
+                                   polarities=(0, 1),
+                                   tracer=None):
+    """Locate QR code position detection patterns of one or both
+    polarities in a single pass.
+
+    Normal QR codes have dark modules on a light background.
+    Inverted QR codes have light modules on a dark background.
+
+    Parameters:
+        img_data (ndarray): 2D Numpy array containing black-and-white image.
+        workspace (QRWorkspace): Optional preallocated buffers.
+        polarities: Tuple of pixel values of the dark modules to look for:
+            0 for normal QR codes, 1 for inverted QR codes.
+        tracer (QRTracer): Optional tracer for the boundary scans.
+
+    Returns:
+        List containing a 1D array of PATTERN_DTYPE for each
+        of the specified polarities.
+
+    See "find_position_detection_patterns()" for coordinate conventions.
     """
 
     (nrow, ncol) = img_data.shape
 
     if (nrow < 7) or (ncol < 7):
-        return []
+        return [np.zeros(0, dtype=PATTERN_DTYPE) for polarity in polarities]
 
     # Scan for horizontal and vertical color boundaries.
-    (hbounds, hmap) = scan_boundaries(img_data)
-    (vbounds, vmap) = scan_boundaries(img_data.transpose())
+    hbuffers = None
+    vbuffers = None
+    if workspace is not None and workspace.image_shape == (nrow, ncol):
+        hbuffers = workspace.hboundaries
+        vbuffers = workspace.vboundaries
+    with QRTraceStage(tracer, "scan_rows") as info:
+        (hbounds, hmap) = scan_boundaries(img_data, hbuffers)
+        info.update(pixels=img_data.size,
+                    array_bytes=hbounds.nbytes + hmap.nbytes)
+    with QRTraceStage(tracer, "scan_columns") as info:
+        (vbounds, vmap) = scan_boundaries(img_data.transpose(), vbuffers)
+        info.update(pixels=img_data.size,
+                    array_bytes=vbounds.nbytes + vmap.nbytes)
+
+    # List the color boundaries of all rows, including X = 0 at the
+    # start of each row and X = ncol at the end of each row.
+    nbound = hmap[:, -1].astype(np.intp) + 2
+    (by, bk) = np.nonzero(np.arange(ncol + 2)[None, :] < nbound[:, None])
+    bx = hbounds[by, bk]
+    first_colors = img_data[by[:-5], np.minimum(bx[:-5], ncol - 1)]
+
+    # Check each range of five intervals for the proportions of
+    # a horizontal slice through a position detection pattern.
+    (index, cx, dx) = check_position_detection_windows(by, bx)
+    colors = first_colors[index]
+    ys = by[index]
+    xs = cx.astype(np.intp)
+
+    # Check that the vertical slice through the center also has
+    # a pattern of the same color.
+    by_ = vmap[xs, ys].astype(np.intp) - 2
+    good = ((img_data[ys, xs] == colors) & (by_ >= 0) & (by_ + 4 < nrow))
+    (sel,) = np.nonzero(good)
+    bounds = np.stack([vbounds[xs[sel], by_[sel] + k] for k in range(6)])
+    (vgood, cy, dy) = check_position_detection_bounds(bounds)
+    good[sel] = vgood
+    cy_all = np.zeros(len(index))
+    dy_all = np.zeros(len(index))
+    cy_all[sel] = cy
+    dy_all[sel] = dy
+    good &= (dx <= 2 * dy_all) & (dy_all <= 2 * dx)
+
+    result = []
+    for polarity in polarities:
+        (sel,) = np.nonzero(good & (colors == polarity))
+        candidates = np.zeros(len(sel), dtype=PATTERN_DTYPE)
+        candidates["x"] = cx[sel]
+        candidates["y"] = cy_all[sel]
+        candidates["dx"] = dx[sel]
+        candidates["dy"] = dy_all[sel]
+        result.append(discard_duplicate_patterns(candidates))
 
-    patterns_raw = []
+    return result
 
-    # Scan each row to find position detection patterns.
-    for y in range(nrow):
-        # Start at the first black interval.
-        bx = 0
-        if img_data[y, 0] != 0:
-            bx += 1
-        # Consider each range of five intervals with colors B,W,B,W,B.
-        while hbounds[y, bx+4] < ncol:
-            # Check that this horizontal slice has the correct
-            # proportions for a position detection pattern.
-            (cx, dx) = check_position_detection(hbounds[y, bx:bx+6])
-            if dx > 0:
-                # Check that the vertical slice also has a pattern.
-                x = int(cx)
-                by = vmap[x, y] - 2
-                if img_data[y, x] == 0 and by >= 0 and by + 4 < nrow:
-                    (cy, dy) = check_position_detection(vbounds[x, by:by+6])
-                    if (dy > 0) and (dx <= 2 * dy) and (dy <= 2 * dx):
-                        # Add this location as a candidate pattern.
-                        patterns_raw.append((cx, cy, dx, dy))
-            bx += 2
-
-    # Discard duplicate entries.
-    patterns = []
-    for fnd in patterns_raw:
-        (cx, cy, dx, dy) = fnd
-        dupl = False
-        for (tcx, tcy, tdx, tdy) in patterns:
-            if ((abs(tcx - cx) < 3 * max(dx, tdx))
-                    and (abs(tcy - cy) < 3 * max(dy, tdy))):
-                dupl = True
-                break
-        if not dupl:
-            patterns.append(fnd)
 
-    return patterns
+def discard_duplicate_patterns(patterns):
+    """Discard candidate patterns close to an earlier candidate.
 
+    A candidate is a duplicate if it is less than 3 modules away
+    in both X and Y direction from an earlier candidate which
+    was not itself discarded.
 
-def make_finder_triplets(patterns):
-    """Select three position detection patterns that could
-    together form the finder pattern for a QR code.
+    Parameters:
+        patterns (ndarray): 1D array of PATTERN_DTYPE.
 
-    If multiple finder triplets are feasible, return them all,
-    starting with the highest QR code version.
+    Returns:
+        1D array of PATTERN_DTYPE containing the remaining
+        candidates in their original order.
+    """
+
+    if len(patterns) == 0:
+        return patterns
+
+    (cx, cy, dx, dy) = (patterns["x"], patterns["y"],
+                        patterns["dx"], patterns["dy"])
+
+    # Keep the first remaining candidate, then drop all candidates
+    # close to it. Each iteration keeps one pattern.
+    remaining = np.ones(len(patterns), dtype=bool)
+    keep = []
+    while True:
+        i = int(np.argmax(remaining))
+        if not remaining[i]:
+            break
+        keep.append(i)
+        near = ((np.abs(cx - cx[i]) < 3 * np.maximum(dx, dx[i]))
+                & (np.abs(cy - cy[i]) < 3 * np.maximum(dy, dy[i])))
+        remaining &= ~near
+        remaining[i] = False
+
+    return patterns[keep]
+
+
+def find_position_detection_patterns_by_polarity(img_data,
+                                                 workspace=None,
+                                                 polarities=(0, 1)):
+    """Locate QR code position detection patterns of one or both
+    polarities in a single pass.
 
     Parameters:
-        patterns: List of tuples describing position detection patterns.
+        img_data (ndarray): 2D Numpy array containing black-and-white image.
+        workspace (QRWorkspace): Optional preallocated buffers.
+        polarities: Tuple of pixel values of the dark modules to look for:
+            0 for normal QR codes, 1 for inverted QR codes.
 
     Returns:
-        List of tuples (finder_ul, finder_ur, finder_dl).
+        List containing a list of tuples (x, y, dx, dy) for each
+        of the specified polarities.
+
+    See "find_position_detection_arrays()".
     """
+    return [patterns.tolist()
+            for patterns in find_position_detection_arrays(
+                img_data, workspace, polarities)]
 
-    finder_triplets = []
 
-    # Try all candidates for the upper-left pattern.
-    for fnd in patterns:
-        (cx, cy, dx, dy) = fnd
+def find_position_detection_patterns(img_data, workspace=None):
+    """Locate QR code position detection patterns.
 
-        # Search a matching pattern with horizontal separation.
-        for fndh in patterns:
-            (hcx, hcy, hdx, hdy) = fndh
+    Parameters:
+        img_data (ndarray): 2D Numpy array containing black-and-white image.
+        workspace (QRWorkspace): Optional preallocated buffers.
 
-            # Check that pixel pitch is roughly compatible.
-            if 8 * abs(dx - hdx) > dx + hdx:
-                continue
-            if 8 * abs(dy - hdy) > dy + hdy:
-                continue
+    Returns:
+        List of tuples (x, y, dx, dy).
 
-            # Check that Y coordinates match.
-            if abs(cy - hcy) > dy + hdy:
-                continue
+    Note that integer values of X/Y coordinates refer to pixel corners.
+    The upper-left corner of the image has coordinates (0, 0).
+    The center of the upper-left pixel has coordinates (0.5, 0.5).
+    The lower-right corner of the image has coordinates (nrow, ncol).
+    """
+    (patterns,) = find_position_detection_patterns_by_polarity(
+        img_data, workspace, (0,))
+    return patterns
 
-            # Check that X separation is sufficient.
-            xsep = 2 * abs(cx - hcx) / (dx + hdx)
-            if xsep < 12:
-                continue
 
-            # Search a matching pattern with vertical separation.
-            for fndv in patterns:
-                (vcx, vcy, vdx, vdy) = fndv
+def make_finder_triplet_array(patterns, img_data=None, versions=None,
+                              mirrored=False, budget=None,
+                              max_checked=MAX_CHECKED_TRIPLETS):
+    """Select three position detection patterns that could
+    together form the finder pattern for a QR code.
 
-                # Check that pixel pitch is roughly compatible.
-                if 8 * abs(dx - vdx) > dx + vdx:
-                    continue
-                if 8 * abs(dy - vdy) > dy + vdy:
-                    continue
+    All combinations of patterns are checked at once with Numpy.
+    See "make_finder_triplets()" for the selection rules.
 
-                # Check that X coordinates match.
-                if abs(cx - vcx) > dx + vdx:
-                    continue
+    Parameters:
+        patterns: List of tuples (x, y, dx, dy) or 1D array of PATTERN_DTYPE.
+        img_data (ndarray): Optional 2D array representing the
+            quantized image.
+        versions: Optional collection of allowed QR code versions.
+        mirrored (bool): Also return mirrored triplets.
+        budget (QRDecodeBudget): Optional limits on time and work,
+            checked before each triplet is checked.
+        max_checked (int): Maximum number of triplets to check,
+            in order of their geometric rank.
 
-                # Check that X and Y separation are roughly compatible.
-                ysep = 2 * abs(cy - vcy) / (dy + vdy)
-                if ysep < 12 or ysep < 0.75 * xsep or ysep > 1.25 * xsep:
-                    continue
+    Returns:
+        1D array of TRIPLET_DTYPE, sorted by decreasing rank.
+        If the quantized image is specified, the fields "qr_version"
+        and "transform" contain the location used for the check.
+        Checked triplets come first, ordered by their check score,
+        followed by unchecked triplets and finally by triplets
+        which failed the check.
 
-                # Identify upper-right and lower-left patterns,
-                # depending on rotation.
-                if (hcx - cx) * (vcy - cy) > 0:
-                    # not rotated or 180 degrees rotated
-                    fnd_ur = fndh
-                    fnd_dl = fndv
-                else:
-                    # 90 degrees or 270 degrees rotated
-                    fnd_ur = fndv
-                    fnd_dl = fndh
+    Raises:
+        QRDecodeTimeout: If the budget runs out.
+    """
 
-                # Estimate QR code version.
-                qrver = (0.5 * (xsep + ysep) - 10) / 4.0
+    if not (isinstance(patterns, np.ndarray)
+            and patterns.dtype == PATTERN_DTYPE):
+        patterns = np.array([tuple(p) for p in patterns],
+                            dtype=PATTERN_DTYPE)
+
+    (cx, cy, dx, dy) = (patterns["x"], patterns["y"],
+                        patterns["dx"], patterns["dy"])
+
+    # Pairwise sums and differences, indexed [upper-left, other].
+    sum_dx = dx[:, None] + dx[None, :]
+    sum_dy = dy[:, None] + dy[None, :]
+    diff_cx = np.abs(cx[:, None] - cx[None, :])
+    diff_cy = np.abs(cy[:, None] - cy[None, :])
+
+    # Check that pixel pitch is roughly compatible.
+    pitch_ok = ((8 * np.abs(dx[:, None] - dx[None, :]) <= sum_dx)
+                & (8 * np.abs(dy[:, None] - dy[None, :]) <= sum_dy))
+
+    # Pairs with horizontal separation: Y coordinates match
+    # and X separation is sufficient.
+    xsep = 2 * diff_cx / sum_dx
+    (hi, hj) = np.nonzero(pitch_ok & (diff_cy <= sum_dy) & (xsep >= 12))
+
+    # Pairs with vertical separation: X coordinates match.
+    ysep = 2 * diff_cy / sum_dy
+    (vi, vk) = np.nonzero(pitch_ok & (diff_cx <= sum_dx) & (ysep >= 12))
+
+    # Combine each horizontal pair with each vertical pair that has
+    # the same upper-left pattern, in the order (i, j, k).
+    vcount = np.bincount(vi, minlength=len(patterns))
+    vstart = np.cumsum(vcount) - vcount
+    count = vcount[hi]
+    hsel = np.repeat(np.arange(len(hi)), count)
+    vsel = (np.repeat(vstart[hi] - (np.cumsum(count) - count), count)
+            + np.arange(len(hsel)))
+    i = hi[hsel]
+    j = hj[hsel]
+    k = vk[vsel]
+
+    # Check that X and Y separation are roughly compatible.
+    txsep = xsep[i, j]
+    tysep = ysep[i, k]
+    good = (tysep >= 0.75 * txsep) & (tysep <= 1.25 * txsep)
+
+    # Estimate QR code version.
+    qrver = (0.5 * (txsep + tysep) - 10) / 4.0
+
+    # Skip triplets which do not match the allowed versions.
+    if versions is not None:
+        allowed = np.array(sorted(versions), dtype=np.float64)
+        good &= np.min(np.abs(qrver[:, None] - allowed[None, :]),
+                       axis=1, initial=np.inf) <= 1
+
+    (sel,) = np.nonzero(good)
+    (i, j, k, qrver) = (i[sel], j[sel], k[sel], qrver[sel])
+
+    # Identify upper-right and lower-left patterns, depending on
+    # rotation: not rotated or 180 degrees rotated if the product
+    # is positive, 90 degrees or 270 degrees rotated otherwise.
+    straight = (cx[j] - cx[i]) * (cy[k] - cy[i]) > 0
+    ur = np.where(straight, j, k)
+    dl = np.where(straight, k, j)
+
+    # Bonus point if QR code is non-rotated.
+    score = qrver + ((cx[j] > cx[i]) & (cy[k] > cy[i]))
+
+    triplets = np.zeros(len(i), dtype=TRIPLET_DTYPE)
+    triplets["ul"] = patterns[i]
+    triplets["ur"] = patterns[ur]
+    triplets["dl"] = patterns[dl]
+    triplets["priority"] = 1
+    triplets["score"] = score
+
+    if mirrored:
+        mirror = triplets.copy()
+        mirror["ur"] = triplets["dl"]
+        mirror["dl"] = triplets["ur"]
+        mirror["priority"] = 0
+        triplets = np.concatenate((triplets, mirror))
+
+    # Sort by decreasing rank, then by decreasing pattern coordinates.
+    keys = [triplets["priority"], triplets["score"]]
+    for name in ("ul", "ur", "dl"):
+        for field in PATTERN_DTYPE.names:
+            keys.append(triplets[name][field])
+    order = np.lexsort([-key.astype(np.float64) for key in reversed(keys)])
+    triplets = triplets[order]
+
+    if img_data is None:
+        return triplets
+
+    # Rank the best triplets by the consistency of their timing
+    # and format information, and keep their location for decoding.
+    num_checked = min(len(triplets), max_checked)
+    for t in range(num_checked):
+        if budget is not None:
+            budget.check("make_triplets")
+        triplet = tuple(triplets[t].tolist()[:3])
+        try:
+            (transform, qr_version) = locate_qr_code(img_data,
+                                                     triplet,
+                                                     versions)
+        except QRDecodeError:
+            continue
+        triplets["qr_version"][t] = qr_version
+        triplets["transform"][t] = transform
+        triplets["check_score"][t] = score_qr_transform(img_data,
+                                                        transform,
+                                                        qr_version)
+
+    # Triplets which failed the check are tried last.
+    status = np.ones(len(triplets), dtype=np.int8)
+    status[:num_checked] = np.where(
+        triplets["check_score"][:num_checked] > 0, 2, 0)
+    order = np.lexsort((-triplets["check_score"],
+                        -triplets["priority"],
+                        -status))
+    return triplets[order]
+
+
+def make_finder_triplets(patterns, img_data=None, versions=None,
+                         mirrored=False, budget=None,
+                         max_checked=MAX_CHECKED_TRIPLETS):
+    """Select three position detection patterns that could
+    together form the finder pattern for a QR code.
+
+    If multiple finder triplets are feasible, return them all,
+    starting with the highest QR code version.
 
-                # Bonus point if QR code is non-rotated.
-                score = qrver
-                if hcx > cx and vcy > cy:
-                    score += 1
+    If the quantized image is specified, the best "max_checked"
+    triplets are also checked with "score_qr_transform()". Triplets
+    that pass this check are sorted by decreasing check score before
+    considering the QR code version. Triplets that fail the check
+    are placed after all others.
 
-                finder_triplets.append((score, (fnd, fnd_ur, fnd_dl)))
+    Parameters:
+        patterns: List of tuples describing position detection patterns,
+            or 1D array of PATTERN_DTYPE.
+        img_data (ndarray): Optional 2D array representing the
+            quantized image.
+        versions: Optional collection of allowed QR code versions.
+            Triplets that can not match any of these versions
+            are discarded.
+        mirrored (bool): Also return the mirrored interpretation of
+            each triplet, with upper-right and lower-left patterns
+            swapped. This decodes mirrored QR codes as a transposed
+            matrix. Mirrored triplets are placed after the normal
+            triplets with the same check result.
+        budget (QRDecodeBudget): Optional limits on time and work.
+        max_checked (int): Maximum number of triplets to check.
 
-    # Sort by decreasing score.
-    finder_triplets.sort(reverse=True)
+    Returns:
+        List of tuples (finder_ul, finder_ur, finder_dl).
 
-    return [triplet for (score, triplet) in finder_triplets]
+    Raises:
+        QRDecodeTimeout: If the budget runs out.
+    """
+    triplets = make_finder_triplet_array(patterns, img_data, versions,
+                                         mirrored, budget, max_checked)
+    return [triplet[:3] for triplet in triplets.tolist()]
 
 
-def extract_qr_version(img_data, finder_ul, finder_ur):
+def extract_qr_version(img_data, finder_ul, finder_ur, finder_dl=None):
     """Extract the QR version from the upper-right version field.
 
     Parameters:
@@ -391,6 +1385,9 @@ def extract_qr_version(img_data, finder_ul, finder_ur):
             position detection pattern.
         finder_ur: Tuple representing the location of the upper-right
             position detection pattern.
+        finder_dl: Optional tuple representing the location of the
+            lower-left position detection pattern. This is required
+            to read the version field of a mirrored QR code.
 
     Returns:
         QR code version (range 1 .. 40).
@@ -409,10 +1406,14 @@ def extract_qr_version(img_data, finder_ul, finder_ur):
         # not rotated or 180 degrees rotated
         transform[0, 0] = ur_dx * np.sign(ur_cx - ul_cx)
         transform[1, 1] = ur_dy * np.sign(ur_cx - ul_cx)
+        if finder_dl is not None:
+            transform[1, 1] = ur_dy * np.sign(finder_dl[1] - ul_cy)
     else:
         # 90 degrees or 270 degrees rotated
         transform[1, 0] = ur_dy * np.sign(ur_cy - ul_cy)
         transform[0, 1] = -ur_dx * np.sign(ur_cy - ul_cy)
+        if finder_dl is not None:
+            transform[0, 1] = ur_dx * np.sign(finder_dl[0] - ul_cx)
 
     transform[0, 2] = ur_cx
     transform[1, 2] = ur_cy
@@ -441,13 +1442,16 @@ def extract_qr_version(img_data, finder_ul, finder_ur):
     return qr_version
 
 
-def locate_qr_code(img_data, triplet):
+def locate_qr_code(img_data, triplet, versions=None):
     """Consider the QR code defined by the specified finder triplet
     and extract precise location, orientation and QR code version.
 
     Parameters:
         img_data (ndarray): 2D array representing the quantized image.
         triplet: Tuple (finder_ul, finder_ur, finder_dl).
+        versions: Optional collection of allowed QR code versions.
+            If specified, the allowed version closest to the estimated
+            version is used and the version information is not decoded.
 
     Returns:
         Tuple (affine_transform, qr_version).
@@ -465,11 +1469,18 @@ def locate_qr_code(img_data, triplet):
     # Estimate the QR code version based on horizontal data.
     hdist = ((2 * (ul_cx - ur_cx) / (ul_dx + ur_dx))**2
              + (2 * (ul_cy - ur_cy) / (ul_dy + ur_dy))**2)**0.5
-    qrver = round((hdist - 10) / 4)
-
-    # For QR versions higher than 6, decode the version information.
-    if qrver > 6:
-        qrver = extract_qr_version(img_data, finder_ul, finder_ur)
+    qrver_est = (hdist - 10) / 4
+    qrver = round(qrver_est)
+
+    if versions is not None:
+        # Select the closest allowed version.
+        qrver = min(versions, key=lambda ver: abs(qrver_est - ver))
+        if abs(qrver_est - qrver) > 1:
+            raise QRDecodeError("QR code version does not match hints")
+    elif qrver > 6:
+        # For QR versions higher than 6, decode the version information.
+        qrver = extract_qr_version(img_data, finder_ul, finder_ur,
+                                   finder_dl)
 
     # Determine nominal separation between finders.
     qrsep = 10 + 4 * qrver
@@ -489,7 +1500,204 @@ def locate_qr_code(img_data, triplet):
     return (transform, qrver)
 
 
-def sample_qr_matrix(img_data, transform, qr_version):
+def find_alignment_pattern(img_data, transform, x, y, search_radius=2.0):
+    """Search for an alignment pattern near its expected location.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        transform (ndarray): Approximate affine transform of the QR code.
+        x (int): Expected X coordinate of the center module.
+        y (int): Expected Y coordinate of the center module.
+        search_radius (float): Maximum displacement, in modules.
+
+    Returns:
+        Tuple (dx, dy) with the displacement of the alignment pattern
+        in modules, or None if the pattern was not found.
+    """
+
+    # Minimum number of matching modules out of 25.
+    min_match = 24
+
+    # Expected module values of the alignment pattern (1 = black).
+    expect = np.ones(25, dtype=np.uint8)
+    expect[[6, 7, 8, 11, 13, 16, 17, 18]] = 0
+    (my, mx) = np.mgrid[-2:3, -2:3]
+
+    def match_shifts(x0, y0, radius, step):
+        """Count matching modules for a grid of displacements."""
+        nstep = int(round(radius / step))
+        shifts = np.arange(-nstep, nstep + 1) * step
+        (sy, sx) = np.meshgrid(y0 + shifts, x0 + shifts, indexing="ij")
+        xcoords = x + sx.reshape(-1, 1) + mx.reshape(1, -1)
+        ycoords = y + sy.reshape(-1, 1) + my.reshape(1, -1)
+        values = sample_qr_modules(img_data, transform, xcoords, ycoords)
+        n_match = np.sum(values == expect, axis=1)
+        return (sx.ravel(), sy.ravel(), n_match)
+
+    # Coarse search in steps of 1/2 module.
+    (sx, sy, n_match) = match_shifts(0, 0, search_radius, 0.5)
+    best = np.argmax(n_match)
+    if n_match[best] < min_match:
+        return None
+
+    # Fine search in steps of 1/8 module around the best match.
+    # Return the center of the range of displacements that match best,
+    # which gives the largest margin when sampling.
+    (sx, sy, n_match) = match_shifts(sx[best], sy[best], 0.75, 0.125)
+    sel = (n_match == np.max(n_match))
+    return (float(np.mean(sx[sel])), float(np.mean(sy[sel])))
+
+
+def refine_qr_transform(img_data, transform, qr_version, search_radius=2.0):
+    """Refine the location of a QR code based on its alignment patterns.
+
+    The initial transform is based only on the three position detection
+    patterns. Small errors in that transform cause sampling to drift
+    away from the module centers far from the finders, which matters
+    for large QR code versions. This function locates the alignment
+    patterns near their predicted positions and fits an affine transform
+    to all patterns by least squares.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        transform (ndarray): Affine transform based on finder patterns.
+        qr_version (int): QR code version.
+        search_radius (float): Maximum displacement of each alignment
+            pattern, in modules.
+
+    Returns:
+        Tuple (refined_transform, num_found).
+        The original transform is returned if no alignment patterns
+        are found.
+    """
+
+    qrsize = 17 + 4 * qr_version
+
+    # Module coordinates of the finder centers.
+    mod_points = [(3.5, 3.5), (qrsize - 3.5, 3.5), (3.5, qrsize - 3.5)]
+    pix_points = [np.dot(transform[:2], (mx, my, 1))
+                  for (mx, my) in mod_points]
+
+    num_found = 0
+    for (x, y) in get_alignment_pattern_locations(qr_version):
+        shift = find_alignment_pattern(img_data, transform, x, y,
+                                       search_radius)
+        if shift is not None:
+            (dx, dy) = shift
+            mod_points.append((x + 0.5, y + 0.5))
+            pix_points.append(
+                np.dot(transform[:2], (x + 0.5 + dx, y + 0.5 + dy, 1)))
+            num_found += 1
+
+    if num_found == 0:
+        return (transform, 0)
+
+    # Least-squares fit of an affine transform.
+    mod_coords = np.ones((len(mod_points), 3))
+    mod_coords[:, :2] = mod_points
+    (coef, residuals, rank, sv) = np.linalg.lstsq(mod_coords,
+                                                  np.array(pix_points),
+                                                  rcond=None)
+
+    refined = np.zeros((3, 3))
+    refined[:2] = coef.transpose()
+    refined[2, 2] = 1.0
+
+    return (refined, num_found)
+
+
+def sample_qr_modules(img_data, transform, xcoords, ycoords):
+    """Sample the specified modules of the QR matrix.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        transform (ndarray): Affine transform specifying the position,
+            size and orientation of the QR code.
+        xcoords (ndarray): X coordinates of the modules to sample.
+        ycoords (ndarray): Y coordinates of the modules to sample.
+
+    Returns:
+        Array with the same shape as "xcoords" containing the value
+        of each sampled module (0 = white, 1 = black).
+    """
+
+    # Sample at the center of each module.
+    xcenter = xcoords + 0.5
+    ycenter = ycoords + 0.5
+
+    xidx = transform[0,0] * xcenter + transform[0,1] * ycenter + transform[0,2]
+    yidx = transform[1,0] * xcenter + transform[1,1] * ycenter + transform[1,2]
+
+    xidx = xidx.astype(np.int32)
+    yidx = yidx.astype(np.int32)
+
+    # Clip coordinates to the image area.
+    (nrow, ncol) = img_data.shape
+    xidx = np.clip(xidx, 0, ncol - 1)
+    yidx = np.clip(yidx, 0, nrow - 1)
+
+    values = img_data[yidx, xidx]
+    values = 1 - values
+    return values
+
+
+def sample_qr_matrix_supersampled(img_data, transform, qr_version,
+                                  supersample=3, spread=0.25):
+    """Sample each module in the QR matrix by majority vote over
+    a grid of points inside the module.
+
+    This is more robust than sampling only the module center when the
+    scale factor is not an integer or module edges are blurred.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        transform (ndarray): Affine transform specifying the position,
+            size and orientation of the QR code.
+        qr_version (int): QR code version.
+        supersample (int): Odd number K to sample a K x K grid
+            of points in each module.
+        spread (float): Distance between the outermost sample points
+            of the grid, in modules. Points too close to the module
+            edge pick up neighbouring modules at small scale factors.
+
+    Returns:
+        Tuple (matrix, agreement).
+        "matrix" is a 2D square Numpy array containing the value of
+        each module (0 = white, 1 = black).
+        "agreement" is a 2D array containing, for each module, the
+        fraction of sample points that agree with the majority
+        (range 0.5 .. 1.0).
+    """
+
+    if supersample < 1 or supersample % 2 != 1:
+        raise ValueError("Supersample factor must be an odd number")
+
+    qrsize = 17 + 4 * qr_version
+    nsample = supersample * supersample
+
+    # Offsets of the sample points relative to the module center.
+    offsets = np.linspace(-0.5 * spread, 0.5 * spread, supersample)
+    xoffset = np.tile(offsets, supersample)
+    yoffset = np.repeat(offsets, supersample)
+
+    coords = np.arange(qrsize, dtype=np.float64)
+    xcoord = coords[None, :, None] + xoffset[None, None, :]
+    ycoord = coords[:, None, None] + yoffset[None, None, :]
+    xcoord = np.broadcast_to(xcoord, (qrsize, qrsize, nsample))
+    ycoord = np.broadcast_to(ycoord, (qrsize, qrsize, nsample))
+
+    # Gather all sample points at once and count black samples.
+    samples = sample_qr_modules(img_data, transform, xcoord, ycoord)
+    nblack = np.sum(samples, axis=2, dtype=np.int32)
+
+    matrix = (2 * nblack > nsample).astype(np.uint8)
+    agreement = np.maximum(nblack, nsample - nblack) / float(nsample)
+
+    return (matrix, agreement)
+
+
+def sample_qr_matrix(img_data, transform, qr_version, workspace=None,
+                     supersample=1, debug_level=0, tracer=None):
     """Sample each module in the QR matrix.
 
     Parameters:
@@ -497,41 +1705,69 @@ def sample_qr_matrix(img_data, transform, qr_version):
         transform (ndarray): Affine transform specifying the position,
             size and orientation of the QR code.
         qr_version (int): QR code version.
+        workspace (QRWorkspace): Optional preallocated buffers.
+            If specified, the returned matrix is stored in a buffer
+            which is overwritten by the next call.
+        supersample (int): If larger than 1, sample a grid of
+            K x K points in each module and take the majority.
+            See "sample_qr_matrix_supersampled()".
+        debug_level (int): Optional debug level (0..3).
+        tracer (QRTracer): Optional receiver of debug messages.
 
     Returns:
         2D square Numpy array containing the value of each module
         (0 = white, 1 = black).
     """
 
+    if supersample > 1:
+        (matrix, agreement) = sample_qr_matrix_supersampled(img_data,
+                                                            transform,
+                                                            qr_version,
+                                                            supersample)
+        if debug_level >= 2:
+            debug_msg("SUPERSAMPLING: {} modules with disagreeing samples"
+                      .format(np.count_nonzero(agreement < 1)),
+                      tracer)
+        return matrix
+
+    if workspace is not None:
+        return workspace.sample_qr_matrix(img_data, transform, qr_version)
+
     qrsize = 17 + 4 * qr_version
 
     xcoord = np.zeros((qrsize, qrsize))
-    xcoord[0] = np.arange(qrsize) + 0.5
+    xcoord[0] = np.arange(qrsize)
     xcoord[1:] = xcoord[0]
 
     ycoord = xcoord.transpose()
 
-    xidx = transform[0,0] * xcoord + transform[0,1] * ycoord + transform[0,2]
-    yidx = transform[1,0] * xcoord + transform[1,1] * ycoord + transform[1,2]
+    return sample_qr_modules(img_data, transform, xcoord, ycoord)
 
-    xidx = xidx.astype(np.int32)
-    yidx = yidx.astype(np.int32)
 
-    # Clip coordinates to the image area.
-    (nrow, ncol) = img_data.shape
-    xidx = np.clip(xidx, 0, ncol - 1)
-    yidx = np.clip(yidx, 0, nrow - 1)
+def get_format_locations():
+    """Return the locations of the format information modules
+    next to the upper-left position detection pattern.
+
+    Returns:
+        Array of shape (15, 2) where each row describes a module location
+        with the X coordinate in the first column and the Y coordinate
+        in the second column, starting with the least-significant bit.
+    """
 
-    matrix = img_data[yidx, xidx]
-    matrix = 1 - matrix
-    return matrix
+    locs = [(8, i) for i in range(6)]
+    locs.append((8, 7))
+    locs.append((8, 8))
+    locs.append((7, 8))
+    locs += [(5 - i, 8) for i in range(6)]
+    return np.array(locs)
 
 
-def extract_format_data(matrix):
-    """Extract format information from the upper-left corner.
+def decode_format_bits(format_bits):
+    """Decode the raw format information bits.
 
     Parameters:
-        matrix (ndarray): 2D array containing the QR matrix.
+        format_bits: List or array of 15 format bits as read from
+            the QR matrix, starting with the least-significant bit.
 
     Returns:
         Tuple (error_correction_level, mask_pattern).
@@ -542,16 +1778,6 @@ def extract_format_data(matrix):
 
     format_mask = 0b101010000010010
 
-    # Fetch format bits from matrix.
-    format_bits = []
-    for i in range(6):
-        format_bits.append(matrix[i, 8])
-    format_bits.append(matrix[7, 8])
-    format_bits.append(matrix[8, 8])
-    format_bits.append(matrix[8, 7])
-    for i in range(6):
-        format_bits.append(matrix[8, 5-i])
-
     # Convert bits to word and apply the format mask.
     format_word_raw = bits_to_word(format_bits)
     format_word_raw ^= format_mask
@@ -569,6 +1795,102 @@ def extract_format_data(matrix):
     return (error_correction_level, mask_pattern)
 
 
+def extract_format_data(matrix):
+    """Extract format information from the upper-left corner.
+
+    Parameters:
+        matrix (ndarray): 2D array containing the QR matrix.
+
+    Returns:
+        Tuple (error_correction_level, mask_pattern).
+
+    Raises:
+        QRDecodeError: If the format information can not be decoded.
+    """
+
+    # Fetch format bits from matrix.
+    format_locations = get_format_locations()
+    format_bits = matrix[format_locations[:, 1], format_locations[:, 0]]
+
+    return decode_format_bits(format_bits)
+
+
+def score_qr_transform(img_data, transform, qr_version):
+    """Quickly check whether a QR code is present at the specified location.
+
+    This samples only the horizontal and vertical timing patterns and
+    the format information next to the upper-left finder. It is much
+    cheaper than sampling and decoding the complete QR matrix.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        transform (ndarray): Affine transform specifying the position,
+            size and orientation of the QR code.
+        qr_version (int): QR code version.
+
+    Returns:
+        Fraction of timing pattern modules that match their expected
+        value (range 0.0 .. 1.0), or 0.0 if the location can not
+        correspond to a decodable QR code.
+    """
+
+    # Minimum fraction of matching timing modules to accept the location.
+    # Random image content matches about half of the timing modules.
+    min_timing_score = 0.7
+
+    qrsize = 17 + 4 * qr_version
+
+    # Sample the timing patterns between the position detection patterns.
+    # Timing modules are black at even coordinates and white at odd ones.
+    tpos = np.arange(8, qrsize - 8)
+    tfixed = np.full(len(tpos), 6)
+    expect = 1 - tpos % 2
+    hbits = sample_qr_modules(img_data, transform, tpos, tfixed)
+    vbits = sample_qr_modules(img_data, transform, tfixed, tpos)
+    n_match = np.sum(hbits == expect) + np.sum(vbits == expect)
+    timing_score = float(n_match) / (2 * len(tpos))
+
+    if timing_score < min_timing_score:
+        return 0.0
+
+    # Check that the format information can be decoded.
+    format_locations = get_format_locations()
+    format_bits = sample_qr_modules(img_data,
+                                    transform,
+                                    format_locations[:, 0],
+                                    format_locations[:, 1])
+    try:
+        decode_format_bits(format_bits)
+    except QRDecodeError:
+        return 0.0
+
+    return timing_score
+
+
+def score_finder_triplet(img_data, triplet, versions=None):
+    """Quickly check whether a finder triplet defines a plausible QR code.
+
+    This is a cheap check, based on "score_qr_transform()", which can be
+    used to reject bad triplets before attempting a full decode.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        triplet: Tuple (finder_ul, finder_ur, finder_dl).
+        versions: Optional collection of allowed QR code versions.
+
+    Returns:
+        Score in range 0.0 .. 1.0, or 0.0 if the triplet can not
+        correspond to a decodable QR code.
+    """
+
+    try:
+        (transform, qr_version) = locate_qr_code(img_data, triplet, versions)
+    except QRDecodeError:
+        return 0.0
+
+    return score_qr_transform(img_data, transform, qr_version)
+
+
 def make_mask_pattern(qrsize, mask_pattern):
     """Generate the specified 2D XOR mask pattern.
 
@@ -746,12 +2068,13 @@ def get_data_locations(qr_version):
     return data_locations
 
 
-def extract_codewords(matrix, mask_pattern):
+def extract_codewords(matrix, mask_pattern, workspace=None):
     """Extract the sequence of codewords from the QR matrix.
 
     Parameters:
         matrix (ndarray):   2D array containing the QR matrix.
         mask_pattern (int): Mask pattern reference from format information.
+        workspace (QRWorkspace): Optional cache of per-version tables.
 
     Returns:
         Array of codewords in order of placement in the matrix.
@@ -760,17 +2083,25 @@ def extract_codewords(matrix, mask_pattern):
     qrsize = matrix.shape[0]
     qr_version = (qrsize - 17) // 4
 
-    # Unmask the QR code.
-    mask = make_mask_pattern(qrsize, mask_pattern)
-    unmasked_matrix = matrix ^ mask
+    if workspace is not None:
+        # Fetch codeword bits from the matrix and unmask them,
+        # using cached tables.
+        data_index = workspace.get_data_index(qr_version)
+        data_mask = workspace.get_data_mask(qr_version, mask_pattern)
+        data_bits = np.take(matrix, data_index)
+        data_bits ^= data_mask
+    else:
+        # Unmask the QR code.
+        mask = make_mask_pattern(qrsize, mask_pattern)
+        unmasked_matrix = matrix ^ mask
 
-    # Get the locations of codewords in placement order.
-    data_locations = get_data_locations(qr_version)
-    xcoords = data_locations[:, 0]
-    ycoords = data_locations[:, 1]
+        # Get the locations of codewords in placement order.
+        data_locations = get_data_locations(qr_version)
+        xcoords = data_locations[:, 0]
+        ycoords = data_locations[:, 1]
 
-    # Fetch codeword bits from the matrix.
-    data_bits = unmasked_matrix[ycoords, xcoords]
+        # Fetch codeword bits from the matrix.
+        data_bits = unmasked_matrix[ycoords, xcoords]
 
     # Split bits in groups of 8 bits per codeword.
     nwords = len(data_bits) // 8
@@ -1061,6 +2392,31 @@ def rs_error_correction(data_words, check_words, max_errors, debug_level=0):
     Returns:
         List of corrected data words.
 
+    Raises:
+        QRDecodeError: If error correction fails.
+    """
+    (data_words, n_error) = rs_error_correction_count(data_words,
+                                                      check_words,
+                                                      max_errors,
+                                                      debug_level)
+    return data_words
+
+
+def rs_error_correction_count(data_words, check_words, max_errors,
+                              debug_level=0, tracer=None):
+    """Perform Reed-Solomon error correction on a message block
+    and count the corrected errors.
+
+    Parameters:
+        data_words (list):      List of received data words.
+        check_words (list):     List of received error correction words.
+        max_errors (int):       Maximum number of errors to correct.
+        debug_level (int):      Optional debug level.
+        tracer (QRTracer):      Optional receiver of debug messages.
+
+    Returns:
+        Tuple (corrected_data_words, num_errors).
+
     Raises:
         QRDecodeError: If error correction fails.
     """
@@ -1075,7 +2431,8 @@ def rs_error_correction(data_words, check_words, max_errors, debug_level=0):
 
     if debug_level >= 2:
         debug_msg("REED-SOLOMON: ({}, {}, r={})"
-                  .format(n_received_words, n_data_words, max_errors))
+                  .format(n_received_words, n_data_words, max_errors),
+                  tracer)
 
     #
     # See also https://en.wikipedia.org/wiki/Reed-Solomon_error_correction
@@ -1102,10 +2459,10 @@ def rs_error_correction(data_words, check_words, max_errors, debug_level=0):
     # Quick check if all syndromes are zero.
     if all([(x == 0) for x in syndrome]):
         # No errors, just return the data words.
-        return data_words
+        return (data_words, 0)
 
     if debug_level >= 3:
-        debug_msg("  syndrome = " + str(syndrome))
+        debug_msg("  syndrome = " + str(syndrome), tracer)
 
     # Determine the error locator polynomial.
     error_locator = rs_berlekamp_massey(syndrome)
@@ -1117,7 +2474,7 @@ def rs_error_correction(data_words, check_words, max_errors, debug_level=0):
         raise QRDecodeError("Uncorrectable errors in Reed-Solomon code")
 
     if debug_level >= 1:
-        debug_msg("REED-SOLOMON: {} errors".format(n_error))
+        debug_msg("REED-SOLOMON: {} errors".format(n_error), tracer)
 
     # Find the roots of the error locator polynomial.
     # If all roots are different AND each root equals "a**(-p[i])" where
@@ -1131,7 +2488,7 @@ def rs_error_correction(data_words, check_words, max_errors, debug_level=0):
             error_locations.append(k)
 
     if debug_level >= 3:
-        debug_msg("  error_locations = " + str(error_locations))
+        debug_msg("  error_locations = " + str(error_locations), tracer)
 
     # Check that all roots of the error locator polynomial are different
     # and correspond to a valid position.
@@ -1159,13 +2516,15 @@ def rs_error_correction(data_words, check_words, max_errors, debug_level=0):
     #assert all([(x == 0) for x in syndrome])
 
     # Return the corrected data words.
-    return received_words[:n_data_words]
+    return (received_words[:n_data_words], n_error)
 
 
 def codeword_error_correction(codewords,
                               qr_version,
                               error_correction_level,
-                              debug_level=0):
+                              debug_level=0,
+                              tracer=None,
+                              result=None):
     """Perform error correction and return only the data codewords.
 
     Parameters:
@@ -1173,6 +2532,9 @@ def codeword_error_correction(codewords,
         qr_version (int):               QR code version
         error_correction_level (str):   Error correction level (L, M, Q or H).
         debug_level (int):              Optional debug level.
+        tracer (QRTracer):              Optional receiver of events.
+        result (QRDecodeResult):        Optional result to store the
+                                        number of errors per block.
 
     Returns:
         List of error-corrected data codewords.
@@ -1181,35 +2543,52 @@ def codeword_error_correction(codewords,
         QRDecodeError: If error correction fails.
     """
 
-    (n_codewords, n_check_words, n_blocks, max_errors
-        ) = get_block_structure(qr_version, error_correction_level)
-
-    assert len(codewords) == n_codewords
-
-    n_data_words = n_codewords - n_check_words
-    n_data_words_per_block = n_data_words // n_blocks
-    n_long_blocks = n_data_words % n_blocks
-
-    corrected_data = []
-
-    for i in range(n_blocks):
-
-        # Collect data words from codeword sequence.
-        k = i + n_blocks * n_data_words_per_block
-        data_words = codewords[i:k:n_blocks]
-        if i >= n_blocks - n_long_blocks:
-            extra_word = codewords[n_data_words-n_blocks+i]
-            data_words.append(extra_word)
-
-        # Collect error correction words from codeword sequence.
-        check_words = codewords[n_data_words+i::n_blocks]
-
-        # Perform Reed-Solomon error correction.
-        message = rs_error_correction(data_words,
-                                      check_words,
-                                      max_errors,
-                                      debug_level)
-        corrected_data += message
+    with QRTraceStage(tracer, "error_correction") as info:
+        (n_codewords, n_check_words, n_blocks, max_errors
+            ) = get_block_structure(qr_version, error_correction_level)
+
+        assert len(codewords) == n_codewords
+
+        n_data_words = n_codewords - n_check_words
+        n_data_words_per_block = n_data_words // n_blocks
+        n_long_blocks = n_data_words % n_blocks
+
+        corrected_data = []
+        blocks_corrected = 0
+        errors_corrected = 0
+        block_errors = []
+
+        for i in range(n_blocks):
+
+            # Collect data words from codeword sequence.
+            k = i + n_blocks * n_data_words_per_block
+            data_words = codewords[i:k:n_blocks]
+            if i >= n_blocks - n_long_blocks:
+                extra_word = codewords[n_data_words-n_blocks+i]
+                data_words.append(extra_word)
+
+            # Collect error correction words from codeword sequence.
+            check_words = codewords[n_data_words+i::n_blocks]
+
+            # Perform Reed-Solomon error correction.
+            (message, n_error) = rs_error_correction_count(data_words,
+                                                           check_words,
+                                                           max_errors,
+                                                           debug_level,
+                                                           tracer)
+            corrected_data += message
+            errors_corrected += n_error
+            block_errors.append(n_error)
+            if n_error > 0:
+                blocks_corrected += 1
+
+        if result is not None:
+            result.block_errors = block_errors
+            result.max_errors = max_errors
+
+        info.update(num_blocks=n_blocks,
+                    blocks_corrected=blocks_corrected,
+                    errors_corrected=errors_corrected)
 
     return corrected_data
 
@@ -1420,19 +2799,8 @@ def decode_bitstream(bitstream, qr_version):
 def matrix_to_string(matrix):
     """Format the QR matrix as a string."""
 
-    lines = []
-    qrsize = matrix.shape[0]
-    for y in range(qrsize):
-        s = []
-        for x in range(qrsize):
-            if matrix[y, x] == 0:
-                s.append(".")
-            elif matrix[y, x] == 1:
-                s.append("X")
-            else:
-                s.append("?")
-        lines.append("  " + " ".join(s))
-    return "\n".join(lines)
+    symbols = np.where(matrix == 0, ".", np.where(matrix == 1, "X", "?"))
+    return "\n".join("  " + " ".join(row) for row in symbols.tolist())
 
 
 def bitstream_to_string(bitstream):
@@ -1444,106 +2812,1536 @@ def bitstream_to_string(bitstream):
     return "".join(map(str, bits))
 
 
-def decode_qrcode(image, debug_level=0):
-    """Decode the QR code in the specified image.
+def extract_matrix_bitstream(matrix, debug_level=0, hints=None,
+                             workspace=None, tracer=None, result=None):
+    """Extract the error-corrected data codewords from the QR matrix.
 
     Parameters:
-        image (PIL.Image): Input image.
+        matrix (ndarray): 2D array containing the QR matrix.
         debug_level (int): Optional debug level (0..3).
+        hints (QRDecodeHints): Optional hints about the QR code.
+        workspace (QRWorkspace): Optional cache of per-version tables.
+        tracer (QRTracer): Optional receiver of events.
+        result (QRDecodeResult): Optional result to store the format
+            and error correction details.
 
     Returns:
-        Decoded data as a byte string.
+        List of error-corrected data codewords.
 
     Raises:
         QRDecodeError: If decoding fails.
     """
 
-    # Convert to black-and-white.
-    img_data = quantize_image(image)
+    qrsize = matrix.shape[0]
+    qr_version = (qrsize - 17) // 4
 
-    # Locate position detection patterns.
-    patterns = find_position_detection_patterns(img_data)
+    error_correction_level_hint = None
+    mask_pattern_hint = None
+    if hints is not None:
+        error_correction_level_hint = hints.error_correction_level
+        mask_pattern_hint = hints.mask_pattern
+
+    # Extract format information, unless fully specified by hints.
+    with QRTraceStage(tracer, "read_format") as info:
+        if (error_correction_level_hint is not None
+                and mask_pattern_hint is not None):
+            error_correction_level = error_correction_level_hint
+            mask_pattern = mask_pattern_hint
+        else:
+            (error_correction_level, mask_pattern
+                ) = extract_format_data(matrix)
+            if error_correction_level_hint not in (None,
+                                                   error_correction_level):
+                raise QRDecodeError(
+                    "Error correction level does not match hints")
+            if mask_pattern_hint not in (None, mask_pattern):
+                raise QRDecodeError("Mask pattern does not match hints")
+        info.update(error_correction_level=error_correction_level,
+                    mask_pattern=mask_pattern)
+
+    if result is not None:
+        result.error_correction_level = error_correction_level
+        result.mask_pattern = mask_pattern
 
-    if debug_level >= 2:
-        debug_msg("POSITION DETECTION PATTERNS:")
-        for pattern in patterns:
-            debug_msg("  " + str(pattern))
+    if debug_level >= 1:
+        debug_msg("QR VERSION: {} {} mask={}"
+                  .format(qr_version,
+                          error_correction_level,
+                          mask_pattern),
+                  tracer)
+
+    # Extract codewords from the QR matrix.
+    with QRTraceStage(tracer, "extract_codewords") as info:
+        codewords = extract_codewords(matrix, mask_pattern, workspace)
+        info["num_codewords"] = len(codewords)
+
+    # Unpack codeword sequence and perform error correction.
+    bitstream = codeword_error_correction(list(codewords),
+                                          qr_version,
+                                          error_correction_level,
+                                          debug_level,
+                                          tracer,
+                                          result)
 
-    if len(patterns) < 3:
-        npattern = len(patterns)
-        if npattern == 0:
-            raise QRDecodeError("No position detection patterns found")
-        raise QRDecodeError("Only {} position detection patterns found"
-                            .format(npattern))
+    if debug_level >= 3:
+        debug_msg("BITSTREAM: " + bitstream_to_string(bitstream), tracer)
 
-    # Make groups of three compatible finders.
-    finder_triplets = make_finder_triplets(patterns)
+    return bitstream
 
-    if len(finder_triplets) == 0:
-        raise QRDecodeError("No valid finder pattern found")
+
+def extract_bitstream(img_data, transform, qr_version, debug_level=0,
+                      hints=None, workspace=None, supersample=1,
+                      tracer=None, result=None):
+    """Sample the QR matrix at the specified location and return
+    the error-corrected data codewords.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        transform (ndarray): Affine transform specifying the position,
+            size and orientation of the QR code.
+        qr_version (int): QR code version.
+        debug_level (int): Optional debug level (0..3).
+        hints (QRDecodeHints): Optional hints about the QR code.
+        workspace (QRWorkspace): Optional preallocated buffers.
+        supersample (int): Optional number K to sample K x K points
+            in each module and take the majority.
+        tracer (QRTracer): Optional receiver of events.
+        result (QRDecodeResult): Optional result to store details
+            of the QR code.
+
+    Returns:
+        List of error-corrected data codewords.
+
+    Raises:
+        QRDecodeError: If decoding fails.
+    """
+
+    # Sample the QR matrix.
+    with QRTraceStage(tracer, "sample") as info:
+        matrix = sample_qr_matrix(img_data, transform, qr_version, workspace,
+                                  supersample, debug_level, tracer)
+        info.update(qr_version=qr_version,
+                    modules=matrix.size,
+                    supersample=supersample,
+                    array_bytes=matrix.nbytes)
+
+    if debug_level >= 3:
+        debug_msg(matrix_to_string(matrix), tracer)
+
+    return extract_matrix_bitstream(matrix, debug_level, hints, workspace,
+                                    tracer, result)
+
+
+def decode_finder_triplets(img_data, finder_triplets, debug_level=0,
+                           hints=None, workspace=None, budget=None,
+                           supersample=1, refine_transform=False,
+                           tracer=None, result=None):
+    """Try to decode the QR code defined by each finder triplet in turn.
+
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        finder_triplets: List of tuples (finder_ul, finder_ur, finder_dl),
+            or 1D array of TRIPLET_DTYPE from "make_finder_triplet_array()".
+            The location stored in an array record is used instead of
+            locating the QR code again.
+        debug_level (int): Optional debug level (0..3).
+        hints (QRDecodeHints): Optional hints about the QR code.
+        workspace (QRWorkspace): Optional preallocated buffers.
+        budget (QRDecodeBudget): Optional limits on time and work.
+        supersample (int): Optional number K to sample K x K points
+            in each module and take the majority.
+        refine_transform (bool): Refine the location of the QR code
+            based on its alignment patterns.
+        tracer (QRTracer): Optional receiver of events.
+        result (QRDecodeResult): Optional result to store details
+            of the decoded QR code.
+
+    Returns:
+        Tuple (decoded_data, affine_transform, qr_version).
+
+    Raises:
+        QRDecodeTimeout: If the budget runs out.
+        QRDecodeError: If decoding fails.
+    """
+
+    versions = None
+    if hints is not None:
+        versions = hints.versions
+        if hints.max_codes is not None:
+            finder_triplets = finder_triplets[:hints.max_codes]
+
+    # Use the locations found while ranking the triplets.
+    if isinstance(finder_triplets, np.ndarray):
+        locations = [(record["transform"], int(record["qr_version"]))
+                     if record["qr_version"] > 0 else None
+                     for record in finder_triplets]
+        finder_triplets = [record[:3] for record in finder_triplets.tolist()]
+    else:
+        locations = [None] * len(finder_triplets)
 
     # Try to decode according to each triplet.
     first_exception = None
-    for triplet in finder_triplets:
+    for (index, (triplet, location)) in enumerate(zip(finder_triplets,
+                                                      locations)):
 
-        if debug_level >= 1:
-            debug_msg("FINDER TRIPLET:")
-            for fnd in triplet:
-                debug_msg("  " + str(fnd))
+        if budget is not None:
+            budget.check_triplet()
+        if result is not None:
+            result.triplets_tried += 1
 
-        try:
-            # Extract QR code location, orientation and version.
-            transform, qr_version = locate_qr_code(img_data, triplet)
+        with QRTraceStage(tracer, "decode_triplet") as triplet_info:
+            triplet_info["index"] = index
 
-            if debug_level >= 2:
-                debug_msg("AFFINE TRANSFORM:")
-                debug_msg(str(transform))
+            if debug_level >= 1:
+                debug_msg("FINDER TRIPLET:", tracer)
+                for fnd in triplet:
+                    debug_msg("  " + str(fnd), tracer)
+
+            try:
+                # Extract QR code location, orientation and version.
+                with QRTraceStage(tracer, "locate") as info:
+                    if location is not None:
+                        (transform, qr_version) = location
+                    else:
+                        (transform, qr_version) = locate_qr_code(img_data,
+                                                                 triplet,
+                                                                 versions)
+                    info.update(qr_version=qr_version,
+                                reused=location is not None)
+
+                # Use alignment patterns to correct the location.
+                if refine_transform:
+                    with QRTraceStage(tracer, "refine") as info:
+                        (transform, num_found
+                            ) = refine_qr_transform(img_data,
+                                                    transform,
+                                                    qr_version)
+                        info.update(qr_version=qr_version,
+                                    num_alignment=num_found)
+                    if debug_level >= 2:
+                        debug_msg("REFINED WITH {} ALIGNMENT PATTERNS"
+                                  .format(num_found),
+                                  tracer)
+
+                if debug_level >= 2:
+                    debug_msg("AFFINE TRANSFORM:", tracer)
+                    debug_msg(str(transform), tracer)
+
+                # Sample the QR matrix and perform error correction.
+                bitstream = extract_bitstream(img_data,
+                                              transform,
+                                              qr_version,
+                                              debug_level,
+                                              hints,
+                                              workspace,
+                                              supersample,
+                                              tracer,
+                                              result)
+
+            except QRDecodeError as exc:
+                # If decoding fails on the first finder triplet,
+                # save the exception and try decoding the remaining
+                # triplets. If all triplets fail, report the error
+                # from the first triplet.
+                if first_exception is None:
+                    first_exception = exc
+                    if budget is not None:
+                        budget.first_error = str(exc)
+                if debug_level >= 1:
+                    debug_msg("FAILED: " + str(exc), tracer)
+                triplet_info["error"] = str(exc)
+                continue
 
-            # Sample the QR matrix.
-            matrix = sample_qr_matrix(img_data, transform, qr_version)
+            # Successfully extracted a bitstream from the QR code.
+            # This implies we correctly located the QR code in the image,
+            # so from this point on it does not make sense to retry with
+            # different finder triplets if an error occurs.
 
-            if debug_level >= 3:
-                debug_msg(matrix_to_string(matrix))
+            # Decode the bitstream.
+            with QRTraceStage(tracer, "decode_data") as info:
+                data = decode_bitstream(bitstream, qr_version)
+                info["num_bytes"] = len(data)
 
-            # Extract format information.
-            (error_correction_level, mask_pattern
-                ) = extract_format_data(matrix)
+        if result is not None:
+            result.data = data
+            result.transform = transform
+            result.qr_version = qr_version
+        return (data, transform, qr_version)
 
-            if debug_level >= 1:
-                debug_msg("QR VERSION: {} {} mask={}"
-                          .format(qr_version,
-                                  error_correction_level,
-                                  mask_pattern))
+    if first_exception is None:
+        raise QRDecodeError("No valid finder pattern found")
 
-            # Extract codewords from the QR matrix.
-            codewords = extract_codewords(matrix, mask_pattern)
+    raise first_exception
 
-            # Unpack codeword sequence and perform error correction.
-            bitstream = codeword_error_correction(list(codewords),
-                                                  qr_version,
-                                                  error_correction_level,
-                                                  debug_level)
 
-            if debug_level >= 3:
-                debug_msg("BITSTREAM: " + bitstream_to_string(bitstream))
+def detect_and_decode_qrcode(img_data, debug_level=0, hints=None,
+                             workspace=None, prefilter_step=2,
+                             budget=None, detect_inverted=False,
+                             detect_mirrored=False, supersample=1,
+                             refine_transform=False, tracer=None,
+                             result=None):
+    """Locate and decode a QR code in a quantized image.
 
+    Parameters:
+        img_data (ndarray): 2D array representing the quantized image.
+        debug_level (int): Optional debug level (0..3).
+        hints (QRDecodeHints): Optional hints about the QR code.
+        workspace (QRWorkspace): Optional preallocated buffers.
+        prefilter_step (int): Row step for "may_contain_qrcode()",
+            or None to skip the quick check.
+        budget (QRDecodeBudget): Optional limits on time and work.
+        detect_inverted (bool): Also look for inverted (light-on-dark)
+            QR codes in the same pass.
+        detect_mirrored (bool): Also try the mirrored interpretation
+            of each finder triplet, after all normal triplets.
+        supersample (int): Optional number K to sample K x K points
+            in each module and take the majority.
+        refine_transform (bool): Refine the location of the QR code
+            based on its alignment patterns.
+        tracer (QRTracer): Optional receiver of events.
+        result (QRDecodeResult): Optional result to store details
+            of the decoded QR code.
+
+    Returns:
+        Tuple (decoded_data, affine_transform, qr_version).
+
+    Raises:
+        QRDecodeTimeout: If the budget runs out.
+        QRDecodeError: If decoding fails.
+    """
+
+    versions = None
+    if hints is not None:
+        versions = hints.versions
+
+    # Quickly reject images without QR code.
+    if budget is not None:
+        budget.check("prefilter")
+    rejected = False
+    if prefilter_step:
+        with QRTraceStage(tracer, "prefilter") as info:
+            rejected = not may_contain_qrcode(img_data,
+                                              prefilter_step,
+                                              inverted=detect_inverted)
+            info.update(pixels=img_data.size, rejected=rejected)
+    if rejected:
+        if debug_level >= 2:
+            debug_msg("REJECTED BY PREFILTER", tracer)
+        raise QRDecodeError("No position detection patterns found")
+
+    # Locate position detection patterns of each polarity in one pass.
+    polarities = (0, 1) if detect_inverted else (0,)
+    if budget is not None:
+        budget.check("find_patterns")
+    with QRTraceStage(tracer, "find_patterns") as info:
+        pattern_lists = find_position_detection_arrays(img_data, workspace,
+                                                       polarities, tracer)
+        info.update(pixels=img_data.size,
+                    num_patterns=sum(len(p) for p in pattern_lists))
+    if budget is not None:
+        budget.num_patterns = sum(len(p) for p in pattern_lists)
+
+    if debug_level >= 2:
+        for (polarity, patterns) in zip(polarities, pattern_lists):
+            if polarity == 0:
+                debug_msg("POSITION DETECTION PATTERNS:", tracer)
+            else:
+                debug_msg("INVERTED POSITION DETECTION PATTERNS:", tracer)
+            for pattern in patterns.tolist():
+                debug_msg("  " + str(pattern), tracer)
+
+    npattern = max(len(p) for p in pattern_lists)
+    if npattern < 3:
+        if npattern == 0:
+            raise QRDecodeError("No position detection patterns found")
+        raise QRDecodeError("Only {} position detection patterns found"
+                            .format(npattern))
+
+    # Try normal QR codes first, then inverted QR codes.
+    first_exception = None
+    for (polarity, patterns) in zip(polarities, pattern_lists):
+
+        if len(patterns) < 3:
+            continue
+
+        if polarity == 0:
+            pol_data = img_data
+        else:
+            # Swap black and white, so that the inverted QR code
+            # can be decoded from the patterns found above.
+            pol_data = img_data ^ 1
+
+        # Make groups of three compatible finders.
+        if budget is not None:
+            budget.check("make_triplets")
+        with QRTraceStage(tracer, "make_triplets") as info:
+            info.update(polarity=polarity, num_patterns=len(patterns))
+            finder_triplets = make_finder_triplet_array(patterns,
+                                                        pol_data,
+                                                        versions,
+                                                        detect_mirrored,
+                                                        budget)
+            info["num_triplets"] = len(finder_triplets)
+        if budget is not None:
+            budget.num_triplets = ((budget.num_triplets or 0)
+                                   + len(finder_triplets))
+
+        if len(finder_triplets) == 0:
+            if first_exception is None:
+                first_exception = QRDecodeError(
+                    "No valid finder pattern found")
+            continue
+
+        # Try to decode according to each triplet.
+        if result is not None:
+            result.inverted = (polarity == 1)
+        try:
+            return decode_finder_triplets(pol_data,
+                                          finder_triplets,
+                                          debug_level,
+                                          hints,
+                                          workspace,
+                                          budget,
+                                          supersample,
+                                          refine_transform,
+                                          tracer,
+                                          result)
+        except QRDecodeTimeout:
+            raise
         except QRDecodeError as exc:
-            # If decoding fails on the first finder triplet,
-            # save the exception and try decoding the remaining triplets.
-            # If all triplets fail, report the error from the first triplet.
             if first_exception is None:
                 first_exception = exc
-            if debug_level >= 1:
-                debug_msg("FAILED: " + str(exc))
-            continue
 
-        # Successfully extracted a bitstream from the QR code.
-        # This implies we correctly located the QR code in the image,
-        # so from this point on it does not make sense to retry with
-        # different finder triplets if an error occurs.
+    raise first_exception
+
 
-        # Decode the bitstream.
-        return decode_bitstream(bitstream, qr_version)
+def measure_symbol_quality(image, img_data, result):
+    """Measure the greyscale levels and module agreement of a decoded
+    QR code.
 
-    raise first_exception
+    This fills in the attributes "threshold", "dark_level",
+    "light_level", "agreement" and "unstable_modules" of the result.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+        img_data (ndarray): 2D array representing the quantized image.
+        result (QRDecodeResult): Result of a successful decode.
+    """
 
+    data_grey = get_greyscale_data(image)
+    result.threshold = get_quantize_threshold(data_grey)
+
+    pol_data = (img_data ^ 1) if result.inverted else img_data
+    matrix = sample_qr_matrix(pol_data, result.transform, result.qr_version)
+
+    # Sample the greyscale value at the center of each module.
+    # "sample_qr_modules()" returns 1 - value, so subtract again.
+    qrsize = matrix.shape[0]
+    xcoord = np.broadcast_to(np.arange(qrsize, dtype=np.float64),
+                             (qrsize, qrsize))
+    ycoord = xcoord.transpose()
+    grey = 1 - sample_qr_modules(data_grey, result.transform,
+                                 xcoord, ycoord)
+    result.dark_level = float(np.median(grey[matrix == 1]))
+    result.light_level = float(np.median(grey[matrix == 0]))
+
+    (matrix, agreement) = sample_qr_matrix_supersampled(pol_data,
+                                                        result.transform,
+                                                        result.qr_version)
+    result.agreement = float(np.mean(agreement))
+    result.unstable_modules = int(np.count_nonzero(agreement < 1))
+
+
+def decode_qrcode_hinted(image, hints, debug_level=0, workspace=None,
+                         budget=None, tracer=None, result=None,
+                         supersample=1, refine_transform=False,
+                         prefilter_step=2, detect_inverted=False,
+                         detect_mirrored=False):
+    """Decode the QR code in the specified image, using hints to restrict
+    the search to matching QR codes.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+        hints (QRDecodeHints): Hints about the QR code.
+        debug_level (int): Optional debug level (0..3).
+        workspace (QRWorkspace): Optional preallocated buffers.
+        budget (QRDecodeBudget): Optional limits on time and work.
+        tracer (QRTracer): Optional receiver of events.
+        result (QRDecodeResult): Optional result to store details
+            and quality metrics of the QR code.
+        supersample (int): Optional number K to sample K x K points
+            in each module and take the majority.
+        refine_transform (bool): Refine the location of the QR code
+            based on its alignment patterns.
+        prefilter_step (int): Row step of the quick check which rejects
+            images without QR code, or None to disable the check.
+        detect_inverted (bool): Also decode inverted QR codes.
+        detect_mirrored (bool): Also decode mirrored QR codes.
+
+    Returns:
+        Decoded data as a byte string.
+
+    Raises:
+        QRDecodeError: If no QR code matching the hints can be decoded.
+    """
+
+    left = 0
+    top = 0
+
+    # Crop to the region of interest.
+    if hints.bbox is not None:
+        if isinstance(image, np.ndarray):
+            (height, width) = image.shape[:2]
+        else:
+            (width, height) = image.size
+        (left, top, right, bottom) = hints.bbox
+        left = max(left, 0)
+        top = max(top, 0)
+        right = min(right, width)
+        bottom = min(bottom, height)
+        if left >= right or top >= bottom:
+            raise QRDecodeError("Bounding box hint outside image")
+        if isinstance(image, np.ndarray):
+            image = image[top:bottom, left:right]
+        else:
+            image = image.crop((left, top, right, bottom))
+
+    # Convert to black-and-white.
+    with QRTraceStage(tracer, "quantize") as info:
+        if workspace is not None:
+            img_data = quantize_image(image, workspace.img_bw)
+        else:
+            img_data = quantize_image(image)
+        info.update(pixels=img_data.size, array_bytes=img_data.nbytes)
+
+    # Locate and decode a QR code which matches the hints.
+    (data, transform, qr_version
+        ) = detect_and_decode_qrcode(img_data,
+                                     debug_level,
+                                     hints,
+                                     workspace,
+                                     prefilter_step=prefilter_step,
+                                     budget=budget,
+                                     detect_inverted=detect_inverted,
+                                     detect_mirrored=detect_mirrored,
+                                     supersample=supersample,
+                                     refine_transform=refine_transform,
+                                     tracer=tracer,
+                                     result=result)
+
+    if result is not None:
+        measure_symbol_quality(image, img_data, result)
+        # Convert to coordinates in the uncropped image.
+        result.transform = result.transform.copy()
+        result.transform[0, 2] += left
+        result.transform[1, 2] += top
+
+    return data
+
+
+def decode_qrcode(image,
+                  debug_level=0,
+                  hints=None,
+                  prefilter_step=2,
+                  deadline=None,
+                  max_triplets=None,
+                  detect_inverted=False,
+                  detect_mirrored=False,
+                  supersample=1,
+                  refine_transform=False,
+                  tracer=None,
+                  return_result=False,
+                  budget=None):
+    """Decode the QR code in the specified image.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+            See "quantize_image()" for supported array formats.
+        debug_level (int): Optional debug level (0..3).
+        hints (QRDecodeHints): Optional hints about the QR code.
+            If decoding with hints fails, the image is decoded again
+            without hints.
+        prefilter_step (int): Row step of the quick check which rejects
+            images without QR code, or None to disable the check.
+            See "may_contain_qrcode()".
+        deadline (float): Optional maximum decoding time in seconds.
+            The time is checked between decoding stages and for each
+            candidate finder triplet, so a single stage such as finding
+            the patterns may still run past the deadline.
+        max_triplets (int): Optional maximum number of candidate
+            finder triplets to try.
+        detect_inverted (bool): Also decode inverted (light-on-dark)
+            QR codes. Both polarities are detected in a single pass.
+        detect_mirrored (bool): Also decode mirrored QR codes.
+            These are tried after normal QR codes have failed,
+            using the same detected patterns.
+        supersample (int): Optional odd number K to sample a grid of
+            K x K points in each module and take the majority.
+            This reduces module errors in resampled or blurred images.
+        refine_transform (bool): Locate the alignment patterns and
+            refine the location of the QR code before sampling.
+            This helps large QR codes with a non-integer scale factor.
+        tracer (QRTracer): Optional receiver of structured events
+            with timings of each decoding stage, and of debug messages.
+            If not specified and "debug_level" is set, the events
+            are printed with the debug messages.
+        return_result (bool): Return a "QRDecodeResult" with details
+            and quality metrics of the QR code instead of only the data.
+            The metrics take extra time, so they are only computed
+            if requested.
+        budget (QRDecodeBudget): Optional budget to use instead of
+            "deadline" and "max_triplets", for example to cancel
+            the decode from another thread.
+
+    Returns:
+        Decoded data as a byte string, or a "QRDecodeResult"
+        if "return_result" is set.
+
+    Raises:
+        QRDecodeTimeout: If the deadline passes or the maximum number
+            of finder triplets has been tried. The "progress" attribute
+            of the exception describes the partial progress.
+        QRDecodeCancelled: If the budget was cancelled.
+        QRDecodeError: If decoding fails.
+    """
+
+    if deadline is not None or max_triplets is not None:
+        if budget is not None:
+            raise ValueError("Specify either a budget or deadline"
+                             " and max_triplets")
+        budget = QRDecodeBudget(deadline, max_triplets)
+
+    result = None
+    if return_result:
+        result = QRDecodeResult()
+
+    if tracer is None and debug_level > 0:
+        tracer = QRTracer(debug_trace_event)
+
+    with QRTraceStage(tracer, "decode") as decode_info:
+        if isinstance(image, np.ndarray):
+            decode_info["pixels"] = image.shape[0] * image.shape[1]
+        else:
+            decode_info["pixels"] = image.size[0] * image.size[1]
+
+        # First try a fast decode, guided by hints.
+        if hints is not None:
+            try:
+                data = decode_qrcode_hinted(image,
+                                            hints,
+                                            debug_level,
+                                            budget=budget,
+                                            tracer=tracer,
+                                            result=result,
+                                            supersample=supersample,
+                                            refine_transform=refine_transform,
+                                            prefilter_step=prefilter_step,
+                                            detect_inverted=detect_inverted,
+                                            detect_mirrored=detect_mirrored)
+                if result is not None:
+                    return result
+                return data
+            except QRDecodeTimeout:
+                raise
+            except QRDecodeError as exc:
+                if debug_level >= 1:
+                    debug_msg("HINTED DECODE FAILED: " + str(exc), tracer)
+
+        # Convert to black-and-white.
+        if budget is not None:
+            budget.check("quantize")
+        with QRTraceStage(tracer, "quantize") as info:
+            img_data = quantize_image(image)
+            info.update(pixels=img_data.size, array_bytes=img_data.nbytes)
+
+        # Locate and decode the QR code.
+        (data, transform, qr_version
+            ) = detect_and_decode_qrcode(img_data,
+                                         debug_level,
+                                         prefilter_step=prefilter_step,
+                                         budget=budget,
+                                         detect_inverted=detect_inverted,
+                                         detect_mirrored=detect_mirrored,
+                                         supersample=supersample,
+                                         refine_transform=refine_transform,
+                                         tracer=tracer,
+                                         result=result)
+        if result is not None:
+            measure_symbol_quality(image, img_data, result)
+
+    if result is not None:
+        return result
+    return data
+
+
+class QRWorkspace:
+    """Preallocated buffers and cached tables for repeated decoding
+    of images with the same size.
+
+    Buffers are reused by each decode, so arrays returned by functions
+    which use a workspace are only valid until the next decode.
+
+    Attributes:
+        image_shape: Tuple (nrow, ncol) of the images.
+        img_bw (ndarray): Buffer for the quantized image.
+        hboundaries: Tuple of buffers for horizontal boundary scan.
+        vboundaries: Tuple of buffers for vertical boundary scan.
+
+    The per-version tables do not depend on the image size, so they
+    can be shared with a workspace for another image size, as long as
+    the workspaces are not used at the same time.
+    """
+
+    def __init__(self, image_shape, tables_from=None):
+        """Allocate buffers for images of the specified size.
+
+        Parameters:
+            image_shape: Tuple (nrow, ncol) or shape of a Numpy array
+                containing the image.
+            tables_from (QRWorkspace): Optional workspace whose
+                per-version tables are shared with this workspace.
+        """
+
+        (nrow, ncol) = image_shape[:2]
+        self.image_shape = (nrow, ncol)
+        self.img_bw = np.zeros((nrow, ncol), dtype=np.uint8)
+        self.hboundaries = (np.zeros((nrow, ncol + 2), dtype=np.uint32),
+                            np.zeros((nrow, ncol), dtype=np.uint32))
+        self.vboundaries = (np.zeros((ncol, nrow + 2), dtype=np.uint32),
+                            np.zeros((ncol, nrow), dtype=np.uint32))
+        if tables_from is not None:
+            self.sample_buffers = tables_from.sample_buffers
+            self.data_index = tables_from.data_index
+            self.data_mask = tables_from.data_mask
+        else:
+            self.sample_buffers = {}
+            self.data_index = {}
+            self.data_mask = {}
+
+    def precompute_tables(self, versions=range(1, 41)):
+        """Compute the codeword tables of the specified QR versions
+        in advance, so that the first decode of each version is not
+        slower than the following ones.
+
+        Parameters:
+            versions: Collection of QR code versions.
+        """
+        for qr_version in versions:
+            for mask_pattern in range(8):
+                self.get_data_mask(qr_version, mask_pattern)
+
+    def get_sample_buffers(self, qr_version):
+        """Return cached module coordinates and buffers for sampling
+        a QR matrix of the specified version."""
+
+        if qr_version not in self.sample_buffers:
+            qrsize = 17 + 4 * qr_version
+            xcenter = np.zeros((qrsize, qrsize))
+            xcenter[0] = np.arange(qrsize) + 0.5
+            xcenter[1:] = xcenter[0]
+            ycenter = xcenter.transpose().copy()
+            self.sample_buffers[qr_version] = (
+                xcenter,
+                ycenter,
+                np.zeros((qrsize, qrsize)),
+                np.zeros((qrsize, qrsize)),
+                np.zeros((qrsize, qrsize), dtype=np.intp),
+                np.zeros((qrsize, qrsize), dtype=np.intp),
+                np.zeros((qrsize, qrsize), dtype=np.uint8))
+
+        return self.sample_buffers[qr_version]
+
+    def sample_qr_matrix(self, img_data, transform, qr_version):
+        """Sample each module in the QR matrix, using preallocated buffers.
+
+        See "sample_qr_matrix()".
+        """
+
+        (xcenter, ycenter, xpos, ypos, xidx, yidx, matrix
+            ) = self.get_sample_buffers(qr_version)
+
+        # Transform module centers to pixel coordinates.
+        np.multiply(xcenter, transform[0, 0], out=xpos)
+        np.multiply(ycenter, transform[0, 1], out=ypos)
+        xpos += ypos
+        xpos += transform[0, 2]
+        np.copyto(xidx, xpos, casting="unsafe")
+
+        np.multiply(xcenter, transform[1, 0], out=xpos)
+        np.multiply(ycenter, transform[1, 1], out=ypos)
+        ypos += xpos
+        ypos += transform[1, 2]
+        np.copyto(yidx, ypos, casting="unsafe")
+
+        # Clip coordinates to the image area.
+        (nrow, ncol) = img_data.shape
+        np.clip(xidx, 0, ncol - 1, out=xidx)
+        np.clip(yidx, 0, nrow - 1, out=yidx)
+
+        # Gather pixels via flat indices.
+        yidx *= ncol
+        yidx += xidx
+        np.take(img_data, yidx, out=matrix)
+        np.subtract(1, matrix, out=matrix)
+
+        return matrix
+
+    def get_data_index(self, qr_version):
+        """Return cached flat indices of the codeword modules
+        in placement order."""
+
+        if qr_version not in self.data_index:
+            qrsize = 17 + 4 * qr_version
+            data_locations = get_data_locations(qr_version)
+            self.data_index[qr_version] = (data_locations[:, 1] * qrsize
+                                           + data_locations[:, 0])
+        return self.data_index[qr_version]
+
+    def get_data_mask(self, qr_version, mask_pattern):
+        """Return cached mask values of the codeword modules
+        in placement order."""
+
+        key = (qr_version, mask_pattern)
+        if key not in self.data_mask:
+            qrsize = 17 + 4 * qr_version
+            mask = make_mask_pattern(qrsize, mask_pattern)
+            data_index = self.get_data_index(qr_version)
+            self.data_mask[key] = np.take(mask, data_index)
+        return self.data_mask[key]
+
+
+class QRDecoder:
+    """Reusable decoder for a stream of images with the same size.
+
+    This is equivalent to calling "decode_qrcode()" for each image,
+    but avoids repeated allocation of large arrays by reusing
+    preallocated buffers and cached tables.
+
+    Attributes:
+        workspace (QRWorkspace): Buffers and tables used by the decoder.
+        debug_level (int): Debug level (0..3).
+        hints (QRDecodeHints): Hints about the QR code, or None.
+        tracer (QRTracer): Receiver of tracing events, or None.
+        detect_inverted (bool): Also decode inverted QR codes.
+        detect_mirrored (bool): Also decode mirrored QR codes.
+        supersample (int): Number K to sample K x K points in each module.
+        refine_transform (bool): Refine the location of the QR code
+            based on its alignment patterns.
+    """
+
+    def __init__(self, image_shape, debug_level=0, hints=None, tracer=None,
+                 detect_inverted=False, detect_mirrored=False,
+                 supersample=1, refine_transform=False):
+        """Create a decoder for images of the specified size.
+
+        Parameters:
+            image_shape: Tuple (nrow, ncol) or shape of a Numpy array
+                containing the image. Images of a different size
+                can still be decoded, but will cause new buffers
+                to be allocated.
+            debug_level (int): Optional debug level (0..3).
+            hints (QRDecodeHints): Optional hints about the QR code.
+            tracer (QRTracer): Optional receiver of tracing events
+                and debug messages. See "decode_qrcode()".
+            detect_inverted (bool): Also decode inverted (light-on-dark)
+                QR codes. See "decode_qrcode()".
+            detect_mirrored (bool): Also decode mirrored QR codes.
+            supersample (int): Optional odd number K to sample K x K
+                points in each module and take the majority.
+            refine_transform (bool): Refine the location of the QR code
+                based on its alignment patterns.
+        """
+        self.workspace = QRWorkspace(image_shape)
+        self.debug_level = debug_level
+        self.hints = hints
+        if tracer is None and debug_level > 0:
+            tracer = QRTracer(debug_trace_event)
+        self.tracer = tracer
+        self.detect_inverted = detect_inverted
+        self.detect_mirrored = detect_mirrored
+        self.supersample = supersample
+        self.refine_transform = refine_transform
+
+    def decode(self, image, return_result=False):
+        """Decode the QR code in the specified image.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+            return_result (bool): Return a "QRDecodeResult" with details
+                and quality metrics of the QR code.
+
+        Returns:
+            Decoded data as a byte string, or a "QRDecodeResult"
+            if "return_result" is set.
+
+        Raises:
+            QRDecodeError: If decoding fails.
+        """
+
+        result = None
+        if return_result:
+            result = QRDecodeResult()
+
+        if isinstance(image, np.ndarray):
+            image_shape = image.shape[:2]
+        else:
+            image_shape = (image.size[1], image.size[0])
+
+        if image_shape != self.workspace.image_shape:
+            self.workspace = QRWorkspace(image_shape,
+                                         tables_from=self.workspace)
+
+        # First try a fast decode, guided by hints.
+        if self.hints is not None:
+            try:
+                data = decode_qrcode_hinted(
+                    image,
+                    self.hints,
+                    self.debug_level,
+                    self.workspace,
+                    tracer=self.tracer,
+                    result=result,
+                    supersample=self.supersample,
+                    refine_transform=self.refine_transform,
+                    detect_inverted=self.detect_inverted,
+                    detect_mirrored=self.detect_mirrored)
+                if result is not None:
+                    return result
+                return data
+            except QRDecodeError as exc:
+                if self.debug_level >= 1:
+                    debug_msg("HINTED DECODE FAILED: " + str(exc),
+                              self.tracer)
+
+        # Convert to black-and-white.
+        with QRTraceStage(self.tracer, "quantize") as info:
+            img_data = quantize_image(image, self.workspace.img_bw)
+            info.update(pixels=img_data.size, array_bytes=img_data.nbytes)
+
+        # Locate and decode the QR code.
+        (data, transform, qr_version) = detect_and_decode_qrcode(
+            img_data,
+            self.debug_level,
+            workspace=self.workspace,
+            detect_inverted=self.detect_inverted,
+            detect_mirrored=self.detect_mirrored,
+            supersample=self.supersample,
+            refine_transform=self.refine_transform,
+            tracer=self.tracer,
+            result=result)
+        if result is not None:
+            measure_symbol_quality(image, img_data, result)
+            return result
+        return data
+
+
+# Intermediate results of the stages of "QRPipeline".
+QuantizedImage = collections.namedtuple(
+    "QuantizedImage", ["img_data", "threshold"])
+QRLocation = collections.namedtuple(
+    "QRLocation", ["transform", "qr_version", "triplet"])
+QRFormat = collections.namedtuple(
+    "QRFormat", ["error_correction_level", "mask_pattern"])
+
+
+class QRPipeline:
+    """Step-by-step decoding of a single image, with cached results.
+
+    Each stage of the decoding process is a separate method which
+    takes the result of earlier stages as input. Results of expensive
+    stages are cached, so a stage can be repeated with different inputs
+    without redoing the work of earlier stages. For example, the QR
+    matrix can be re-sampled from an image quantized with a different
+    threshold while reusing the finder patterns that were already found.
+
+    Cached results are shared by all callers, so they are returned
+    as read-only arrays and tuples.
+
+    Example:
+
+        pipeline = QRPipeline(image)
+        quantized = pipeline.quantize()
+        triplets = pipeline.make_triplets(quantized)
+        location = pipeline.locate(triplets[0], quantized)
+        matrix = pipeline.sample(location, pipeline.quantize(threshold=100))
+        qr_format = pipeline.read_format(matrix)
+        codewords = pipeline.extract_codewords(matrix, qr_format)
+        bitstream = pipeline.correct_errors(codewords, location, qr_format)
+        data = pipeline.decode_data(bitstream, location)
+    """
+
+    def __init__(self, image, debug_level=0, tracer=None):
+        """Prepare to decode the specified image.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+            debug_level (int): Optional debug level (0..3).
+            tracer (QRTracer): Optional receiver of debug messages,
+                and of tracing events from "correct_errors()" and
+                "decode()". See "decode_qrcode()".
+        """
+        self.image = image
+        self.debug_level = debug_level
+        if tracer is None and debug_level > 0:
+            tracer = QRTracer(debug_trace_event)
+        self.tracer = tracer
+        self.cache = {}
+
+    def cached(self, key, func, *args):
+        """Return the cached result for "key", or call "func"."""
+        if key not in self.cache:
+            self.cache[key] = func(*args)
+        return self.cache[key]
+
+    def clear_cache(self):
+        """Discard all cached results."""
+        self.cache = {}
+
+    @staticmethod
+    def read_only(array):
+        """Return a read-only view of an array."""
+        view = array.view()
+        view.flags.writeable = False
+        return view
+
+    def greyscale(self):
+        """Return the greyscale pixel values of the image."""
+        return self.cached(("greyscale",),
+                           lambda: self.read_only(
+                               get_greyscale_data(self.image)))
+
+    def quantize(self, threshold=None):
+        """Quantize the image into black and white pixels.
+
+        Parameters:
+            threshold (int): Optional greyscale threshold.
+
+        Returns:
+            QuantizedImage(img_data, threshold)
+        """
+        data_grey = self.greyscale()
+        if threshold is None:
+            threshold = self.cached(("threshold",),
+                                    get_quantize_threshold,
+                                    data_grey)
+        return self.cached(
+            ("quantize", threshold),
+            lambda: QuantizedImage(
+                self.read_only(quantize_image(data_grey,
+                                              threshold=threshold)),
+                threshold))
+
+    def find_patterns(self, quantized=None):
+        """Locate position detection patterns.
+
+        Parameters:
+            quantized (QuantizedImage): Default "self.quantize()".
+
+        Returns:
+            Tuple of tuples (x, y, dx, dy).
+        """
+        if quantized is None:
+            quantized = self.quantize()
+        patterns = self.cached(("patterns", quantized.threshold),
+                               lambda: tuple(find_position_detection_patterns(
+                                   quantized.img_data)))
+        if self.debug_level >= 2:
+            debug_msg("POSITION DETECTION PATTERNS:", self.tracer)
+            for pattern in patterns:
+                debug_msg("  " + str(pattern), self.tracer)
+        return patterns
+
+    def make_triplet_array(self, quantized=None):
+        """Make groups of three compatible position detection patterns,
+        with the location of each checked triplet.
+
+        Parameters:
+            quantized (QuantizedImage): Default "self.quantize()".
+
+        Returns:
+            Read-only 1D array of TRIPLET_DTYPE.
+            See "make_finder_triplet_array()".
+        """
+        if quantized is None:
+            quantized = self.quantize()
+        patterns = self.find_patterns(quantized)
+        return self.cached(("triplet_array", quantized.threshold),
+                           lambda: self.read_only(make_finder_triplet_array(
+                               patterns, quantized.img_data)))
+
+    def make_triplets(self, quantized=None):
+        """Make groups of three compatible position detection patterns.
+
+        Parameters:
+            quantized (QuantizedImage): Default "self.quantize()".
+
+        Returns:
+            Tuple of tuples (finder_ul, finder_ur, finder_dl).
+        """
+        if quantized is None:
+            quantized = self.quantize()
+        triplets = self.make_triplet_array(quantized)
+        return self.cached(("triplets", quantized.threshold),
+                           lambda: tuple(triplet[:3]
+                                         for triplet in triplets.tolist()))
+
+    def locate(self, triplet, quantized=None):
+        """Determine location and version of the QR code
+        defined by a finder triplet.
+
+        Parameters:
+            triplet: Tuple (finder_ul, finder_ur, finder_dl).
+            quantized (QuantizedImage): Default "self.quantize()".
+
+        Returns:
+            QRLocation(transform, qr_version, triplet)
+
+        Raises:
+            QRDecodeError: If no QR code was detected.
+        """
+        if quantized is None:
+            quantized = self.quantize()
+        key = ("locate", quantized.threshold, triplet)
+        if key not in self.cache:
+            (transform, qr_version) = locate_qr_code(quantized.img_data,
+                                                     triplet)
+            self.cache[key] = QRLocation(self.read_only(transform),
+                                         qr_version, triplet)
+        return self.cache[key]
+
+    def sample(self, location, quantized=None):
+        """Sample each module in the QR matrix.
+
+        Parameters:
+            location (QRLocation): Location of the QR code.
+            quantized (QuantizedImage): Default "self.quantize()".
+
+        Returns:
+            Read-only 2D square Numpy array containing the value
+            of each module.
+        """
+        if quantized is None:
+            quantized = self.quantize()
+        key = ("sample",
+               quantized.threshold,
+               location.transform.tobytes(),
+               location.qr_version)
+        matrix = self.cached(key,
+                             lambda: self.read_only(sample_qr_matrix(
+                                 quantized.img_data,
+                                 location.transform,
+                                 location.qr_version)))
+        if self.debug_level >= 3:
+            debug_msg(matrix_to_string(matrix), self.tracer)
+        return matrix
+
+    def read_format(self, matrix):
+        """Extract format information from the QR matrix.
+
+        Returns:
+            QRFormat(error_correction_level, mask_pattern)
+
+        Raises:
+            QRDecodeError: If the format information can not be decoded.
+        """
+        return QRFormat(*extract_format_data(matrix))
+
+    def extract_codewords(self, matrix, qr_format):
+        """Extract the sequence of codewords from the QR matrix.
+
+        Returns:
+            Array of codewords in order of placement in the matrix.
+        """
+        return extract_codewords(matrix, qr_format.mask_pattern)
+
+    def correct_errors(self, codewords, location, qr_format):
+        """Perform error correction and return the data codewords.
+
+        Returns:
+            List of error-corrected data codewords.
+
+        Raises:
+            QRDecodeError: If error correction fails.
+        """
+        key = ("correct_errors",
+               bytes(codewords),
+               location.qr_version,
+               qr_format.error_correction_level)
+        return list(self.cached(key,
+                                codeword_error_correction,
+                                list(codewords),
+                                location.qr_version,
+                                qr_format.error_correction_level,
+                                self.debug_level,
+                                self.tracer))
+
+    def decode_data(self, bitstream, location):
+        """Decode the error-corrected bitstream.
+
+        Returns:
+            Decoded data as a byte string.
+
+        Raises:
+            QRDecodeError: If decoding fails.
+        """
+        return decode_bitstream(bitstream, location.qr_version)
+
+    def decode(self, threshold=None, sample_threshold=None):
+        """Run all stages to decode the QR code.
+
+        The finder triplets are tried with "decode_finder_triplets()".
+        Triplets which pass the check of "make_finder_triplet_array()"
+        are located in the image quantized with "threshold", and the
+        QR matrix is sampled from the image quantized with
+        "sample_threshold".
+
+        Parameters:
+            threshold (int): Optional threshold for finding the QR code.
+            sample_threshold (int): Optional threshold for sampling
+                the QR matrix (default: same as "threshold").
+
+        Returns:
+            Decoded data as a byte string.
+
+        Raises:
+            QRDecodeError: If decoding fails.
+        """
+
+        quantized = self.quantize(threshold)
+        if sample_threshold is None:
+            sample_quantized = quantized
+        else:
+            sample_quantized = self.quantize(sample_threshold)
+
+        patterns = self.find_patterns(quantized)
+        if len(patterns) < 3:
+            npattern = len(patterns)
+            if npattern == 0:
+                raise QRDecodeError("No position detection patterns found")
+            raise QRDecodeError("Only {} position detection patterns found"
+                                .format(npattern))
+
+        triplets = self.make_triplet_array(quantized)
+        (data, transform, qr_version
+            ) = decode_finder_triplets(sample_quantized.img_data,
+                                       triplets,
+                                       self.debug_level,
+                                       tracer=self.tracer)
+        return data
+
+
+class QRTracker:
+    """Decode a sequence of video frames which show a QR code at
+    approximately the same location in each frame.
+
+    After a successful decode, the tracker remembers the location of
+    the QR code. The next frame is first decoded by sampling the QR matrix
+    at the remembered location, allowing for a small shift. The full
+    detection process is only used when this fails.
+
+    If the sampled QR matrix is identical to the matrix of the previous
+    frame, the previous data is returned without error correction.
+
+    If the pixels in the region around the QR code are identical to
+    the previous frame, the previous data is returned without quantizing
+    or sampling the new frame. Changes outside this region are ignored.
+
+    Frames can be PIL images or Numpy arrays, as for "decode_qrcode()".
+
+    Attributes:
+        transform (ndarray): Affine transform of the most recently
+            decoded QR code, or None.
+        qr_version (int): Version of the most recently decoded QR code,
+            or None.
+        frames_skipped (int): Number of unchanged frames for which
+            the previous data was returned.
+        frames_tracked (int): Number of frames decoded by tracking.
+        frames_detected (int): Number of frames decoded by full detection.
+        frames_failed (int): Number of frames that could not be decoded.
+    """
+
+    def __init__(self, search_radius=2, skip_unchanged=True, debug_level=0,
+                 tracer=None):
+        """Create a tracker.
+
+        Parameters:
+            search_radius (int): Maximum shift (in pixels) of the QR code
+                between consecutive frames that is found without using
+                full detection.
+            skip_unchanged (bool): True to return the previous data
+                when the region around the QR code is unchanged.
+            debug_level (int): Optional debug level (0..3).
+            tracer (QRTracer): Optional receiver of debug messages
+                and tracing events. See "decode_qrcode()".
+        """
+        self.search_radius = search_radius
+        self.skip_unchanged = skip_unchanged
+        self.debug_level = debug_level
+        if tracer is None and debug_level > 0:
+            tracer = QRTracer(debug_trace_event)
+        self.tracer = tracer
+        self.transform = None
+        self.qr_version = None
+        self.matrix = None
+        self.data = None
+        self.region_bbox = None
+        self.region_signature = None
+        self.frames_skipped = 0
+        self.frames_tracked = 0
+        self.frames_detected = 0
+        self.frames_failed = 0
+
+    def reset(self):
+        """Forget the location of the previous QR code."""
+        self.transform = None
+        self.qr_version = None
+        self.matrix = None
+        self.data = None
+        self.region_bbox = None
+        self.region_signature = None
+
+    def get_stats(self):
+        """Return a dictionary with frame counters."""
+        return {"skipped": self.frames_skipped,
+                "tracked": self.frames_tracked,
+                "detected": self.frames_detected,
+                "failed": self.frames_failed}
+
+    @staticmethod
+    def get_image_size(image):
+        """Return the size of an image as a tuple (width, height).
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+        """
+        if isinstance(image, np.ndarray):
+            return (image.shape[1], image.shape[0])
+        return image.size
+
+    @staticmethod
+    def get_region_data(image, bbox):
+        """Return the greyscale pixel values of an image region.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+            bbox: Tuple (left, top, right, bottom) in pixel coordinates.
+
+        Returns:
+            2D Numpy array of greyscale pixel values.
+            See "get_greyscale_data()".
+        """
+        (left, top, right, bottom) = bbox
+        if isinstance(image, np.ndarray):
+            return get_greyscale_data(image[top:bottom, left:right])
+        return get_greyscale_data(image.crop(bbox))
+
+    @staticmethod
+    def get_region_signature(image, bbox):
+        """Return a hash of the pixel data in the specified image region.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+            bbox: Tuple (left, top, right, bottom) in pixel coordinates.
+
+        Returns:
+            Signature as a byte string.
+        """
+        region = QRTracker.get_region_data(image, bbox)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(region.dtype.str.encode("ascii"))
+        digest.update(np.ascontiguousarray(region).data)
+        return digest.digest()
+
+    def update_region_signature(self, image):
+        """Store the signature of the region around the current QR code.
+
+        Parameters:
+            image (PIL.Image or ndarray): Most recently decoded frame.
+        """
+        self.region_bbox = None
+        self.region_signature = None
+        if self.skip_unchanged:
+            try:
+                bbox = self.get_tracked_bbox(self.get_image_size(image))
+            except QRDecodeError:
+                return
+            self.region_bbox = bbox
+            self.region_signature = self.get_region_signature(image, bbox)
+
+    def is_unchanged(self, image):
+        """Check whether the region around the QR code is unchanged
+        since the previous frame.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+
+        Returns:
+            True if the region around the QR code is unchanged.
+        """
+        if self.region_signature is None:
+            return False
+        try:
+            bbox = self.get_tracked_bbox(self.get_image_size(image))
+        except QRDecodeError:
+            return False
+        if bbox != self.region_bbox:
+            return False
+        signature = self.get_region_signature(image, bbox)
+        return signature == self.region_signature
+
+    def get_tracked_bbox(self, image_size):
+        """Return the image region that must be examined to track
+        the QR code from the previous frame.
+
+        Parameters:
+            image_size: Tuple (width, height) of the new frame.
+
+        Returns:
+            Tuple (left, top, right, bottom) in pixel coordinates.
+
+        Raises:
+            QRDecodeError: If the region is outside the image.
+        """
+
+        qrsize = 17 + 4 * self.qr_version
+        corners = np.array([[0, qrsize, 0, qrsize],
+                            [0, 0, qrsize, qrsize],
+                            [1, 1, 1, 1]])
+        (xpix, ypix) = np.dot(self.transform[:2], corners)
+
+        (width, height) = image_size
+        margin = self.search_radius + 2
+        left = max(int(np.min(xpix)) - margin, 0)
+        top = max(int(np.min(ypix)) - margin, 0)
+        right = min(int(np.max(xpix)) + margin + 1, width)
+        bottom = min(int(np.max(ypix)) + margin + 1, height)
+
+        if left >= right or top >= bottom:
+            raise QRDecodeError("Tracked QR code outside image")
+
+        return (left, top, right, bottom)
+
+    def decode_tracked(self, image):
+        """Decode the QR code at the location found in the previous frame.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+
+        Returns:
+            Decoded data as a byte string.
+
+        Raises:
+            QRDecodeError: If the QR code can not be found near
+                the previous location.
+        """
+
+        if self.transform is None:
+            raise QRDecodeError("No QR code location to track")
+
+        # Quantize only the region around the previous location.
+        bbox = self.get_tracked_bbox(self.get_image_size(image))
+        (left, top, right, bottom) = bbox
+        img_data = quantize_image(self.get_region_data(image, bbox))
+
+        transform = self.transform.copy()
+        transform[0, 2] -= left
+        transform[1, 2] -= top
+
+        # Try the previous location first. If the timing patterns or
+        # format information do not match, look for the best matching
+        # location within the search radius.
+        best_score = score_qr_transform(img_data, transform, self.qr_version)
+        if best_score < 1:
+            best_shift = (0, 0)
+            radius = self.search_radius
+            for dy in range(-radius, radius + 1):
+                for dx in range(-radius, radius + 1):
+                    if (dx, dy) == (0, 0):
+                        continue
+                    shifted = transform.copy()
+                    shifted[0, 2] += dx
+                    shifted[1, 2] += dy
+                    score = score_qr_transform(img_data,
+                                               shifted,
+                                               self.qr_version)
+                    if score > best_score:
+                        best_score = score
+                        best_shift = (dx, dy)
+            transform[0, 2] += best_shift[0]
+            transform[1, 2] += best_shift[1]
+
+        if best_score == 0:
+            raise QRDecodeError("Lost track of QR code")
+
+        if self.debug_level >= 2:
+            debug_msg("TRACKED TRANSFORM:", self.tracer)
+            debug_msg(str(transform), self.tracer)
+
+        matrix = sample_qr_matrix(img_data, transform, self.qr_version)
+
+        if self.debug_level >= 3:
+            debug_msg(matrix_to_string(matrix), self.tracer)
+
+        # Skip error correction if the QR matrix did not change.
+        if self.matrix is not None and np.array_equal(matrix, self.matrix):
+            data = self.data
+        else:
+            bitstream = extract_matrix_bitstream(matrix, self.debug_level,
+                                                 tracer=self.tracer)
+            data = decode_bitstream(bitstream, self.qr_version)
+
+        transform[0, 2] += left
+        transform[1, 2] += top
+        self.transform = transform
+        self.matrix = matrix
+        self.data = data
+
+        return data
+
+    def decode(self, image):
+        """Decode the QR code in the next frame.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+                See "quantize_image()" for supported array formats.
+
+        Returns:
+            Decoded data as a byte string.
+
+        Raises:
+            QRDecodeError: If decoding fails.
+        """
+
+        # Return the previous data if the QR code region is unchanged.
+        if self.skip_unchanged and self.is_unchanged(image):
+            self.frames_skipped += 1
+            return self.data
+
+        # Try to track the QR code from the previous frame.
+        if self.transform is not None:
+            try:
+                data = self.decode_tracked(image)
+                self.update_region_signature(image)
+                self.frames_tracked += 1
+                return data
+            except QRDecodeError as exc:
+                if self.debug_level >= 1:
+                    debug_msg("TRACKING FAILED: " + str(exc), self.tracer)
+
+        # Fall back to full detection.
+        img_data = quantize_image(image)
+        try:
+            (data, transform, qr_version
+                ) = detect_and_decode_qrcode(img_data, self.debug_level,
+                                         tracer=self.tracer)
+        except QRDecodeError:
+            self.frames_failed += 1
+            raise
+
+        self.transform = transform
+        self.qr_version = qr_version
+        self.matrix = sample_qr_matrix(img_data, transform, qr_version)
+        self.data = data
+        self.update_region_signature(image)
+        self.frames_detected += 1
+        return data
@@ -0,0 +1,300 @@
+"""
+Asynchronous QR decoding for asyncio applications.
+
+Decodes run in a thread pool or process pool, so that they do not block
+the event loop. The number of concurrent decodes is limited by a
+semaphore. A cancelled decode gives up its place: if it is still waiting,
+it is removed from the queue, and if it is running in a thread, it stops
+at the next decoding stage.
+"""
+
+import os
+import asyncio
+import functools
+import concurrent.futures
+import qrdecode
+
+
+def decode_in_worker(image, decode_args, budget=None):
+    """Decode an image in a worker of the executor.
+
+    Errors are returned instead of raised, because "QRDecodeTimeout"
+    can not be passed back from a worker process.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+        decode_args (dict): Keyword arguments for "decode_qrcode()".
+        budget (QRDecodeBudget): Optional budget, which can be
+            cancelled if the worker is a thread.
+
+    Returns:
+        Tuple (value, error, progress), where "value" is the return
+        value of "decode_qrcode()" or None, "error" is the error message
+        or None, and "progress" is the progress reported by a timeout
+        or None.
+    """
+    try:
+        value = qrdecode.decode_qrcode(image, budget=budget, **decode_args)
+        return (value, None, None)
+    except qrdecode.QRDecodeTimeout as exc:
+        return (None, str(exc), exc.progress)
+    except qrdecode.QRDecodeError as exc:
+        return (None, str(exc), None)
+
+
+class QRAsyncDecoder:
+    """Decode QR codes from asyncio code without blocking the event loop.
+
+    Example:
+
+        async with QRAsyncDecoder(max_concurrency=4) as decoder:
+            data = await decoder.decode(image)
+            async for (index, data, error) in decoder.decode_batch(images):
+                ...
+
+    The concurrency limit applies to the event loop which is running
+    the decodes. A decoder should only be used from one event loop
+    at a time.
+    """
+
+    def __init__(self, max_concurrency=None, executor="thread"):
+        """Create a decoder.
+
+        Parameters:
+            max_concurrency (int): Maximum number of decodes running
+                at the same time (default: number of CPUs).
+            executor: Either "thread" or "process" to create a pool
+                of "max_concurrency" threads or processes, or an existing
+                "concurrent.futures.Executor", which is not shut down
+                by "close()". Running decodes can only be interrupted
+                in a thread pool.
+        """
+
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count() or 1
+        if max_concurrency < 1:
+            raise ValueError("Invalid max_concurrency")
+
+        self.max_concurrency = max_concurrency
+        self.owns_executor = True
+        if executor == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_concurrency, thread_name_prefix="qrdecode")
+        elif executor == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_concurrency)
+        elif isinstance(executor, concurrent.futures.Executor):
+            self.executor = executor
+            self.owns_executor = False
+        else:
+            raise ValueError("Invalid executor")
+
+        self.interruptible = isinstance(self.executor,
+                                        concurrent.futures.ThreadPoolExecutor)
+        self.loop = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def close(self):
+        """Shut down the executor, if it was created by the decoder.
+
+        This waits until running decodes have finished.
+        """
+        if self.owns_executor and self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.executor = None
+
+    async def aclose(self):
+        """Shut down the executor without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.close)
+
+    def get_semaphore(self):
+        """Return the semaphore which limits concurrency
+        in the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.semaphore
+
+    def release_slot(self, loop, semaphore, future):
+        """Release a place in the semaphore when an executor job
+        has finished. Called from the thread which completes the job."""
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            # The event loop has been closed.
+            pass
+
+    async def decode(self, image, **decode_args):
+        """Decode the QR code in the specified image.
+
+        The place of the decode is only released when the executor job
+        has finished, so a cancelled decode can not overload the executor.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image. The image must not
+                be modified until the decode has finished.
+            decode_args: Keyword arguments for "decode_qrcode()", except
+                "budget". A tracer only works with a thread pool.
+
+        Returns:
+            Return value of "decode_qrcode()".
+
+        Raises:
+            QRDecodeTimeout: If the deadline passes or the maximum number
+                of finder triplets has been tried.
+            QRDecodeError: If decoding fails.
+            asyncio.CancelledError: If the decode is cancelled.
+        """
+
+        if self.executor is None:
+            raise ValueError("Decoder is closed")
+
+        loop = asyncio.get_running_loop()
+        semaphore = self.get_semaphore()
+        await semaphore.acquire()
+
+        budget = None
+        try:
+            if self.interruptible:
+                budget = qrdecode.QRDecodeBudget(
+                    decode_args.pop("deadline", None),
+                    decode_args.pop("max_triplets", None))
+            future = self.executor.submit(decode_in_worker, image,
+                                          decode_args, budget)
+        except BaseException:
+            semaphore.release()
+            raise
+        future.add_done_callback(
+            functools.partial(self.release_slot, loop, semaphore))
+
+        try:
+            (value, error, progress) = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # A job which has not started is removed from the queue.
+            # A running job stops at the next decoding stage.
+            future.cancel()
+            if budget is not None:
+                budget.cancel()
+            raise
+
+        if progress is not None:
+            raise qrdecode.QRDecodeTimeout(error, progress)
+        if error is not None:
+            raise qrdecode.QRDecodeError(error)
+        return value
+
+    async def decode_indexed(self, index, image, decode_args):
+        """Decode an image and return a tuple (index, value, error)."""
+        try:
+            value = await self.decode(image, **decode_args)
+            return (index, value, None)
+        except qrdecode.QRDecodeError as exc:
+            return (index, None, str(exc))
+
+    async def decode_batch(self, images, ordered=True, **decode_args):
+        """Decode a sequence of images concurrently.
+
+        Images are taken from the input only when fewer than
+        2 * max_concurrency results are outstanding, so the input
+        may be a long or endless iterator. If the caller stops
+        iterating and closes the generator, pending decodes are
+        cancelled.
+
+        Parameters:
+            images: Iterable or asynchronous iterable of images.
+            ordered (bool): Yield results in the order of the input.
+                Otherwise results are yielded as soon as available.
+            decode_args: Keyword arguments for "decode_qrcode()".
+
+        Yields:
+            Tuple (index, value, error) for each image, where "value" is
+            the return value of "decode_qrcode()", or None if decoding
+            failed, and "error" is the error message, or None.
+        """
+
+        is_async = hasattr(images, "__aiter__")
+        if is_async:
+            image_iter = images.__aiter__()
+        else:
+            image_iter = iter(images)
+
+        max_outstanding = 2 * self.max_concurrency
+        pending = set()
+        done_results = {}
+        next_index = 0
+        next_yield_index = 0
+        exhausted = False
+
+        try:
+            while True:
+                while (not exhausted
+                       and len(pending) + len(done_results) < max_outstanding):
+                    try:
+                        if is_async:
+                            image = await image_iter.__anext__()
+                        else:
+                            image = next(image_iter)
+                    except (StopIteration, StopAsyncIteration):
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(
+                        self.decode_indexed(next_index, image, decode_args)))
+                    next_index += 1
+
+                if not pending:
+                    break
+
+                (done, pending) = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                results = sorted(task.result() for task in done)
+
+                if not ordered:
+                    for result in results:
+                        yield result
+                    continue
+
+                for result in results:
+                    done_results[result[0]] = result
+                while next_yield_index in done_results:
+                    yield done_results.pop(next_yield_index)
+                    next_yield_index += 1
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+# Decoder used by "decode_qrcode_async()", created on first use.
+default_decoder = None
+
+
+async def decode_qrcode_async(image, decoder=None, **decode_args):
+    """Decode the QR code in the specified image without blocking
+    the event loop.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+        decoder (QRAsyncDecoder): Optional decoder which runs the decode.
+            By default a shared decoder with a thread pool is used.
+        decode_args: Keyword arguments for "decode_qrcode()".
+
+    Returns:
+        Return value of "decode_qrcode()".
+
+    Raises:
+        QRDecodeError: If decoding fails.
+    """
+    global default_decoder
+    if decoder is None:
+        if default_decoder is None:
+            default_decoder = QRAsyncDecoder()
+        decoder = default_decoder
+    return await decoder.decode(image, **decode_args)
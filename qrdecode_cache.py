@@ -0,0 +1,353 @@
+"""
+Cache of QR decoding results, keyed by image content.
+
+Identical images are decoded only once. Results are stored in an
+in-memory LRU cache and optionally in an SQLite database which can be
+shared between processes. Failed decodes are also cached, but expire
+after a configurable time. Expired failures are deleted from the
+database, and its number of entries is limited.
+"""
+
+import os
+import time
+import inspect
+import sqlite3
+import hashlib
+import threading
+import collections
+import numpy as np
+import qrdecode
+
+
+# Approximate memory overhead of a cache entry in bytes,
+# in addition to the size of the decoded data.
+CACHE_ENTRY_OVERHEAD = 200
+
+# Number of stores between two size checks of the persistent cache.
+DISK_TRIM_INTERVAL = 100
+
+# Options of "decode_qrcode()" which affect the decoded data.
+# The other options, such as a deadline or a tracer, only decide
+# whether the decode completes, so they are not part of the cache key.
+RESULT_OPTIONS = ("hints", "prefilter_step", "detect_inverted",
+                  "detect_mirrored", "supersample", "refine_transform")
+
+
+def image_cache_key(image, options=()):
+    """Return a hash of the pixel data of an image and decode options.
+
+    For palette images, the palette and transparency are included,
+    because the pixel data only contains palette indices.
+
+    Parameters:
+        image (PIL.Image or ndarray): Input image.
+        options: Tuple of (name, value) pairs that affect the result.
+
+    Returns:
+        Cache key as a byte string.
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+
+    if isinstance(image, np.ndarray):
+        header = "array:{}:{}".format(image.dtype.str, image.shape)
+        digest.update(header.encode("ascii"))
+        digest.update(np.ascontiguousarray(image).data)
+    else:
+        header = "image:{}:{}".format(image.mode, image.size)
+        digest.update(header.encode("ascii"))
+        digest.update(image.tobytes())
+        palette = image.getpalette()
+        if palette is not None:
+            digest.update(b"palette:")
+            digest.update(bytes(palette))
+            transparency = image.info.get("transparency")
+            digest.update(repr(transparency).encode("ascii"))
+
+    digest.update(repr(tuple(options)).encode("utf-8"))
+    return digest.digest()
+
+
+class QRDecodeCache:
+    """Cache of decoding results in front of "decode_qrcode()".
+
+    Example:
+
+        cache = QRDecodeCache(max_bytes=16*1024*1024, path="qrcache.db")
+        data = cache.decode(image)
+        print(cache.get_stats())
+    """
+
+    def __init__(self, max_bytes=16*1024*1024, path=None, negative_ttl=300,
+                 max_disk_entries=100000):
+        """Create a cache.
+
+        Parameters:
+            max_bytes (int): Approximate maximum memory used by
+                the in-memory cache.
+            path (str): Optional file name of an SQLite database used
+                as a persistent cache, shared by all processes that use
+                the same file.
+            negative_ttl (float): Time in seconds during which a failed
+                decode is remembered.
+            max_disk_entries (int): Maximum number of entries in the
+                persistent cache. When the limit is exceeded, the oldest
+                entries are deleted.
+        """
+
+        if max_disk_entries < 1:
+            raise ValueError("Invalid max_disk_entries")
+
+        self.max_bytes = max_bytes
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.max_disk_entries = max_disk_entries
+
+        # In-memory cache: key -> (data, error, created, size)
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        # The database connection is shared between threads,
+        # so all access to it must hold "db_lock".
+        self.db = None
+        self.db_pid = None
+        self.db_lock = threading.Lock()
+        self.stores_since_trim = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stats(self):
+        """Return a dictionary with cache statistics."""
+        with self.lock:
+            return {"hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "negative_hits": self.negative_hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "disk_evictions": self.disk_evictions,
+                    "entries": len(self.entries),
+                    "bytes": self.total_bytes}
+
+    def get_db(self):
+        """Return a connection to the persistent cache, or None.
+
+        The caller must hold "db_lock".
+        """
+
+        if self.path is None:
+            return None
+
+        # Do not share a connection with a parent process.
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.path,
+                                      timeout=30,
+                                      check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS qrdecode_cache ("
+                            " key BLOB PRIMARY KEY,"
+                            " data BLOB,"
+                            " error TEXT,"
+                            " created REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS qrdecode_cache_created"
+                            " ON qrdecode_cache (created)")
+            self.db_pid = os.getpid()
+            self.trim_db(self.db)
+
+        return self.db
+
+    def trim_db(self, db):
+        """Delete expired failures and the oldest entries above
+        "max_disk_entries" from the persistent cache, and commit.
+
+        The caller must hold "db_lock".
+        """
+
+        cursor = db.execute("DELETE FROM qrdecode_cache"
+                            " WHERE data IS NULL AND created < ?",
+                            (time.time() - self.negative_ttl,))
+        deleted = cursor.rowcount
+        cursor = db.execute("DELETE FROM qrdecode_cache WHERE key IN"
+                            " (SELECT key FROM qrdecode_cache"
+                            "  ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                            (self.max_disk_entries,))
+        deleted += cursor.rowcount
+        db.commit()
+        self.stores_since_trim = 0
+
+        with self.lock:
+            self.disk_evictions += deleted
+
+    def is_expired(self, data, created):
+        """Return True if a cached failure has expired."""
+        return data is None and time.time() > created + self.negative_ttl
+
+    def store_memory(self, key, data, error, created):
+        """Store an entry in the in-memory cache and evict old entries."""
+
+        size = CACHE_ENTRY_OVERHEAD + len(data or b"") + len(error or "")
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[3]
+            self.entries[key] = (data, error, created, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self.entries:
+                (old_key, old) = self.entries.popitem(last=False)
+                self.total_bytes -= old[3]
+                self.evictions += 1
+
+    def lookup(self, key):
+        """Find a cached result.
+
+        Returns:
+            Tuple (data, error) or None if the key is not cached.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                (data, error, created, size) = entry
+                if self.is_expired(data, created):
+                    del self.entries[key]
+                    self.total_bytes -= size
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    if data is None:
+                        self.negative_hits += 1
+                    return (data, error)
+
+        row = None
+        with self.db_lock:
+            db = self.get_db()
+            if db is not None:
+                row = db.execute("SELECT data, error, created"
+                                 " FROM qrdecode_cache WHERE key = ?",
+                                 (key,)).fetchone()
+                if row is not None and self.is_expired(row[0], row[2]):
+                    db.execute("DELETE FROM qrdecode_cache"
+                               " WHERE key = ? AND created = ?",
+                               (key, row[2]))
+                    db.commit()
+                    row = None
+                    with self.lock:
+                        self.disk_evictions += 1
+
+        if row is not None:
+            (data, error, created) = row
+            if data is not None:
+                data = bytes(data)
+            self.store_memory(key, data, error, created)
+            with self.lock:
+                self.disk_hits += 1
+                if data is None:
+                    self.negative_hits += 1
+            return (data, error)
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def store(self, key, data, error):
+        """Store a result in the cache.
+
+        Parameters:
+            key (bytes): Cache key.
+            data (bytes): Decoded data, or None if decoding failed.
+            error (str): Error message if decoding failed, or None.
+        """
+
+        created = time.time()
+        self.store_memory(key, data, error, created)
+
+        with self.db_lock:
+            db = self.get_db()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO qrdecode_cache"
+                           " (key, data, error, created) VALUES (?, ?, ?, ?)",
+                           (key, data, error, created))
+                self.stores_since_trim += 1
+                if self.stores_since_trim >= DISK_TRIM_INTERVAL:
+                    self.trim_db(db)
+                else:
+                    db.commit()
+
+    def clear(self):
+        """Discard all cached results, including the persistent cache."""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+        with self.db_lock:
+            db = self.get_db()
+            if db is not None:
+                db.execute("DELETE FROM qrdecode_cache")
+                db.commit()
+
+    def close(self):
+        """Close the persistent cache."""
+        with self.db_lock:
+            if self.db is not None and self.db_pid == os.getpid():
+                self.db.close()
+            self.db = None
+
+    def decode(self, image, **decode_args):
+        """Decode the QR code in the specified image, using cached
+        results when possible.
+
+        Timeouts are not cached, so a decode which ran out of time
+        or was cancelled is tried again on the next call.
+
+        Parameters:
+            image (PIL.Image or ndarray): Input image.
+            decode_args: Keyword arguments for "decode_qrcode()",
+                for example "hints" or "detect_inverted".
+                "return_result" is not supported.
+
+        Returns:
+            Decoded data as a byte string.
+
+        Raises:
+            QRDecodeError: If decoding fails, or failed recently.
+            TypeError: If an argument is not accepted by
+                "decode_qrcode()".
+            ValueError: If "return_result" is set.
+        """
+
+        if decode_args.get("return_result"):
+            raise ValueError("return_result is not supported by the cache")
+        arguments = inspect.signature(qrdecode.decode_qrcode).bind(
+            image, **decode_args)
+        arguments.apply_defaults()
+        key = image_cache_key(image,
+                              tuple((name, arguments.arguments[name])
+                                    for name in RESULT_OPTIONS))
+
+        result = self.lookup(key)
+        if result is not None:
+            (data, error) = result
+            if data is None:
+                raise qrdecode.QRDecodeError(error)
+            return data
+
+        try:
+            data = qrdecode.decode_qrcode(image, **decode_args)
+        except qrdecode.QRDecodeTimeout:
+            raise
+        except qrdecode.QRDecodeError as exc:
+            self.store(key, None, str(exc))
+            raise
+
+        self.store(key, data, None)
+        return data
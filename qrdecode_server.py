@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+
+"""
+Local QR decoding server with a pool of warm worker processes.
+
+The server avoids the cost of starting Python, importing the libraries
+and building decoding tables for every image. It listens on a Unix
+socket or on a local TCP port and speaks HTTP, so it can be used from
+shell pipelines with "curl". Only the standard library is used for
+the server itself.
+
+Requests:
+
+    POST /decode
+        With an image file as body: decode the image.
+        With a JSON body: decode a batch of images,
+            {"images": [{"path": "..."}, {"image": "<base64>"}, ...],
+             "inverted": false, "mirrored": false, "metrics": false}
+        Options can also be given in the query string, for example
+        "/decode?inverted=1&metrics=1".
+
+    GET /metrics
+        Queue depth, counters and latency percentiles.
+
+    GET /health
+        Returns {"status": "ok"}.
+
+Example:
+
+    qrdecode_server.py --socket /tmp/qrdecode.sock &
+    curl -s --unix-socket /tmp/qrdecode.sock \\
+        --data-binary @image.png http://localhost/decode
+
+Paths in requests are opened by the server with its own permissions,
+so the server should only be reachable by trusted local users.
+The Unix socket is only accessible by the owner of the server.
+Path requests are refused if the server listens on a TCP address
+other than loopback.
+
+Usage: qrdecode_server.py [--socket PATH | --host HOST --port PORT]
+                          [--workers N] [--verbose]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import stat
+import signal
+import argparse
+import ipaddress
+import threading
+import collections
+import http.server
+import socketserver
+import urllib.parse
+import multiprocessing
+import numpy as np
+from PIL import Image
+import qrdecode
+
+
+# Number of recent requests used for latency percentiles.
+LATENCY_WINDOW = 1000
+
+# Maximum number of decoders for different image sizes per worker.
+MAX_DECODERS = 8
+
+# Maximum size of a request body in bytes.
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+# Decoders of the worker process, keyed by
+# (image_shape, detect_inverted, detect_mirrored).
+worker_decoders = collections.OrderedDict()
+
+# Workspace holding the precomputed tables of the worker process.
+worker_tables = None
+
+
+def init_worker():
+    """Prepare a worker process for decoding.
+
+    Precomputes the per-version tables and decodes a generated QR code,
+    so that the first request does not pay for the warm-up.
+    """
+    global worker_tables
+    worker_tables = qrdecode.QRWorkspace((1, 1))
+    worker_tables.precompute_tables()
+
+    import qrrender
+    matrix = qrrender.encode_qr_matrix(b"warm-up", 2, "M", 0)
+    img = qrrender.render_qr_image(matrix, scale=3)
+    get_worker_decoder(img.shape, False, False).decode(img)
+
+
+def get_worker_decoder(image_shape, detect_inverted, detect_mirrored):
+    """Return a decoder of the worker process for the image size."""
+    key = (tuple(image_shape), detect_inverted, detect_mirrored)
+    decoder = worker_decoders.get(key)
+    if decoder is None:
+        decoder = qrdecode.QRDecoder(image_shape,
+                                     detect_inverted=detect_inverted,
+                                     detect_mirrored=detect_mirrored)
+        decoder.workspace = qrdecode.QRWorkspace(image_shape,
+                                                 tables_from=worker_tables)
+        worker_decoders[key] = decoder
+        if len(worker_decoders) > MAX_DECODERS:
+            worker_decoders.popitem(last=False)
+    else:
+        worker_decoders.move_to_end(key)
+    return decoder
+
+
+def get_result_metrics(result):
+    """Return the quality metrics of a "QRDecodeResult" as a dictionary."""
+    return {"qr_version": result.qr_version,
+            "error_correction_level": result.error_correction_level,
+            "mask_pattern": result.mask_pattern,
+            "inverted": result.inverted,
+            "triplets_tried": result.triplets_tried,
+            "block_errors": result.block_errors,
+            "max_errors": result.max_errors,
+            "error_margin": result.error_margin,
+            "threshold": result.threshold,
+            "contrast": result.contrast,
+            "threshold_margin": result.threshold_margin,
+            "agreement": result.agreement,
+            "unstable_modules": result.unstable_modules}
+
+
+def decode_item(task):
+    """Decode one image in a worker process.
+
+    Parameters:
+        task: Tuple (item, options). "item" is a dictionary with either
+            "path" (file name) or "image" (image file contents as bytes).
+            "options" is a dictionary with the keys "inverted",
+            "mirrored" and "metrics".
+
+    Returns:
+        Dictionary which can be formatted as JSON.
+    """
+
+    (item, options) = task
+    start_time = time.perf_counter()
+    response = {"source": item.get("path", "upload"),
+                "text": None,
+                "data_base64": None,
+                "error": None}
+
+    try:
+        if "path" in item:
+            img = Image.open(item["path"], "r")
+        else:
+            img = Image.open(io.BytesIO(item["image"]), "r")
+        img_data = np.array(img.convert("L"))
+    except (IOError, ValueError, Image.DecompressionBombError) as exc:
+        response["error"] = "Can not read image: {}".format(exc)
+        response["decode_ms"] = 1000 * (time.perf_counter() - start_time)
+        return response
+
+    (response["height"], response["width"]) = img_data.shape
+    decoder = get_worker_decoder(img_data.shape,
+                                 options["inverted"],
+                                 options["mirrored"])
+    try:
+        if options["metrics"]:
+            result = decoder.decode(img_data, return_result=True)
+            data = result.data
+            response["metrics"] = get_result_metrics(result)
+        else:
+            data = decoder.decode(img_data)
+        response["text"] = data.decode("iso8859-1")
+        response["data_base64"] = base64.b64encode(data).decode("ascii")
+    except qrdecode.QRDecodeError as exc:
+        response["error"] = str(exc)
+    except Exception as exc:
+        response["error"] = "Internal error: {}: {}".format(
+            type(exc).__name__, exc)
+
+    response["decode_ms"] = 1000 * (time.perf_counter() - start_time)
+    return response
+
+
+def get_percentiles(values):
+    """Return a dictionary of percentiles of a list of values."""
+    if not values:
+        return None
+    values = np.array(values)
+    return {"p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(np.max(values))}
+
+
+class QRDecodeService:
+    """Pool of warm worker processes with request statistics.
+
+    Example:
+
+        with QRDecodeService(n_workers=4) as service:
+            results = service.decode_items([{"path": "image.png"}])
+            print(service.get_metrics())
+    """
+
+    def __init__(self, n_workers=None):
+        """Start the worker processes.
+
+        Parameters:
+            n_workers (int): Number of worker processes
+                (default: number of CPUs).
+        """
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if n_workers < 1:
+            raise ValueError("Need at least one worker")
+
+        self.n_workers = n_workers
+        self.pool = multiprocessing.Pool(n_workers, initializer=init_worker)
+        self.start_time = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.num_requests = 0
+        self.num_images = 0
+        self.num_errors = 0
+        self.request_ms = collections.deque(maxlen=LATENCY_WINDOW)
+        self.decode_ms = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def decode_items(self, items, inverted=False, mirrored=False,
+                     metrics=False):
+        """Decode a batch of images in the worker processes.
+
+        Parameters:
+            items (list): Dictionaries with either "path" (file name)
+                or "image" (image file contents as bytes).
+            inverted (bool): Also decode inverted QR codes.
+            mirrored (bool): Also decode mirrored QR codes.
+            metrics (bool): Add quality metrics to each result.
+                See "qrdecode.QRDecodeResult".
+
+        Returns:
+            List of dictionaries with the result for each image.
+        """
+
+        options = {"inverted": bool(inverted),
+                   "mirrored": bool(mirrored),
+                   "metrics": bool(metrics)}
+        start_time = time.perf_counter()
+        with self.lock:
+            self.outstanding += len(items)
+        try:
+            results = self.pool.map(decode_item,
+                                    [(item, options) for item in items],
+                                    chunksize=1)
+        finally:
+            with self.lock:
+                self.outstanding -= len(items)
+        elapsed = 1000 * (time.perf_counter() - start_time)
+
+        with self.lock:
+            self.num_requests += 1
+            self.num_images += len(results)
+            self.num_errors += sum(r["error"] is not None for r in results)
+            self.request_ms.append(elapsed)
+            self.decode_ms.extend(r["decode_ms"] for r in results)
+
+        return results
+
+    def get_metrics(self):
+        """Return a dictionary with the state of the queue,
+        counters and latency percentiles in milliseconds.
+
+        "request_ms" is the time to serve a request, including waiting
+        for a worker. "decode_ms" is the time spent decoding each image
+        in a worker, including reading the image.
+        """
+        with self.lock:
+            return {"workers": self.n_workers,
+                    "outstanding": self.outstanding,
+                    "queue_depth": max(0, self.outstanding - self.n_workers),
+                    "requests": self.num_requests,
+                    "images": self.num_images,
+                    "errors": self.num_errors,
+                    "uptime": time.monotonic() - self.start_time,
+                    "request_ms": get_percentiles(list(self.request_ms)),
+                    "decode_ms": get_percentiles(list(self.decode_ms))}
+
+    def close(self):
+        """Stop the worker processes."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def parse_flag(query, name, default=False):
+    """Return a boolean option from a parsed query string."""
+    values = query.get(name)
+    if not values:
+        return default
+    return values[-1].lower() not in ("0", "false", "no", "")
+
+
+class QRDecodeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler of the decode server.
+
+    The server object must have the attributes "service"
+    (QRDecodeService), "allow_paths" (bool) and "verbose" (bool).
+    """
+
+    server_version = "qrdecode"
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/metrics":
+            self.send_json(200, self.server.service.get_metrics())
+        elif path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/decode":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_REQUEST_BYTES:
+            self.send_json(400, {"error": "Invalid request size"})
+            return
+        body = self.rfile.read(length)
+
+        query = urllib.parse.parse_qs(url.query)
+        options = {"inverted": parse_flag(query, "inverted"),
+                   "mirrored": parse_flag(query, "mirrored"),
+                   "metrics": parse_flag(query, "metrics")}
+
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            try:
+                request = json.loads(body)
+                items = []
+                for entry in request["images"]:
+                    if "path" in entry:
+                        if not self.server.allow_paths:
+                            self.send_json(403, {
+                                "error": "Path requests are disabled"})
+                            return
+                        items.append({"path": str(entry["path"])})
+                    else:
+                        items.append({"image": base64.b64decode(
+                            entry["image"], validate=True)})
+                for name in options:
+                    if name in request:
+                        if not isinstance(request[name], bool):
+                            raise TypeError("{} must be true or false"
+                                            .format(name))
+                        options[name] = request[name]
+            except (ValueError, KeyError, TypeError) as exc:
+                self.send_json(400, {"error": "Invalid request: {}"
+                                     .format(exc)})
+                return
+            results = self.server.service.decode_items(items, **options)
+            self.send_json(200, {"results": results})
+        else:
+            (result,) = self.server.service.decode_items([{"image": body}],
+                                                         **options)
+            self.send_json(200, result)
+
+
+class QRDecodeHTTPServer(http.server.ThreadingHTTPServer):
+    """HTTP decode server on a TCP port."""
+    daemon_threads = True
+
+
+class QRDecodeUnixServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+    """HTTP decode server on a Unix socket."""
+    daemon_threads = True
+
+
+def remove_socket(socket_path):
+    """Remove a Unix socket left behind by a previous server.
+
+    Parameters:
+        socket_path (str): Path of the socket.
+
+    Raises:
+        FileExistsError: If the path exists and is not a socket.
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError("Not a socket: {}".format(socket_path))
+    os.unlink(socket_path)
+
+
+def make_server(service, socket_path=None, host="127.0.0.1", port=8765,
+                verbose=False, allow_paths=None):
+    """Create an HTTP server for a decode service.
+
+    The Unix socket is created with access only for the owner.
+
+    Parameters:
+        service (QRDecodeService): Pool of decoding workers.
+        socket_path (str): Path of a Unix socket to listen on.
+            If not specified, the server listens on a TCP port.
+        host (str): Host address for TCP.
+        port (int): Port number for TCP, or 0 to pick a free port.
+        verbose (bool): Log each request on stderr.
+        allow_paths (bool): Accept requests to decode files by path.
+            By default, paths are only accepted on a Unix socket
+            or a loopback address.
+
+    Returns:
+        Server object. Call "serve_forever()" to handle requests.
+
+    Raises:
+        OSError: If the server can not listen, or if "socket_path"
+            exists and is not a socket.
+    """
+    if socket_path is not None:
+        remove_socket(socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            server = QRDecodeUnixServer(socket_path, QRDecodeRequestHandler)
+        finally:
+            os.umask(old_umask)
+        local = True
+    else:
+        server = QRDecodeHTTPServer((host, port), QRDecodeRequestHandler)
+        local = ipaddress.ip_address(server.server_address[0]).is_loopback
+    if allow_paths is None:
+        allow_paths = local
+    server.allow_paths = allow_paths
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve QR decoding requests from a pool of workers.")
+    parser.add_argument("--socket", type=str,
+                        help="Listen on a Unix socket with this path.")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Host address to listen on (default 127.0.0.1)."
+                             " Path requests are refused on addresses"
+                             " other than loopback.")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="TCP port to listen on (default 8765).")
+    parser.add_argument("--workers", type=int,
+                        help="Number of worker processes"
+                             " (default: number of CPUs).")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Log each request on stderr.")
+    args = parser.parse_args()
+
+    if args.workers is not None and args.workers < 1:
+        print("ERROR: Invalid value for --workers", file=sys.stderr)
+        return 1
+
+    with QRDecodeService(args.workers) as service:
+        try:
+            server = make_server(service, args.socket, args.host, args.port,
+                                 args.verbose)
+        except OSError as exc:
+            print("ERROR: Can not listen -", exc, file=sys.stderr)
+            return 1
+
+        # Stop cleanly on SIGTERM as well as on Ctrl-C.
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: threading.Thread(
+                          target=server.shutdown).start())
+
+        if args.socket:
+            print("Listening on", args.socket, file=sys.stderr)
+        else:
+            print("Listening on http://{}:{}/".format(
+                *server.server_address[:2]), file=sys.stderr)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket:
+                try:
+                    remove_socket(args.socket)
+                except OSError:
+                    pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
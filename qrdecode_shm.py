@@ -0,0 +1,362 @@
+"""
+Decoding QR codes from a stream of video frames with multiple processes.
+
+Frames are stored in a ring buffer of slots in shared memory.
+Worker processes decode the frames directly from their shared slots,
+so only slot indices and small result records are passed between
+processes.
+"""
+
+import os
+import time
+import queue
+import threading
+import collections
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy as np
+import qrdecode
+
+
+# Interval in seconds at which "get_result()" checks that the worker
+# processes are still running while it waits for a result.
+WORKER_CHECK_INTERVAL = 0.5
+
+# Time in seconds that "close()" waits for the worker processes
+# to finish their current frame before terminating them.
+WORKER_STOP_TIMEOUT = 5.0
+
+
+def frame_worker_main(shm_name,
+                      frame_shape,
+                      frame_dtype,
+                      task_queue,
+                      result_queue,
+                      debug_level):
+    """Main function of a worker process.
+
+    Parameters:
+        shm_name (str): Name of the shared memory block.
+        frame_shape (tuple): Shape of each frame.
+        frame_dtype (str): Numpy data type of the frame pixels.
+        task_queue: Queue of (frame_index, slot) tuples to decode,
+            terminated by None.
+        result_queue: Queue for (frame_index, data, error) tuples.
+        debug_level (int): Debug level for "decode_qrcode()".
+    """
+
+    shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+    frame_dtype = np.dtype(frame_dtype)
+    frame_nbytes = int(np.prod(frame_shape)) * frame_dtype.itemsize
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            (frame_index, slot) = task
+            frame = np.ndarray(frame_shape,
+                               dtype=frame_dtype,
+                               buffer=shm.buf,
+                               offset=slot*frame_nbytes)
+            try:
+                data = qrdecode.decode_qrcode(frame, debug_level=debug_level)
+                result = (frame_index, data, None)
+            except qrdecode.QRDecodeError as exc:
+                result = (frame_index, None, str(exc))
+            except Exception as exc:
+                result = (frame_index, None,
+                          "Internal error: {}: {}"
+                          .format(type(exc).__name__, exc))
+
+            # Release the view before the shared memory is closed.
+            del frame
+
+            result_queue.put(result)
+    finally:
+        shm.close()
+
+
+class SharedFrameDecoder:
+    """Decode QR codes from video frames in a pool of worker processes.
+
+    Frames are copied into a ring buffer in shared memory. The number of
+    slots in the ring buffer limits the number of frames in flight.
+    A slot is released when its result has been returned to the caller,
+    so a slow consumer blocks the producer.
+
+    Results are returned in the same order as the frames were submitted.
+    Each result is a tuple (frame_index, data, error) where "data" is
+    the decoded byte string, or None if decoding failed, and "error" is
+    the error message if decoding failed, or None.
+
+    Example:
+
+        with SharedFrameDecoder((480, 640), n_slots=16) as decoder:
+            for (frame_index, data, error) in decoder.decode_frames(frames):
+                ...
+    """
+
+    def __init__(self,
+                 frame_shape,
+                 frame_dtype=np.uint8,
+                 n_slots=8,
+                 n_workers=None,
+                 debug_level=0):
+        """Create the shared ring buffer and start the worker processes.
+
+        Parameters:
+            frame_shape (tuple): Shape of each frame, either (height, width)
+                for greyscale frames or (height, width, 3) for RGB frames.
+            frame_dtype: Numpy data type of the frame pixels.
+            n_slots (int): Number of slots in the ring buffer.
+            n_workers (int): Number of worker processes
+                (default: number of CPUs).
+            debug_level (int): Debug level for "decode_qrcode()".
+        """
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+
+        if n_slots < 1 or n_workers < 1:
+            raise ValueError("Need at least one slot and one worker")
+
+        self.frame_shape = tuple(frame_shape)
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.frame_nbytes = (int(np.prod(self.frame_shape))
+                             * self.frame_dtype.itemsize)
+        self.n_slots = n_slots
+        self.n_workers = n_workers
+
+        self.shm = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=n_slots*self.frame_nbytes)
+
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+
+        # Slot bookkeeping, only used in the parent process.
+        self.cond = threading.Condition()
+        self.free_slots = collections.deque(range(n_slots))
+        self.slot_of_frame = {}
+        self.done_results = {}
+        self.next_submit_index = 0
+        self.next_result_index = 0
+
+        self.workers = []
+        for i in range(n_workers):
+            proc = multiprocessing.Process(
+                target=frame_worker_main,
+                args=(self.shm.name,
+                      self.frame_shape,
+                      self.frame_dtype.str,
+                      self.task_queue,
+                      self.result_queue,
+                      debug_level),
+                daemon=True)
+            proc.start()
+            self.workers.append(proc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_slot_view(self, slot):
+        """Return a Numpy array which refers to the specified slot."""
+        return np.ndarray(self.frame_shape,
+                          dtype=self.frame_dtype,
+                          buffer=self.shm.buf,
+                          offset=slot*self.frame_nbytes)
+
+    def num_pending(self):
+        """Return the number of submitted frames whose result
+        has not yet been returned."""
+        return self.next_submit_index - self.next_result_index
+
+    def has_free_slot(self):
+        """Return True if a frame can be submitted without blocking."""
+        with self.cond:
+            return len(self.free_slots) > 0
+
+    def acquire_slot(self, timeout=None):
+        """Reserve a free slot in the ring buffer.
+
+        The caller may write a frame directly into the slot
+        and then call "submit_slot()".
+
+        This blocks until a slot is released by "get_result()"
+        in another thread.
+
+        Parameters:
+            timeout (float): Maximum time to wait, or None.
+
+        Returns:
+            Tuple (slot, view) where "view" is a Numpy array
+            referring to the shared slot.
+
+        Raises:
+            TimeoutError: If no slot becomes available in time.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.free_slots, timeout):
+                raise TimeoutError("No free slot in frame buffer")
+            slot = self.free_slots.popleft()
+        return (slot, self.get_slot_view(slot))
+
+    def submit_slot(self, slot):
+        """Submit a frame which was written into a reserved slot.
+
+        Parameters:
+            slot (int): Slot returned by "acquire_slot()".
+
+        Returns:
+            Frame index of the submitted frame.
+        """
+        with self.cond:
+            frame_index = self.next_submit_index
+            self.next_submit_index += 1
+            self.slot_of_frame[frame_index] = slot
+        self.task_queue.put((frame_index, slot))
+        return frame_index
+
+    def submit(self, frame, timeout=None):
+        """Copy a frame into the ring buffer and submit it for decoding.
+
+        This blocks while all slots are in use.
+
+        Parameters:
+            frame (ndarray): Frame with the configured shape.
+            timeout (float): Maximum time to wait for a slot, or None.
+
+        Returns:
+            Frame index of the submitted frame.
+        """
+        frame = np.asarray(frame)
+        if frame.shape != self.frame_shape:
+            raise ValueError("Expecting frame shape {}, got {}"
+                             .format(self.frame_shape, frame.shape))
+        (slot, view) = self.acquire_slot(timeout)
+        view[...] = frame
+        del view
+        return self.submit_slot(slot)
+
+    def check_workers(self):
+        """Raise RuntimeError if a worker process has exited."""
+        for proc in self.workers:
+            if not proc.is_alive():
+                raise RuntimeError("Worker process {} exited with code {}"
+                                   .format(proc.pid, proc.exitcode))
+
+    def get_result(self, timeout=None):
+        """Return the result of the oldest pending frame and release
+        its slot.
+
+        Parameters:
+            timeout (float): Maximum time to wait, or None.
+
+        Returns:
+            Tuple (frame_index, data, error).
+
+        Raises:
+            ValueError: If there are no pending frames.
+            queue.Empty: If the result is not available in time.
+            RuntimeError: If a worker process has exited, so that
+                the result may never become available.
+        """
+        if self.num_pending() == 0:
+            raise ValueError("No pending frames")
+
+        if timeout is not None:
+            end_time = time.monotonic() + timeout
+
+        frame_index = self.next_result_index
+        while frame_index not in self.done_results:
+            wait_time = WORKER_CHECK_INTERVAL
+            if timeout is not None:
+                wait_time = min(wait_time, end_time - time.monotonic())
+            try:
+                result = self.result_queue.get(timeout=max(wait_time, 0))
+            except queue.Empty:
+                self.check_workers()
+                if timeout is not None and time.monotonic() >= end_time:
+                    raise
+                continue
+            self.done_results[result[0]] = result
+
+        result = self.done_results.pop(frame_index)
+        with self.cond:
+            self.next_result_index += 1
+            slot = self.slot_of_frame.pop(frame_index)
+            self.free_slots.append(slot)
+            self.cond.notify()
+
+        return result
+
+    def decode_frames(self, frames):
+        """Decode a sequence of frames.
+
+        New frames are taken from the input only when a slot is free,
+        so the rate of processing follows the rate at which the caller
+        consumes results.
+
+        Parameters:
+            frames: Iterable of Numpy arrays with the configured shape.
+
+        Yields:
+            Tuple (frame_index, data, error) for each frame, in order.
+        """
+        frame_iter = iter(frames)
+        exhausted = False
+        while True:
+            while (not exhausted) and self.has_free_slot():
+                try:
+                    frame = next(frame_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.submit(frame)
+            if self.num_pending() == 0:
+                break
+            yield self.get_result()
+
+    def close(self, timeout=WORKER_STOP_TIMEOUT):
+        """Stop the worker processes and release the shared memory.
+
+        Parameters:
+            timeout (float): Time in seconds to wait for the workers
+                to exit. Workers which are still running after this
+                time, for example in a very slow decode, are terminated.
+        """
+        if self.shm is None:
+            return
+        for proc in self.workers:
+            self.task_queue.put(None)
+        # Keep draining results that were never collected. A worker can not
+        # exit while its results are still stuck in the queue.
+        deadline = time.monotonic() + timeout
+        for proc in self.workers:
+            while proc.is_alive() and time.monotonic() < deadline:
+                try:
+                    while True:
+                        self.result_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                proc.join(timeout=0.1)
+        for proc in self.workers:
+            if proc.is_alive():
+                proc.terminate()
+                proc.join(timeout=1)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+        self.workers = []
+        # The task queue may still hold stop requests which no worker
+        # will read. Do not wait for them to be flushed at exit.
+        self.task_queue.cancel_join_thread()
+        self.task_queue.close()
+        self.result_queue.close()
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
@@ -0,0 +1,540 @@
+"""
+Fast generation of QR code symbols.
+
+Encodes byte strings as QR code matrices and renders them as images.
+All steps are vectorized with Numpy, and tables that depend only on
+the QR version and error correction level are computed once.
+Many symbols of the same version can be encoded in a single call,
+which is useful to generate large test corpora.
+
+Only byte mode encoding is supported.
+"""
+
+import functools
+import numpy as np
+import qrdecode
+
+
+# Index of each error correction level in the format information.
+ERROR_CORRECTION_BITS = {"L": 1, "M": 0, "Q": 3, "H": 2}
+
+# Exp/log tables of GF(2**8) as arrays.
+# The exp table is repeated so that the sum of two logarithms can be
+# used as an index without reduction modulo 255.
+GF_EXP = np.array(2 * qrdecode.reed_solomon_gf_exp[:255], dtype=np.uint8)
+GF_LOG = np.array(qrdecode.reed_solomon_gf_log, dtype=np.intp)
+
+
+def get_data_capacity(qr_version, error_correction_level):
+    """Return the maximum number of data bytes in byte mode.
+
+    Parameters:
+        qr_version (int): QR code version.
+        error_correction_level (str): Error correction level (L, M, Q or H).
+    """
+    (n_codewords, n_check_words, n_blocks, max_errors
+        ) = qrdecode.get_block_structure(qr_version, error_correction_level)
+    header_words = 2 if qr_version < 10 else 3
+    return n_codewords - n_check_words - header_words
+
+
+def choose_version(nbytes, error_correction_level):
+    """Return the smallest QR version which can hold "nbytes" bytes.
+
+    Raises:
+        ValueError: If the data does not fit in any QR code.
+    """
+    for qr_version in range(1, 41):
+        if get_data_capacity(qr_version, error_correction_level) >= nbytes:
+            return qr_version
+    raise ValueError("Too much data for a QR code")
+
+
+def encode_format_bits(error_correction_level, mask_pattern):
+    """Return the 15-bit format information word, including
+    BCH error correction bits and the format mask."""
+
+    data = (ERROR_CORRECTION_BITS[error_correction_level] << 3) | mask_pattern
+    v = data << 10
+    for k in range(14, 9, -1):
+        if (v >> k) & 1:
+            v ^= 0b10100110111 << (k - 10)
+    return ((data << 10) | v) ^ 0b101010000010010
+
+
+def encode_version_bits(qr_version):
+    """Return the 18-bit version information word, including
+    BCH error correction bits."""
+
+    v = qr_version << 12
+    for k in range(17, 11, -1):
+        if (v >> k) & 1:
+            v ^= 0b1111100100101 << (k - 12)
+    return (qr_version << 12) | v
+
+
+@functools.lru_cache(maxsize=None)
+def get_symbol_template(qr_version):
+    """Return the QR matrix containing only the function patterns and
+    version information, with 1 for dark modules.
+
+    The format information modules are left light.
+    The returned array must not be modified.
+    """
+
+    qrsize = 17 + 4 * qr_version
+    matrix = np.zeros((qrsize, qrsize), dtype=np.uint8)
+
+    # Position detection patterns.
+    finder = np.ones((7, 7), dtype=np.uint8)
+    finder[1:6, 1:6] = 0
+    finder[2:5, 2:5] = 1
+    matrix[:7, :7] = finder
+    matrix[:7, -7:] = finder
+    matrix[-7:, :7] = finder
+
+    # Timing patterns.
+    matrix[6, 8:-8:2] = 1
+    matrix[8:-8:2, 6] = 1
+
+    # Alignment patterns.
+    align = np.ones((5, 5), dtype=np.uint8)
+    align[1:4, 1:4] = 0
+    align[2, 2] = 1
+    for (x, y) in qrdecode.get_alignment_pattern_locations(qr_version):
+        matrix[y-2:y+3, x-2:x+3] = align
+
+    # Dark module next to the lower-left format information.
+    matrix[qrsize-8, 8] = 1
+
+    # Version information, least-significant bit first.
+    if qr_version >= 7:
+        version_bits = encode_version_bits(qr_version)
+        for i in range(18):
+            bit = (version_bits >> i) & 1
+            matrix[i // 3, qrsize - 11 + i % 3] = bit
+            matrix[qrsize - 11 + i % 3, i // 3] = bit
+
+    matrix.flags.writeable = False
+    return matrix
+
+
+@functools.lru_cache(maxsize=None)
+def get_format_index(qr_version):
+    """Return the flat matrix indices of both copies of the format
+    information, as an array of shape (2, 15) starting with the
+    least-significant bit."""
+
+    qrsize = 17 + 4 * qr_version
+
+    # Next to the upper-left position detection pattern.
+    locs = qrdecode.get_format_locations()
+    first = locs[:, 1] * qrsize + locs[:, 0]
+
+    # Split between the lower-left and upper-right patterns.
+    second = []
+    for i in range(15):
+        if i < 8:
+            (x, y) = (qrsize - 1 - i, 8)
+        else:
+            (x, y) = (8, qrsize - 15 + i)
+        second.append(y * qrsize + x)
+
+    index = np.array([first, second], dtype=np.intp)
+    index.flags.writeable = False
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def get_data_index(qr_version):
+    """Return the flat matrix indices of the codeword modules
+    in order of bit placement."""
+    qrsize = 17 + 4 * qr_version
+    locs = qrdecode.get_data_locations(qr_version)
+    index = locs[:, 1] * qrsize + locs[:, 0]
+    index.flags.writeable = False
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def get_data_mask(qr_version, mask_pattern):
+    """Return the mask bits of the codeword modules
+    in order of bit placement."""
+    qrsize = 17 + 4 * qr_version
+    mask = qrdecode.make_mask_pattern(qrsize, mask_pattern)
+    bits = np.take(mask, get_data_index(qr_version))
+    bits.flags.writeable = False
+    return bits
+
+
+@functools.lru_cache(maxsize=None)
+def get_parity_table(n_data_words, n_check_words):
+    """Return the Reed-Solomon encoding of each data word position.
+
+    Reed-Solomon encoding is linear, so the check words of a block are
+    the XOR of the rows of this table, each multiplied by the
+    corresponding data word.
+
+    Returns:
+        Array of shape (n_data_words, n_check_words) containing
+        the logarithm of each table entry, or -1 for zero entries.
+    """
+
+    # Generator polynomial, highest-order coefficient first:
+    #   g(x) = (x - a**0) * (x - a**1) * ... * (x - a**(n-1))
+    gen = [1]
+    for k in range(n_check_words):
+        root = qrdecode.reed_solomon_gf_exp[k]
+        gen = ([gen[0]]
+               + [gen[i] ^ qrdecode.rs_mul(gen[i-1], root)
+                  for i in range(1, len(gen))]
+               + [qrdecode.rs_mul(gen[-1], root)])
+
+    # Row i is the remainder of x**(n_check_words + n_data_words - 1 - i)
+    # divided by g(x). Start from the last row, x**n_check_words.
+    table = np.zeros((n_data_words, n_check_words), dtype=np.intp)
+    rem = gen[1:]
+    for i in range(n_data_words - 1, -1, -1):
+        table[i] = rem
+        carry = rem[0]
+        rem = rem[1:] + [0]
+        rem = [r ^ qrdecode.rs_mul(carry, g) for (r, g) in zip(rem, gen[1:])]
+
+    log_table = np.where(table == 0, -1, GF_LOG[table])
+    log_table.flags.writeable = False
+    return log_table
+
+
+@functools.lru_cache(maxsize=None)
+def get_interleave_index(qr_version, error_correction_level):
+    """Return the order of codewords in the symbol.
+
+    Data words are arranged as an array of shape (n_blocks, L) where
+    L is the length of the longest block, and short blocks start with
+    an extra zero word. Check words follow as an array of shape
+    (n_blocks, n_check_words_per_block).
+
+    Returns:
+        Array with, for each codeword in placement order, its index
+        in the concatenation of the flattened data and check arrays.
+    """
+
+    (n_codewords, n_check_words, n_blocks, max_errors
+        ) = qrdecode.get_block_structure(qr_version, error_correction_level)
+    n_data_words = n_codewords - n_check_words
+    n_short = n_blocks - n_data_words % n_blocks
+    block_len = -(-n_data_words // n_blocks)
+    n_check_per_block = n_check_words // n_blocks
+
+    index = []
+    for j in range(block_len):
+        for i in range(n_blocks):
+            if i < n_short and n_data_words % n_blocks != 0:
+                # Short block, skip the extra leading zero word.
+                if j < block_len - 1:
+                    index.append(i * block_len + j + 1)
+            else:
+                index.append(i * block_len + j)
+    offset = n_blocks * block_len
+    for j in range(n_check_per_block):
+        for i in range(n_blocks):
+            index.append(offset + i * n_check_per_block + j)
+
+    assert len(index) == n_codewords
+    index = np.array(index, dtype=np.intp)
+    index.flags.writeable = False
+    return index
+
+
+def make_data_codewords(payloads, qr_version, error_correction_level):
+    """Encode byte strings as data codewords in byte mode.
+
+    Parameters:
+        payloads: List of byte strings.
+        qr_version (int): QR code version.
+        error_correction_level (str): Error correction level.
+
+    Returns:
+        Array of shape (len(payloads), n_data_words).
+
+    Raises:
+        ValueError: If a byte string does not fit in the QR code.
+    """
+
+    (n_codewords, n_check_words, n_blocks, max_errors
+        ) = qrdecode.get_block_structure(qr_version, error_correction_level)
+    n_data_words = n_codewords - n_check_words
+    capacity = get_data_capacity(qr_version, error_correction_level)
+
+    # Pad codewords after the data alternate between 0xEC and 0x11.
+    padding = np.resize(np.array([0xec, 0x11], dtype=np.uint8), n_data_words)
+    codewords = np.empty((len(payloads), n_data_words), dtype=np.uint8)
+
+    # The stream consists of 4-bit mode indicator 0100, the length
+    # (8 bits for version 1 to 9, 16 bits otherwise), the data bytes
+    # and a 4-bit terminator. Since the header is an odd number of
+    # nibbles, the stream is built from nibbles.
+    for (k, payload) in enumerate(payloads):
+        nbytes = len(payload)
+        if nbytes > capacity:
+            raise ValueError("Too much data for QR version {}-{}"
+                             .format(qr_version, error_correction_level))
+        if qr_version < 10:
+            header = [4, nbytes >> 4, nbytes & 15]
+        else:
+            header = [4, nbytes >> 12, (nbytes >> 8) & 15,
+                      (nbytes >> 4) & 15, nbytes & 15]
+        data = np.frombuffer(payload, dtype=np.uint8)
+        nibbles = np.empty(len(header) + 2 * nbytes + 1, dtype=np.uint8)
+        nibbles[:len(header)] = header
+        nibbles[len(header):-1:2] = data >> 4
+        nibbles[len(header)+1:-1:2] = data & 15
+        nibbles[-1] = 0
+        nstream = len(nibbles) // 2
+        codewords[k, :nstream] = (nibbles[0::2] << 4) | nibbles[1::2]
+        codewords[k, nstream:] = padding[:n_data_words-nstream]
+
+    return codewords
+
+
+def make_codewords(data_words, qr_version, error_correction_level):
+    """Add Reed-Solomon check words and interleave the blocks.
+
+    Parameters:
+        data_words (ndarray): Array of shape (n, n_data_words).
+        qr_version (int): QR code version.
+        error_correction_level (str): Error correction level.
+
+    Returns:
+        Array of shape (n, n_codewords) in placement order.
+    """
+
+    (n_codewords, n_check_words, n_blocks, max_errors
+        ) = qrdecode.get_block_structure(qr_version, error_correction_level)
+    n_data_words = n_codewords - n_check_words
+    n_short = n_blocks - n_data_words % n_blocks
+    block_len = -(-n_data_words // n_blocks)
+    n_check_per_block = n_check_words // n_blocks
+    nsym = data_words.shape[0]
+
+    # Split into blocks of equal length by prepending a zero word
+    # to each short block. A leading zero does not change
+    # the Reed-Solomon check words.
+    if n_data_words % n_blocks == 0:
+        blocks = data_words.reshape((nsym, n_blocks, block_len))
+    else:
+        blocks = np.zeros((nsym, n_blocks, block_len), dtype=np.uint8)
+        short_len = block_len - 1
+        blocks[:, :n_short, 1:] = data_words[:, :n_short*short_len].reshape(
+            (nsym, n_short, short_len))
+        blocks[:, n_short:, :] = data_words[:, n_short*short_len:].reshape(
+            (nsym, n_blocks - n_short, block_len))
+
+    # Multiply each data word with its row of the parity table
+    # and add (XOR) the rows.
+    log_table = get_parity_table(block_len, n_check_per_block)
+    log_data = GF_LOG[blocks]
+    products = GF_EXP[log_data[..., None] + log_table]
+    products[(blocks == 0)[..., None] | (log_table < 0)] = 0
+    check_words = np.bitwise_xor.reduce(products, axis=2)
+
+    flat = np.concatenate((blocks.reshape((nsym, -1)),
+                           check_words.reshape((nsym, -1))), axis=1)
+    return flat[:, get_interleave_index(qr_version, error_correction_level)]
+
+
+def place_codewords(codewords, qr_version, error_correction_level,
+                    mask_pattern):
+    """Build QR matrices from codewords.
+
+    Parameters:
+        codewords (ndarray): Array of shape (n, n_codewords).
+        qr_version (int): QR code version.
+        error_correction_level (str): Error correction level.
+        mask_pattern (int): Mask pattern (0 .. 7).
+
+    Returns:
+        Array of shape (n, qrsize, qrsize) with 1 for dark modules.
+    """
+
+    qrsize = 17 + 4 * qr_version
+    nsym = codewords.shape[0]
+
+    matrices = np.empty((nsym, qrsize * qrsize), dtype=np.uint8)
+    matrices[:] = get_symbol_template(qr_version).reshape(-1)
+
+    # Format information.
+    format_word = encode_format_bits(error_correction_level, mask_pattern)
+    format_bits = (format_word >> np.arange(15)) & 1
+    matrices[:, get_format_index(qr_version)] = format_bits
+
+    # Codeword bits, most significant bit first, followed by zero
+    # remainder bits, then masked.
+    data_index = get_data_index(qr_version)
+    bits = np.zeros((nsym, len(data_index)), dtype=np.uint8)
+    nbits = 8 * codewords.shape[1]
+    bits[:, :nbits] = np.unpackbits(codewords, axis=1)
+    bits ^= get_data_mask(qr_version, mask_pattern)
+    matrices[:, data_index] = bits
+
+    return matrices.reshape((nsym, qrsize, qrsize))
+
+
+def get_mask_penalty(matrices):
+    """Return the penalty score of QR matrices, used to select
+    the mask pattern.
+
+    Parameters:
+        matrices (ndarray): Array of shape (..., qrsize, qrsize).
+
+    Returns:
+        Array of penalty scores.
+    """
+
+    penalty = 0
+    finder_like = [np.array([1, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0]),
+                   np.array([0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 1])]
+
+    for m in (matrices, np.swapaxes(matrices, -1, -2)):
+        # Runs of 5 or more modules of the same color score N - 2.
+        eq = (m[..., 1:] == m[..., :-1])
+        run5 = eq[..., :-3] & eq[..., 1:-2] & eq[..., 2:-1] & eq[..., 3:]
+        starts = run5.copy()
+        starts[..., 1:] &= ~run5[..., :-1]
+        penalty = (penalty + np.count_nonzero(run5, axis=(-2, -1))
+                   + 2 * np.count_nonzero(starts, axis=(-2, -1)))
+
+        # Patterns resembling a position detection pattern score 40.
+        n = m.shape[-1] - 10
+        for pattern in finder_like:
+            match = np.ones(m.shape[:-1] + (n,), dtype=bool)
+            for k in range(11):
+                match &= (m[..., k:k+n] == pattern[k])
+            penalty = penalty + 40 * np.count_nonzero(match, axis=(-2, -1))
+
+    # Blocks of 2 x 2 modules of the same color score 3.
+    same = ((matrices[..., 1:, 1:] == matrices[..., :-1, :-1])
+            & (matrices[..., 1:, :-1] == matrices[..., :-1, :-1])
+            & (matrices[..., :-1, 1:] == matrices[..., :-1, :-1]))
+    penalty = penalty + 3 * np.count_nonzero(same, axis=(-2, -1))
+
+    # Deviation of the proportion of dark modules from 50%.
+    qrsize = matrices.shape[-1]
+    dark = np.count_nonzero(matrices, axis=(-2, -1))
+    percent = 100 * dark // (qrsize * qrsize)
+    penalty = penalty + 10 * (np.abs(percent - 50) // 5)
+
+    return penalty
+
+
+def encode_qr_matrices(payloads, qr_version, error_correction_level="M",
+                       mask_pattern=None):
+    """Encode many byte strings as QR matrices of the same version.
+
+    Parameters:
+        payloads: List of byte strings.
+        qr_version (int): QR code version (1 .. 40).
+        error_correction_level (str): Error correction level (L, M, Q or H).
+        mask_pattern (int): Mask pattern (0 .. 7), or None to select
+            the mask pattern with the lowest penalty for each symbol.
+
+    Returns:
+        Array of shape (len(payloads), qrsize, qrsize) with 1 for
+        dark modules, without quiet zone.
+
+    Raises:
+        ValueError: If the parameters are invalid or the data does not
+            fit in the QR code.
+    """
+
+    if not (1 <= qr_version <= 40):
+        raise ValueError("Invalid QR code version")
+    if error_correction_level not in ERROR_CORRECTION_BITS:
+        raise ValueError("Invalid error correction level")
+    if mask_pattern is not None and not (0 <= mask_pattern <= 7):
+        raise ValueError("Invalid mask pattern")
+
+    data_words = make_data_codewords(payloads, qr_version,
+                                     error_correction_level)
+    codewords = make_codewords(data_words, qr_version,
+                               error_correction_level)
+
+    if mask_pattern is not None:
+        return place_codewords(codewords, qr_version,
+                               error_correction_level, mask_pattern)
+
+    # Try all mask patterns and keep the best one for each symbol.
+    candidates = np.stack([place_codewords(codewords, qr_version,
+                                           error_correction_level, mask)
+                           for mask in range(8)], axis=1)
+    best = np.argmin(get_mask_penalty(candidates), axis=1)
+    return candidates[np.arange(len(payloads)), best]
+
+
+def encode_qr_matrix(data, qr_version=None, error_correction_level="M",
+                     mask_pattern=None):
+    """Encode a byte string as a QR matrix.
+
+    Parameters:
+        data (bytes): Data to encode.
+        qr_version (int): QR code version (1 .. 40), or None to select
+            the smallest version that fits the data.
+        error_correction_level (str): Error correction level (L, M, Q or H).
+        mask_pattern (int): Mask pattern (0 .. 7), or None to select
+            the mask pattern with the lowest penalty.
+
+    Returns:
+        2D array with 1 for dark modules, without quiet zone.
+
+    Raises:
+        ValueError: If the parameters are invalid or the data does not
+            fit in the QR code.
+    """
+
+    if error_correction_level not in ERROR_CORRECTION_BITS:
+        raise ValueError("Invalid error correction level")
+    if qr_version is None:
+        qr_version = choose_version(len(data), error_correction_level)
+
+    (matrix,) = encode_qr_matrices([bytes(data)], qr_version,
+                                   error_correction_level, mask_pattern)
+    return matrix
+
+
+def render_qr_image(matrix, scale=1, border=4):
+    """Render QR matrices as greyscale images.
+
+    Parameters:
+        matrix (ndarray): QR matrix with 1 for dark modules,
+            or an array of shape (n, qrsize, qrsize).
+        scale: Pixels per module, either a number or a tuple (sx, sy).
+            Non-integer scale factors are rendered by nearest-neighbor
+            sampling.
+        border (int): Width of the quiet zone in modules.
+
+    Returns:
+        Array of type uint8 with 0 for dark and 255 for light pixels.
+    """
+
+    if isinstance(scale, (tuple, list)):
+        (sx, sy) = scale
+    else:
+        sx = sy = scale
+
+    qrsize = matrix.shape[-1]
+    size = qrsize + 2 * border
+
+    # Module coordinate of each pixel, outside the symbol for the border.
+    xs = (np.arange(int(size * sx)) / sx).astype(np.intp) - border
+    ys = (np.arange(int(size * sy)) / sy).astype(np.intp) - border
+    xs[(xs < 0) | (xs >= qrsize)] = qrsize
+    ys[(ys < 0) | (ys >= qrsize)] = qrsize
+
+    # Convert to pixel values, with an extra light row and column
+    # for the border.
+    lut = np.array([255, 0], dtype=np.uint8)
+    pixels = np.full(matrix.shape[:-2] + (qrsize + 1, qrsize + 1), 255,
+                     dtype=np.uint8)
+    pixels[..., :qrsize, :qrsize] = lut[matrix]
+
+    return pixels[..., ys[:, None], xs[None, :]]
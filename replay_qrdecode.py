@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+"""
+Replay a corpus of images through the QR decoder.
+
+Decodes all image files in a directory tree with a pool of worker
+processes and records for each image the decode latency, the stage
+where most of the time was spent, and the error message for failures.
+
+Prints latency histograms and a breakdown of failure reasons.
+Results can be saved as JSON and compared with an earlier run,
+for example before and after upgrading the decoder, to list images
+which started or stopped decoding, changed their decoded data or
+became slower.
+
+Usage: replay_qrdecode.py [--workers N] [--inverted] [--mirrored]
+                          [--output FILE] [--compare FILE] directory
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import platform
+import collections
+import multiprocessing
+import numpy as np
+from PIL import Image
+import qrdecode
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif",
+                    ".tif", ".tiff", ".webp", ".pgm", ".ppm")
+
+# Upper bounds of the latency histogram bins in milliseconds.
+HISTOGRAM_BINS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Stages which contain other stages, and the stages they contain.
+NESTED_STAGES = {"decode": None,
+                 "decode_triplet": None,
+                 "find_patterns": ("scan_rows", "scan_columns")}
+
+# An image counts as slower if its latency increases by this factor
+# and by at least SLOWER_MIN_MS milliseconds.
+SLOWER_FACTOR = 1.5
+SLOWER_MIN_MS = 1.0
+
+
+def find_image_files(directory):
+    """Return a sorted list of image file paths relative to "directory"."""
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        for name in filenames:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, name)
+                files.append(os.path.relpath(path, directory))
+    files.sort()
+    return files
+
+
+def get_dominant_stage(stage_times):
+    """Return the stage with the largest exclusive time.
+
+    Stages which only contain other stages ("decode", "decode_triplet")
+    are ignored, and the time of "find_patterns" excludes the boundary
+    scans.
+
+    Parameters:
+        stage_times (dict): Mapping of stage name to total duration.
+
+    Returns:
+        Name of the stage, or None if there are no stages.
+    """
+    self_times = {}
+    for (stage, duration) in stage_times.items():
+        if stage in NESTED_STAGES:
+            inner = NESTED_STAGES[stage]
+            if inner is None:
+                continue
+            duration -= sum(stage_times.get(s, 0.0) for s in inner)
+        self_times[stage] = duration
+    if not self_times:
+        return None
+    return max(self_times, key=self_times.get)
+
+
+def replay_image(task):
+    """Decode one image file.
+
+    Parameters:
+        task: Tuple (directory, file_name, decode_args).
+
+    Returns:
+        Dictionary describing the result. "error" is a failure reason
+        which is the same for similar failures, and "error_detail"
+        contains the exception message if it is not part of "error".
+    """
+
+    (directory, file_name, decode_args) = task
+    result = {"file": file_name,
+              "width": None,
+              "height": None,
+              "error": None,
+              "error_detail": None,
+              "data_length": None,
+              "data_sha256": None,
+              "decode_ms": None,
+              "dominant_stage": None,
+              "stage_ms": {}}
+
+    try:
+        img = Image.open(os.path.join(directory, file_name), "r")
+        img.load()
+    except (IOError, ValueError, Image.DecompressionBombError) as exc:
+        result["error"] = "Can not read image file"
+        result["error_detail"] = "{}: {}".format(type(exc).__name__, exc)
+        return result
+    except Exception as exc:
+        result["error"] = "Internal error: {}".format(type(exc).__name__)
+        result["error_detail"] = str(exc)
+        return result
+    (result["width"], result["height"]) = img.size
+
+    tracer = qrdecode.QRTracer()
+    try:
+        data = qrdecode.decode_qrcode(img, tracer=tracer, **decode_args)
+        result["data_length"] = len(data)
+        result["data_sha256"] = hashlib.sha256(data).hexdigest()
+    except qrdecode.QRDecodeError as exc:
+        result["error"] = str(exc)
+    except Exception as exc:
+        result["error"] = "Internal error: {}".format(type(exc).__name__)
+        result["error_detail"] = str(exc)
+
+    stage_times = {stage: duration
+                   for (stage, (count, duration))
+                   in tracer.get_stage_times().items()}
+    if "decode" in stage_times:
+        result["decode_ms"] = 1000 * stage_times["decode"]
+    result["dominant_stage"] = get_dominant_stage(stage_times)
+    result["stage_ms"] = {stage: 1000 * duration
+                          for (stage, duration) in stage_times.items()}
+
+    return result
+
+
+def run_replay(directory, files, decode_args, workers):
+    """Decode the image files with a pool of worker processes.
+
+    Parameters:
+        directory (str): Root directory of the corpus.
+        files (list): File names relative to the directory.
+        decode_args (dict): Keyword arguments for "decode_qrcode()".
+        workers (int): Number of worker processes. With 1 worker,
+            images are decoded in the current process.
+
+    Returns:
+        List of result dictionaries in the order of "files".
+    """
+
+    tasks = [(directory, file_name, decode_args) for file_name in files]
+    if workers == 1:
+        return [replay_image(task) for task in tasks]
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(replay_image, tasks, chunksize=1)
+
+
+def latency_histogram(values):
+    """Count latencies in milliseconds per bin of HISTOGRAM_BINS.
+
+    Returns:
+        List of counts, with one extra bin for values above
+        the last bound.
+    """
+    index = np.searchsorted(HISTOGRAM_BINS, values, side="left")
+    return np.bincount(index, minlength=len(HISTOGRAM_BINS) + 1).tolist()
+
+
+def summarize_results(results):
+    """Summarize replay results.
+
+    Returns:
+        Dictionary with counts, latency percentiles and histograms,
+        failure reasons and dominant stages.
+    """
+
+    ok_times = [r["decode_ms"] for r in results
+                if r["error"] is None]
+    failed_times = [r["decode_ms"] for r in results
+                    if r["error"] is not None and r["decode_ms"] is not None]
+    all_times = ok_times + failed_times
+
+    summary = {"images": len(results),
+               "decoded": len(ok_times),
+               "failed": len(results) - len(ok_times),
+               "histogram_bins_ms": list(HISTOGRAM_BINS),
+               "histogram_ok": latency_histogram(ok_times),
+               "histogram_failed": latency_histogram(failed_times),
+               "errors": collections.Counter(
+                   r["error"] for r in results
+                   if r["error"] is not None).most_common(),
+               "dominant_stages": collections.Counter(
+                   r["dominant_stage"] for r in results
+                   if r["dominant_stage"] is not None).most_common()}
+
+    if all_times:
+        summary["latency_ms"] = {
+            "p50": float(np.percentile(all_times, 50)),
+            "p90": float(np.percentile(all_times, 90)),
+            "p99": float(np.percentile(all_times, 99)),
+            "max": float(np.max(all_times)),
+            "mean": float(np.mean(all_times))}
+
+    return summary
+
+
+def print_histogram(summary):
+    """Print the latency histograms of decoded and failed images."""
+
+    ok = summary["histogram_ok"]
+    failed = summary["histogram_failed"]
+    bins = summary["histogram_bins_ms"]
+    largest = max(ok + failed + [1])
+    width = 40
+
+    print("{:<14s} {:>7s} {:>7s}".format("latency (ms)", "ok", "failed"))
+    for k in range(len(ok)):
+        if k < len(bins):
+            label = "<= {}".format(bins[k])
+        else:
+            label = "> {}".format(bins[-1])
+        bar = ("#" * round(width * ok[k] / largest)
+               + "x" * round(width * failed[k] / largest))
+        print("{:<14s} {:>7d} {:>7d}  {}".format(label, ok[k], failed[k],
+                                                  bar).rstrip())
+
+
+def print_summary(summary):
+    """Print a summary of a replay."""
+
+    print("images: {}  decoded: {}  failed: {}".format(
+        summary["images"], summary["decoded"], summary["failed"]))
+    if "latency_ms" in summary:
+        print("latency: p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms,"
+              " max {max:.2f} ms".format(**summary["latency_ms"]))
+    print()
+    print_histogram(summary)
+
+    if summary["errors"]:
+        print()
+        print("failure reasons:")
+        for (error, count) in summary["errors"]:
+            print("  {:6d}  {}".format(count, error))
+
+    if summary["dominant_stages"]:
+        print()
+        print("dominant stages:")
+        for (stage, count) in summary["dominant_stages"]:
+            print("  {:6d}  {}".format(count, stage))
+
+
+def diff_results(results, baseline_results):
+    """Compare replay results with a previous run.
+
+    Images are matched by file name.
+
+    Returns:
+        Dictionary with lists of file names:
+            "fixed": Images which decode now but failed before.
+            "broken": Images which fail now but decoded before.
+            "changed_data": Images which decode to different data.
+            "changed_error": Images which fail with a different error.
+            "slower": Tuples (file, old_ms, new_ms) of images whose
+                latency increased by more than SLOWER_FACTOR.
+            "added", "removed": Images only in one of the runs.
+        and "latency_ratio", the median ratio of new to old latency.
+    """
+
+    old = {r["file"]: r for r in baseline_results}
+    new = {r["file"]: r for r in results}
+
+    diff = {"fixed": [],
+            "broken": [],
+            "changed_data": [],
+            "changed_error": [],
+            "slower": [],
+            "added": sorted(set(new) - set(old)),
+            "removed": sorted(set(old) - set(new)),
+            "latency_ratio": None}
+    ratios = []
+
+    for file_name in sorted(set(new) & set(old)):
+        (r_new, r_old) = (new[file_name], old[file_name])
+        if r_new["error"] is None and r_old["error"] is not None:
+            diff["fixed"].append(file_name)
+        elif r_new["error"] is not None and r_old["error"] is None:
+            diff["broken"].append(file_name)
+        elif r_new["error"] is None:
+            if r_new["data_sha256"] != r_old["data_sha256"]:
+                diff["changed_data"].append(file_name)
+        elif r_new["error"] != r_old["error"]:
+            diff["changed_error"].append(file_name)
+
+        (t_new, t_old) = (r_new["decode_ms"], r_old["decode_ms"])
+        if t_new is not None and t_old is not None and t_old > 0:
+            ratios.append(t_new / t_old)
+            if (t_new > SLOWER_FACTOR * t_old
+                    and t_new - t_old >= SLOWER_MIN_MS):
+                diff["slower"].append((file_name, t_old, t_new))
+
+    if ratios:
+        diff["latency_ratio"] = float(np.median(ratios))
+    diff["slower"].sort(key=lambda item: item[2] / item[1], reverse=True)
+
+    return diff
+
+
+def print_diff(diff, baseline_summary, summary):
+    """Print the comparison with a previous run."""
+
+    print("comparison with baseline:")
+    print("  decoded: {} -> {}  failed: {} -> {}".format(
+        baseline_summary["decoded"], summary["decoded"],
+        baseline_summary["failed"], summary["failed"]))
+    if "latency_ms" in baseline_summary and "latency_ms" in summary:
+        (old, new) = (baseline_summary["latency_ms"], summary["latency_ms"])
+        for key in ("p50", "p90", "p99"):
+            change = (100 * (new[key] / old[key] - 1) if old[key] > 0
+                      else 0.0)
+            print("  {}: {:.2f} ms -> {:.2f} ms ({:+.1f}%)".format(
+                key, old[key], new[key], change))
+    if diff["latency_ratio"] is not None:
+        print("  median latency ratio per image: {:.3f}".format(
+            diff["latency_ratio"]))
+
+    for (key, title) in (("broken", "now failing"),
+                         ("fixed", "now decoding"),
+                         ("changed_data", "different data"),
+                         ("changed_error", "different error"),
+                         ("added", "not in baseline"),
+                         ("removed", "missing from this run")):
+        if diff[key]:
+            print()
+            print("{} ({}):".format(title, len(diff[key])))
+            for file_name in diff[key]:
+                print("  " + file_name)
+
+    if diff["slower"]:
+        print()
+        print("slower than {}x ({}):".format(SLOWER_FACTOR,
+                                             len(diff["slower"])))
+        for (file_name, t_old, t_new) in diff["slower"]:
+            print("  {}: {:.2f} ms -> {:.2f} ms".format(file_name,
+                                                        t_old, t_new))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a directory of images through the QR decoder.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes"
+                             " (default: number of CPUs).")
+    parser.add_argument("--inverted", action="store_true",
+                        help="Also decode light-on-dark QR codes.")
+    parser.add_argument("--mirrored", action="store_true",
+                        help="Also decode mirrored QR codes.")
+    parser.add_argument("--output", type=str,
+                        help="Save results to a JSON file.")
+    parser.add_argument("--compare", type=str,
+                        help="Compare with results from a JSON file.")
+    parser.add_argument("directory", type=str,
+                        help="Directory containing the image files.")
+    args = parser.parse_args()
+
+    if args.workers is None or args.workers < 1:
+        print("ERROR: Invalid value for --workers", file=sys.stderr)
+        return 1
+
+    files = find_image_files(args.directory)
+    if not files:
+        print("ERROR: No image files found", file=sys.stderr)
+        return 1
+
+    config = {"directory": os.path.abspath(args.directory),
+              "detect_inverted": args.inverted,
+              "detect_mirrored": args.mirrored}
+    decode_args = {"detect_inverted": args.inverted,
+                   "detect_mirrored": args.mirrored}
+
+    t0 = time.perf_counter()
+    results = run_replay(args.directory, files, decode_args, args.workers)
+    t1 = time.perf_counter()
+
+    summary = summarize_results(results)
+    summary["workers"] = args.workers
+    summary["wall_time"] = t1 - t0
+
+    print("{} images decoded by {} workers in {:.1f} s".format(
+        len(files), args.workers, t1 - t0))
+    print_summary(summary)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_report = json.load(f)
+        if baseline_report["config"] != config:
+            print()
+            print("WARNING: The baseline was run with different options.")
+        print()
+        diff = diff_results(results, baseline_report["results"])
+        print_diff(diff, baseline_report["summary"], summary)
+
+    if args.output:
+        report = {"config": config,
+                  "environment": {"python": platform.python_version(),
+                                  "numpy": np.__version__,
+                                  "machine": platform.machine(),
+                                  "time": time.strftime(
+                                      "%Y-%m-%dT%H:%M:%S")},
+                  "summary": summary,
+                  "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
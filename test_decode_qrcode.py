@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""Tests for the stream mode of the command line tool."""
+
+import io
+import os.path
+import json
+import unittest
+import decode_qrcode
+
+
+class TestStreamInput(unittest.TestCase):
+    """Test reading file names and image blobs from a stream."""
+
+    def test_read_paths(self):
+        stream = io.BytesIO(b"a.png\n\nb c.png\n  \nd.png")
+        self.assertEqual(list(decode_qrcode.read_paths(stream)),
+                         [{"path": "a.png"},
+                          {"path": "b c.png"},
+                          {"path": "d.png"}])
+
+    def test_read_paths_null(self):
+        stream = io.BytesIO(b"a\nb.png\0c.png\0")
+        self.assertEqual(list(decode_qrcode.read_paths(stream, b"\0")),
+                         [{"path": "a\nb.png"}, {"path": "c.png"}])
+
+    def test_read_blobs(self):
+        stream = io.BytesIO(b"3\nabc\n0\n\n2\nxy")
+        self.assertEqual(list(decode_qrcode.read_blobs(stream)),
+                         [{"image": b"abc"},
+                          {"image": b""},
+                          {"image": b"xy"}])
+
+    def test_read_blobs_invalid(self):
+        for data in (b"x\n", b"-1\n", b"5\nabc"):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    list(decode_qrcode.read_blobs(io.BytesIO(data)))
+
+
+class TestStreamDecode(unittest.TestCase):
+    """Test decoding a stream of images."""
+
+    testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+    options = {"inverted": False, "mirrored": False, "metrics": False}
+
+    image_files = ["Qr-1.png", "Qr-2.png", "Qr-3.png", "Qr-4.png",
+                   "Qr-code-ver-10.png", "no_such_file.png"]
+
+    def get_items(self):
+        return [{"path": os.path.join(self.testdata_dir, image_file)}
+                for image_file in self.image_files]
+
+    def decode(self, items, n_workers, ordered):
+        output = io.StringIO()
+        error = decode_qrcode.stream_decode(items, self.options,
+                                            n_workers, ordered, output)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        return (error, lines)
+
+    def check_results(self, lines):
+        items = self.get_items()
+        self.assertEqual(sorted(line["index"] for line in lines),
+                         list(range(len(items))))
+        for line in lines:
+            self.assertEqual(line["source"], items[line["index"]]["path"])
+        by_index = {line["index"]: line for line in lines}
+        self.assertEqual(by_index[2]["text"], "Version 3 QR Code")
+        self.assertIsNone(by_index[2]["error"])
+        self.assertTrue(by_index[5]["error"].startswith(
+            "Can not read image"))
+
+    def test_single_worker(self):
+        (error, lines) = self.decode(self.get_items(), 1, False)
+        self.assertIsNone(error)
+        self.check_results(lines)
+        self.assertEqual([line["index"] for line in lines],
+                         list(range(len(lines))))
+
+    def test_ordered(self):
+        (error, lines) = self.decode(self.get_items(), 2, True)
+        self.assertIsNone(error)
+        self.check_results(lines)
+        self.assertEqual([line["index"] for line in lines],
+                         list(range(len(lines))))
+
+    def test_unordered(self):
+        (error, lines) = self.decode(self.get_items(), 2, False)
+        self.assertIsNone(error)
+        self.check_results(lines)
+
+    def test_invalid_input(self):
+        stream = io.BytesIO(b"3\nabc\nnot a length\n")
+        for n_workers in (1, 2):
+            with self.subTest(n_workers=n_workers):
+                (error, lines) = self.decode(
+                    decode_qrcode.read_blobs(io.BytesIO(stream.getvalue())),
+                    n_workers, True)
+                self.assertIn("invalid literal", error)
+                self.assertEqual(len(lines), 1)
+                self.assertTrue(lines[0]["error"].startswith(
+                    "Can not read image"))
+
+    def test_reader_error(self):
+        # An error while reading the input ends the stream
+        # after the images read so far, and is passed to the caller.
+        def failing_items():
+            yield from self.get_items()[:2]
+            raise OSError("Read error")
+        for n_workers in (1, 2):
+            with self.subTest(n_workers=n_workers):
+                output = io.StringIO()
+                with self.assertRaises(OSError) as cm:
+                    decode_qrcode.stream_decode(failing_items(),
+                                                self.options,
+                                                n_workers, True, output)
+                self.assertEqual(str(cm.exception), "Read error")
+                lines = output.getvalue().splitlines()
+                self.assertEqual(len(lines), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,13 +2,48 @@
 
 """Tests for QR decoder."""
 
+import io
 import os.path
+import time
+import contextlib
 import random
 import unittest
+import tracemalloc
+import numpy as np
 from PIL import Image
 import qrdecode
 
 
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
+
+
+def load_image(image_file):
+    """Open an image from the test data directory."""
+    image_path = os.path.join(TESTDATA_DIR, image_file)
+    return Image.open(image_path, "r")
+
+
+def load_image_data(image_file):
+    """Return the quantized data of an image from the test data directory."""
+    return qrdecode.quantize_image(load_image(image_file))
+
+
+def make_cluttered_image(repeat):
+    """Return a grid of damaged copies of a version 1 QR code.
+
+    The grid contains many position detection patterns, which form
+    a large number of candidate finder triplets.
+    """
+    img_data = load_image_data("Qr-1.png")
+    # Sample the center of each module, 7 pixels apart,
+    # and damage the data region.
+    matrix = img_data[40:187:7, 40:187:7]
+    matrix[9:21, 9:21] ^= 1
+    tile = np.kron(matrix, np.ones((3, 3), dtype=np.uint8))
+    tile = 255 * np.pad(tile, 6, constant_values=1)
+    return np.tile(tile, (repeat, repeat))
+
+
 class TestImageFiles(unittest.TestCase):
     """Test QR decoding based on a collection of image files."""
 
@@ -192,6 +227,836 @@ class TestImageFiles(unittest.TestCase):
             "A version 12 code with high error correction. We can mess it up pretty bad and still decode it correctly. Those Reed-Solomon codes are quite impressive.")
 
 
+class TestArrayInput(unittest.TestCase):
+    """Test QR decoding from Numpy arrays."""
+
+    def test_grey_array(self):
+        img = load_image("Qr-4.png").convert("L")
+        got_bytes = qrdecode.decode_qrcode(np.array(img))
+        self.assertEqual(got_bytes, b"Version 4 QR Code, up to 50 char")
+
+    def test_rgb_array(self):
+        img = load_image("Qr-4.png").convert("RGB")
+        got_bytes = qrdecode.decode_qrcode(np.array(img))
+        self.assertEqual(got_bytes, b"Version 4 QR Code, up to 50 char")
+
+    def test_array_with_bbox_hint(self):
+        img = load_image("qr_code_embedded.png").convert("L")
+        hints = qrdecode.QRDecodeHints(bbox=(430, 430, 600, 600))
+        got_bytes = qrdecode.decode_qrcode(np.array(img), hints=hints)
+        self.assertEqual(got_bytes, b"Little code")
+
+    def test_supersampled_matrix(self):
+        img_data = load_image_data("Qr-3.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        (triplet,) = qrdecode.make_finder_triplets(patterns, img_data)
+        (transform, qr_version) = qrdecode.locate_qr_code(img_data, triplet)
+        matrix = qrdecode.sample_qr_matrix(img_data, transform, qr_version)
+        (vmatrix, agreement) = qrdecode.sample_qr_matrix_supersampled(
+            img_data, transform, qr_version, 5)
+        self.assertTrue(np.array_equal(matrix, vmatrix))
+        self.assertTrue(np.all(agreement == 1))
+        with self.assertRaises(ValueError):
+            qrdecode.sample_qr_matrix_supersampled(
+                img_data, transform, qr_version, 2)
+
+    def test_refine_transform(self):
+        img_data = load_image_data("Qr-code-ver-10.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplet = qrdecode.make_finder_triplets(patterns, img_data)[0]
+        (transform, qr_version) = qrdecode.locate_qr_code(img_data, triplet)
+        (dx, dy) = qrdecode.find_alignment_pattern(img_data, transform,
+                                                   28, 28)
+        self.assertLessEqual(abs(dx), 0.25)
+        self.assertLessEqual(abs(dy), 0.25)
+        self.assertIsNone(
+            qrdecode.find_alignment_pattern(img_data, transform, 20, 40))
+        (refined, num_found) = qrdecode.refine_qr_transform(img_data,
+                                                            transform,
+                                                            qr_version)
+        self.assertEqual(num_found, 6)
+        self.assertTrue(np.array_equal(
+            qrdecode.sample_qr_matrix(img_data, transform, qr_version),
+            qrdecode.sample_qr_matrix(img_data, refined, qr_version)))
+
+    def test_quantize_bright_image(self):
+        # Threshold must not overflow for bright images.
+        data = np.array([[128, 255], [255, 128]], dtype=np.uint8)
+        img_data = qrdecode.quantize_image(data)
+        self.assertEqual(img_data.tolist(), [[0, 1], [1, 0]])
+
+
+class TestPrefilter(unittest.TestCase):
+    """Test quick rejection of images without QR code."""
+
+    def test_accept_image_files(self):
+        for image_file in sorted(os.listdir(TESTDATA_DIR)):
+            with self.subTest(image_file=image_file):
+                img_data = load_image_data(image_file)
+                for row_step in (1, 2, 3):
+                    self.assertTrue(
+                        qrdecode.may_contain_qrcode(img_data, row_step))
+
+    def test_reject_blank_image(self):
+        img_data = np.ones((100, 100), dtype=np.uint8)
+        self.assertFalse(qrdecode.may_contain_qrcode(img_data))
+
+    def test_reject_stripes(self):
+        # Horizontal runs with finder proportions, but no vertical match.
+        img_data = np.ones((60, 100), dtype=np.uint8)
+        img_data[20:40, 10:12] = 0
+        img_data[20:40, 14:20] = 0
+        img_data[20:40, 22:24] = 0
+        self.assertFalse(qrdecode.may_contain_qrcode(img_data, 1))
+        with self.assertRaises(qrdecode.QRDecodeError) as cm:
+            qrdecode.decode_qrcode(img_data)
+        self.assertEqual(str(cm.exception),
+                         "No position detection patterns found")
+
+
+class TestDecodeBudget(unittest.TestCase):
+    """Test limits on decoding time and work."""
+
+    def test_within_budget(self):
+        img = load_image("Qr-3.png")
+        got_bytes = qrdecode.decode_qrcode(img, deadline=60, max_triplets=1)
+        self.assertEqual(got_bytes, b"Version 3 QR Code")
+
+    def test_deadline_exceeded(self):
+        img = load_image("Qr-3.png")
+        with self.assertRaises(qrdecode.QRDecodeTimeout) as cm:
+            qrdecode.decode_qrcode(img, deadline=-1)
+        self.assertIsInstance(cm.exception, qrdecode.QRDecodeError)
+        self.assertEqual(cm.exception.progress["stage"], "quantize")
+        self.assertEqual(cm.exception.progress["triplets_tried"], 0)
+
+    def test_deadline_with_hints(self):
+        # A timeout must not fall back to the decode without hints.
+        img = load_image("Qr-3.png")
+        hints = qrdecode.QRDecodeHints(versions=3)
+        with self.assertRaises(qrdecode.QRDecodeTimeout) as cm:
+            qrdecode.decode_qrcode(img, hints=hints, deadline=-1)
+        self.assertEqual(cm.exception.progress["stage"], "prefilter")
+
+    def test_max_triplets(self):
+        img_data = load_image_data("Qr-3.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        (triplet,) = qrdecode.make_finder_triplets(patterns)
+        bad_triplet = (triplet[1], triplet[0], triplet[2])
+        budget = qrdecode.QRDecodeBudget(max_triplets=1)
+        with self.assertRaises(qrdecode.QRDecodeTimeout) as cm:
+            qrdecode.decode_finder_triplets(img_data,
+                                            [bad_triplet, triplet],
+                                            budget=budget)
+        progress = cm.exception.progress
+        self.assertEqual(progress["stage"], "decode_triplet")
+        self.assertEqual(progress["triplets_tried"], 1)
+        self.assertEqual(progress["first_error"],
+                         "Data corruption in format bits")
+
+    def test_deadline_cluttered(self):
+        # Thousands of candidate triplets from a grid of damaged codes.
+        # The deadline must also stop the checks of these triplets.
+        img_data = make_cluttered_image(16)
+        (patterns,) = qrdecode.find_position_detection_arrays(
+            img_data, polarities=(0,))
+        budget = qrdecode.QRDecodeBudget(deadline=0.5)
+        start_time = time.monotonic()
+        with self.assertRaises(qrdecode.QRDecodeTimeout) as cm:
+            qrdecode.make_finder_triplet_array(patterns, img_data,
+                                               budget=budget,
+                                               max_checked=10**6)
+        elapsed = time.monotonic() - start_time
+        self.assertEqual(cm.exception.progress["stage"], "make_triplets")
+        self.assertLess(elapsed, 1.5)
+
+    def test_cancel(self):
+        img = load_image("Qr-3.png")
+        budget = qrdecode.QRDecodeBudget()
+        self.assertEqual(qrdecode.decode_qrcode(img, budget=budget),
+                         b"Version 3 QR Code")
+        budget.cancel()
+        with self.assertRaises(qrdecode.QRDecodeCancelled) as cm:
+            qrdecode.decode_qrcode(img, budget=budget)
+        self.assertIsInstance(cm.exception, qrdecode.QRDecodeTimeout)
+        self.assertEqual(str(cm.exception),
+                         "Decode cancelled before stage quantize")
+
+    def test_invalid_budget(self):
+        with self.assertRaises(ValueError):
+            qrdecode.QRDecodeBudget(max_triplets=0)
+        with self.assertRaises(ValueError):
+            qrdecode.decode_qrcode(load_image("Qr-3.png"),
+                                   deadline=1,
+                                   budget=qrdecode.QRDecodeBudget())
+
+
+class TestInvertedCodes(unittest.TestCase):
+    """Test decoding of inverted (light-on-dark) QR codes."""
+
+    def test_patterns_by_polarity(self):
+        img_data = load_image_data("Qr-4.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        (normal, inverted) = (
+            qrdecode.find_position_detection_patterns_by_polarity(img_data))
+        self.assertEqual(normal, patterns)
+        # Inverting the image swaps the patterns of both polarities.
+        self.assertEqual(
+            qrdecode.find_position_detection_patterns_by_polarity(
+                img_data ^ 1),
+            [inverted, normal])
+
+    def test_decode_inverted(self):
+        for (image_file, expect_data) in (
+                ("Qr-3.png", b"Version 3 QR Code"),
+                ("qr_damaged_7H.png", None),
+                ("212px-QR_Code_Damaged.jpg", b"http://en.m.wikipedia.org")):
+            with self.subTest(image_file=image_file):
+                data = np.array(load_image(image_file).convert("L"))
+                if expect_data is None:
+                    expect_data = qrdecode.decode_qrcode(data)
+                inverted = 255 - data
+                with self.assertRaises(qrdecode.QRDecodeError):
+                    qrdecode.decode_qrcode(inverted)
+                self.assertEqual(
+                    qrdecode.decode_qrcode(inverted, detect_inverted=True),
+                    expect_data)
+                self.assertEqual(
+                    qrdecode.decode_qrcode(data, detect_inverted=True),
+                    expect_data)
+
+
+class TestMirroredCodes(unittest.TestCase):
+    """Test decoding of mirrored QR codes."""
+
+    def test_mirrored_triplets_last(self):
+        img_data = load_image_data("Qr-3.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplets = qrdecode.make_finder_triplets(patterns)
+        mtriplets = qrdecode.make_finder_triplets(patterns, mirrored=True)
+        self.assertEqual(len(mtriplets), 2 * len(triplets))
+        self.assertEqual(mtriplets[:len(triplets)], triplets)
+        self.assertEqual(mtriplets[len(triplets):],
+                         [(ul, dl, ur) for (ul, ur, dl) in triplets])
+
+    def test_decode_mirrored(self):
+        for (image_file, expect_text) in (
+                ("Qr-3.png", "Version 3 QR Code"),
+                ("Qr-code-ver-10.png", "VERSION 10 QR CODE, UP TO 174 CHAR")):
+            img = load_image(image_file).convert("L")
+            for method in (Image.FLIP_LEFT_RIGHT,
+                           Image.FLIP_TOP_BOTTOM,
+                           Image.TRANSPOSE,
+                           Image.TRANSVERSE):
+                with self.subTest(image_file=image_file, method=method):
+                    mirrored = img.transpose(method)
+                    with self.assertRaises(qrdecode.QRDecodeError):
+                        qrdecode.decode_qrcode(mirrored)
+                    got_bytes = qrdecode.decode_qrcode(mirrored,
+                                                       detect_mirrored=True)
+                    got_text = got_bytes.decode("iso8859-1")
+                    self.assertTrue(got_text.startswith(expect_text))
+
+
+class TestTracing(unittest.TestCase):
+    """Test structured tracing events."""
+
+    def test_decode_events(self):
+        tracer = qrdecode.QRTracer()
+        img = load_image("Qr-code-ver-10.png")
+        qrdecode.decode_qrcode(img, tracer=tracer)
+        events = {event["stage"]: event for event in tracer.events}
+        self.assertEqual(list(tracer.get_stage_times()),
+                         ["quantize", "prefilter", "scan_rows",
+                          "scan_columns", "find_patterns", "make_triplets",
+                          "locate", "sample", "read_format",
+                          "extract_codewords", "error_correction",
+                          "decode_data", "decode_triplet", "decode"])
+        self.assertEqual(events["decode"]["pixels"], img.width * img.height)
+        self.assertNotIn("error", events["decode"])
+        self.assertEqual(events["locate"]["qr_version"], 10)
+        self.assertTrue(events["locate"]["reused"])
+        self.assertEqual(events["sample"]["modules"], 57 * 57)
+        self.assertEqual(events["error_correction"]["num_blocks"], 8)
+        self.assertEqual(events["error_correction"]["errors_corrected"], 0)
+        # All stages end within the "decode" stage.
+        for event in tracer.events:
+            self.assertGreaterEqual(event["duration"], 0)
+            self.assertLessEqual(
+                event["start"] + event["duration"],
+                events["decode"]["start"] + events["decode"]["duration"])
+
+    def test_errors_corrected(self):
+        events = []
+        tracer = qrdecode.QRTracer(events.append)
+        qrdecode.decode_qrcode(load_image("qr_damaged_7H.png"),
+                               tracer=tracer)
+        self.assertEqual(tracer.events, [])
+        (event,) = [e for e in events if e["stage"] == "error_correction"]
+        self.assertEqual(event["errors_corrected"], 26)
+        self.assertEqual(event["blocks_corrected"], 2)
+
+    def test_failed_decode(self):
+        tracer = qrdecode.QRTracer()
+        img_data = np.full((100, 100), 255, dtype=np.uint8)
+        with self.assertRaises(qrdecode.QRDecodeError):
+            qrdecode.decode_qrcode(img_data, tracer=tracer)
+        (prefilter, decode) = tracer.events[-2:]
+        self.assertTrue(prefilter["rejected"])
+        self.assertEqual(decode["stage"], "decode")
+        self.assertEqual(decode["error"],
+                         "No position detection patterns found")
+
+    def test_debug_messages(self):
+        events = []
+        tracer = qrdecode.QRTracer(events.append)
+        img = load_image("Qr-code-ver-10.png")
+        qrdecode.decode_qrcode(img, debug_level=1, tracer=tracer)
+        messages = [event["message"] for event in events
+                    if event["stage"] == "message"]
+        self.assertIn("FINDER TRIPLET:", messages)
+        self.assertIn("QR VERSION: 10 H mask=4", messages)
+        # Messages are interleaved with the events of the stages.
+        stages = [event["stage"] for event in events]
+        self.assertLess(stages.index("make_triplets"),
+                        stages.index("message"))
+        self.assertLess(stages.index("message"), stages.index("locate"))
+        # Without a tracer, messages and events are printed together.
+        output = io.StringIO()
+        with contextlib.redirect_stderr(output):
+            qrdecode.decode_qrcode(img, debug_level=1)
+        lines = output.getvalue().splitlines()
+        self.assertIn("QR VERSION: 10 H mask=4", lines)
+        self.assertTrue(lines[-1].startswith("TRACE decode: "))
+
+    def test_pipeline_tracker_messages(self):
+        img = load_image("Qr-3.png").convert("L")
+        events = []
+        tracer = qrdecode.QRTracer(events.append)
+        pipeline = qrdecode.QRPipeline(img, debug_level=2, tracer=tracer)
+        self.assertEqual(pipeline.decode(), b"Version 3 QR Code")
+        messages = [event["message"] for event in events
+                    if event["stage"] == "message"]
+        self.assertIn("POSITION DETECTION PATTERNS:", messages)
+        self.assertIn("FINDER TRIPLET:", messages)
+        del events[:]
+        tracker = qrdecode.QRTracker(skip_unchanged=False, debug_level=2,
+                                     tracer=tracer)
+        rotated = img.rotate(180)
+        for frame in (img, rotated, rotated):
+            self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        messages = [event["message"] for event in events
+                    if event["stage"] == "message"]
+        self.assertIn("POSITION DETECTION PATTERNS:", messages)
+        self.assertIn("TRACKED TRANSFORM:", messages)
+        self.assertTrue(any(msg.startswith("TRACKING FAILED: ")
+                            for msg in messages))
+
+    def test_memory_events(self):
+        img = load_image("Qr-code-ver-10.png")
+        with qrdecode.QRMemoryTracer() as tracer:
+            qrdecode.decode_qrcode(img, tracer=tracer)
+        self.assertFalse(tracemalloc.is_tracing())
+        events = {event["stage"]: event for event in tracer.events}
+        pixels = img.width * img.height
+        self.assertEqual(events["quantize"]["array_bytes"], pixels)
+        self.assertGreaterEqual(events["quantize"]["peak_bytes"], pixels)
+        self.assertGreaterEqual(events["quantize"]["retained_bytes"], pixels)
+        for stage in ("scan_rows", "scan_columns"):
+            self.assertGreater(events[stage]["array_bytes"], 4 * pixels)
+            self.assertGreaterEqual(events[stage]["peak_bytes"],
+                                    events[stage]["array_bytes"])
+        self.assertEqual(events["sample"]["array_bytes"], 57 * 57)
+        # The decode stage includes the peak of all other stages.
+        memory = tracer.get_stage_memory()
+        self.assertEqual(memory["decode"][0],
+                         max(peak for (peak, retained) in memory.values()))
+        self.assertEqual(tracer.open_stages, [])
+
+    def test_matrix_to_string(self):
+        matrix = np.array([[0, 1], [1, 2]], dtype=np.uint8)
+        self.assertEqual(qrdecode.matrix_to_string(matrix),
+                         "  . X\n  X ?")
+
+
+class TestDecodeResult(unittest.TestCase):
+    """Test decode results with quality metrics."""
+
+    def test_damaged(self):
+        img = load_image("qr_damaged_7H.png")
+        result = qrdecode.decode_qrcode(img, return_result=True)
+        self.assertIsInstance(result, qrdecode.QRDecodeResult)
+        self.assertEqual(result.data, qrdecode.decode_qrcode(img))
+        self.assertEqual(result.qr_version, 7)
+        self.assertEqual(result.error_correction_level, "H")
+        self.assertEqual(result.block_errors, [13, 0, 0, 0, 13])
+        self.assertEqual(result.max_errors, 13)
+        self.assertEqual(result.error_margin, 0)
+        self.assertEqual(result.triplets_tried, 1)
+        self.assertFalse(result.inverted)
+        self.assertEqual(result.contrast, 255)
+        self.assertEqual(result.threshold, 127)
+        self.assertEqual(result.threshold_margin, 127)
+        self.assertEqual(result.agreement, 1.0)
+        self.assertEqual(result.unstable_modules, 0)
+
+    def test_inverted_and_hinted(self):
+        img = load_image("Qr-code-ver-10.png")
+        img_data = np.array(img.convert("L"))
+        expect = qrdecode.decode_qrcode(img_data, return_result=True)
+        self.assertEqual(max(expect.block_errors), 0)
+        result = qrdecode.decode_qrcode(255 - img_data,
+                                        detect_inverted=True,
+                                        return_result=True)
+        self.assertTrue(result.inverted)
+        self.assertEqual(result.data, expect.data)
+        self.assertGreater(result.dark_level, result.light_level)
+        # With a bounding box hint, the transform still refers to
+        # the complete image.
+        hints = qrdecode.QRDecodeHints(bbox=(10, 6, 210, 214))
+        result = qrdecode.decode_qrcode(img_data, hints=hints,
+                                        return_result=True)
+        np.testing.assert_allclose(result.transform, expect.transform)
+        decoder = qrdecode.QRDecoder(img_data.shape, hints=hints)
+        result = decoder.decode(img_data, return_result=True)
+        self.assertEqual(result.data, expect.data)
+        np.testing.assert_allclose(result.transform, expect.transform)
+
+    def test_degraded(self):
+        img = load_image("Qr-code-ver-10.png")
+        # Reduce contrast and resample to a non-integer scale.
+        img = img.convert("L").resize((120, 120), Image.BILINEAR)
+        img_data = 80 + np.array(img) // 3
+        result = qrdecode.decode_qrcode(img_data, return_result=True)
+        self.assertLess(result.contrast, 90)
+        self.assertLess(result.agreement, 1.0)
+        self.assertGreater(result.unstable_modules, 0)
+
+    def test_slots(self):
+        result = qrdecode.QRDecodeResult()
+        self.assertFalse(hasattr(result, "__dict__"))
+        with self.assertRaises(AttributeError):
+            result.other = 1
+        self.assertIsNone(result.error_margin)
+        self.assertIsNone(result.contrast)
+
+
+class TestQRDecoder(unittest.TestCase):
+    """Test the reusable QRDecoder."""
+
+    def test_repeated_decode(self):
+        decoder = qrdecode.QRDecoder((220, 220))
+        for image_file in ("Qr-1.png", "Qr-4.png", "Qr-1.png"):
+            img = load_image(image_file)
+            expect = qrdecode.decode_qrcode(img)
+            self.assertEqual(decoder.decode(img), expect)
+            self.assertEqual(decoder.decode(np.array(img.convert("L"))),
+                             expect)
+
+    def test_change_image_size(self):
+        decoder = qrdecode.QRDecoder((220, 220))
+        img = load_image("qr_damaged_7H.png")
+        self.assertEqual(
+            decoder.decode(img),
+            b"Maximum number of correctable errors in two blocks of this code.")
+        self.assertEqual(decoder.workspace.image_shape, (159, 159))
+
+    def test_shared_tables(self):
+        decoder = qrdecode.QRDecoder((220, 220))
+        decoder.workspace.precompute_tables((7,))
+        data_mask = decoder.workspace.data_mask
+        self.assertEqual(len(data_mask), 8)
+        img = load_image("qr_damaged_7H.png")
+        decoder.decode(img)
+        self.assertIs(decoder.workspace.data_mask, data_mask)
+        self.assertEqual(len(data_mask), 8)
+
+    def test_decoder_inverted(self):
+        img_data = np.array(load_image("Qr-1.png").convert("L"))
+        expect = qrdecode.decode_qrcode(img_data)
+        decoder = qrdecode.QRDecoder(img_data.shape, detect_inverted=True)
+        self.assertEqual(decoder.decode(255 - img_data), expect)
+        self.assertEqual(decoder.decode(img_data), expect)
+
+    def test_decoder_hints(self):
+        hints = qrdecode.QRDecodeHints(bbox=(430, 430, 600, 600))
+        decoder = qrdecode.QRDecoder((725, 725), hints=hints)
+        img = load_image("qr_code_embedded.png")
+        self.assertEqual(decoder.decode(img), b"Little code")
+
+    def test_workspace_buffers(self):
+        rnd = np.random.RandomState(1234)
+        img_data = (rnd.uniform(size=(40, 30)) > 0.5).astype(np.uint8)
+        workspace = qrdecode.QRWorkspace(img_data.shape)
+        (boundpos, boundmap) = qrdecode.scan_boundaries(img_data)
+        (wboundpos, wboundmap) = qrdecode.scan_boundaries(
+            img_data, workspace.hboundaries)
+        self.assertTrue(np.array_equal(boundpos, wboundpos))
+        self.assertTrue(np.array_equal(boundmap, wboundmap))
+        transform = np.array([[1.3, 0.2, 1.0], [-0.1, 1.4, 2.0], [0, 0, 1]])
+        self.assertTrue(np.array_equal(
+            qrdecode.sample_qr_matrix(img_data, transform, 2),
+            qrdecode.sample_qr_matrix(img_data, transform, 2, workspace)))
+
+
+class TestQRPipeline(unittest.TestCase):
+    """Test step-by-step decoding with QRPipeline."""
+
+    def test_decode(self):
+        img = load_image("qr_damaged_8L.png")
+        pipeline = qrdecode.QRPipeline(img)
+        self.assertEqual(pipeline.decode(), qrdecode.decode_qrcode(img))
+
+    def test_stages(self):
+        img = load_image("Qr-4.png")
+        pipeline = qrdecode.QRPipeline(img)
+        quantized = pipeline.quantize()
+        self.assertIsInstance(quantized, qrdecode.QuantizedImage)
+        triplets = pipeline.make_triplets(quantized)
+        self.assertEqual(len(triplets), 1)
+        location = pipeline.locate(triplets[0], quantized)
+        self.assertIsInstance(location, qrdecode.QRLocation)
+        self.assertEqual(location.qr_version, 4)
+        matrix = pipeline.sample(location, quantized)
+        qr_format = pipeline.read_format(matrix)
+        self.assertIsInstance(qr_format, qrdecode.QRFormat)
+        codewords = pipeline.extract_codewords(matrix, qr_format)
+        bitstream = pipeline.correct_errors(codewords, location, qr_format)
+        self.assertEqual(pipeline.decode_data(bitstream, location),
+                         b"Version 4 QR Code, up to 50 char")
+
+    def test_read_only_results(self):
+        data = np.array(load_image("Qr-4.png").convert("L"))
+        pipeline = qrdecode.QRPipeline(data)
+        quantized = pipeline.quantize()
+        location = pipeline.locate(pipeline.make_triplets()[0])
+        matrix = pipeline.sample(location)
+        for array in (pipeline.greyscale(), quantized.img_data,
+                      location.transform, matrix,
+                      pipeline.make_triplet_array()):
+            with self.assertRaises(ValueError):
+                array[0] = 0
+        self.assertIsInstance(pipeline.find_patterns(), tuple)
+        self.assertIsInstance(pipeline.make_triplets(), tuple)
+        # The input array itself stays writable.
+        self.assertTrue(data.flags.writeable)
+        self.assertEqual(pipeline.decode(),
+                         b"Version 4 QR Code, up to 50 char")
+
+    def test_resample_with_new_threshold(self):
+        img = load_image("qr_damaged_9Q.png")
+        pipeline = qrdecode.QRPipeline(img)
+        data = pipeline.decode()
+        patterns = pipeline.find_patterns()
+        # Re-sampling with a different threshold reuses the patterns
+        # found in the default quantized image.
+        self.assertEqual(pipeline.decode(sample_threshold=100), data)
+        self.assertIs(pipeline.find_patterns(), patterns)
+        self.assertIn(("quantize", 100), pipeline.cache)
+        self.assertNotIn(("patterns", 100), pipeline.cache)
+
+    def test_quantize_threshold(self):
+        data = np.array([[10, 100], [150, 250]], dtype=np.uint8)
+        img_data = qrdecode.quantize_image(data, threshold=120)
+        self.assertEqual(img_data.tolist(), [[0, 0], [1, 1]])
+        pipeline = qrdecode.QRPipeline(data)
+        self.assertEqual(pipeline.quantize().threshold, 130)
+
+
+class TestFinderTriplets(unittest.TestCase):
+    """Test the pre-verification of finder triplets."""
+
+    def test_score_good_triplet(self):
+        img_data = load_image_data("Qr-code-ver-10.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplets = qrdecode.make_finder_triplets(patterns, img_data)
+        self.assertEqual(len(triplets), 1)
+        score = qrdecode.score_finder_triplet(img_data, triplets[0])
+        self.assertEqual(score, 1.0)
+
+    def test_broken_timing(self):
+        img_data = load_image_data("Qr-4.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplets = qrdecode.make_finder_triplets(patterns)
+        self.assertEqual(len(triplets), 1)
+        # Paint over the horizontal and vertical timing patterns
+        # between the position detection patterns.
+        (transform, qr_version) = qrdecode.locate_qr_code(img_data,
+                                                          triplets[0])
+        self.assertEqual(transform[:2].tolist(), [[5, 0, 27], [0, 5, 27]])
+        img_data[57:62, 67:152] = 1
+        img_data[67:152, 57:62] = 1
+        score = qrdecode.score_finder_triplet(img_data, triplets[0])
+        self.assertEqual(score, 0.0)
+        # The triplet is kept, and the QR code can still be decoded.
+        self.assertEqual(qrdecode.make_finder_triplets(patterns, img_data),
+                         triplets)
+        (data, transform, qr_version
+            ) = qrdecode.detect_and_decode_qrcode(img_data)
+        self.assertEqual(data, b"Version 4 QR Code, up to 50 char")
+
+    def test_order_embedded(self):
+        # The outer version-30 code must still be tried first.
+        img_data = load_image_data("qr_code_embedded.png")
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplets = qrdecode.make_finder_triplets(patterns, img_data)
+        self.assertEqual(len(triplets), 2)
+        (transform, qr_version) = qrdecode.locate_qr_code(img_data,
+                                                          triplets[0])
+        self.assertEqual(qr_version, 30)
+
+    def test_array_records(self):
+        img_data = load_image_data("qr_code_embedded.png")
+        (patterns,) = qrdecode.find_position_detection_arrays(img_data,
+                                                              polarities=(0,))
+        self.assertEqual(patterns.dtype, qrdecode.PATTERN_DTYPE)
+        self.assertEqual(
+            patterns.tolist(),
+            qrdecode.find_position_detection_patterns(img_data))
+        triplets = qrdecode.make_finder_triplet_array(patterns, img_data,
+                                                      mirrored=True)
+        self.assertEqual(triplets.dtype, qrdecode.TRIPLET_DTYPE)
+        self.assertEqual(
+            [t[:3] for t in triplets.tolist()],
+            qrdecode.make_finder_triplets(patterns.tolist(), img_data,
+                                          mirrored=True))
+        # Triplets which pass the check first, then normal triplets
+        # before mirrored ones, then by decreasing check score.
+        keys = list(zip(triplets["check_score"] > 0, triplets["priority"],
+                        triplets["check_score"]))
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        # The location of each checked triplet is kept.
+        for record in triplets[triplets["check_score"] > 0]:
+            (transform, qr_version) = qrdecode.locate_qr_code(
+                img_data, tuple(record.tolist()[:3]))
+            self.assertEqual(record["qr_version"], qr_version)
+            self.assertTrue(np.array_equal(record["transform"], transform))
+
+    def test_checked_triplets(self):
+        # Many candidate triplets from a grid of damaged codes.
+        # Only the best triplets are checked before decoding.
+        img_data = make_cluttered_image(8)
+        (patterns,) = qrdecode.find_position_detection_arrays(
+            img_data, polarities=(0,))
+        scored = []
+        score_qr_transform = qrdecode.score_qr_transform
+        def count_score(*args):
+            scored.append(args)
+            return score_qr_transform(*args)
+        qrdecode.score_qr_transform = count_score
+        try:
+            triplets = qrdecode.make_finder_triplet_array(patterns, img_data)
+        finally:
+            qrdecode.score_qr_transform = score_qr_transform
+        self.assertGreater(len(triplets), 100)
+        self.assertLessEqual(len(scored), qrdecode.MAX_CHECKED_TRIPLETS)
+        self.assertEqual(np.count_nonzero(triplets["qr_version"]),
+                         len(scored))
+        # Unchecked triplets keep their geometric order, between
+        # the triplets which passed and failed the check.
+        num_passed = np.count_nonzero(triplets["check_score"] > 0)
+        num_failed = qrdecode.MAX_CHECKED_TRIPLETS - num_passed
+        unchecked = triplets[num_passed:len(triplets)-num_failed]
+        keys = list(zip(unchecked["priority"], unchecked["score"]))
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_discard_duplicates(self):
+        patterns = np.array([(10.0, 10.0, 1.0, 1.0),
+                             (12.0, 11.0, 1.0, 1.0),
+                             (30.0, 10.0, 1.0, 1.0),
+                             (14.0, 10.0, 1.0, 1.0),
+                             (32.0, 11.0, 1.0, 1.0)],
+                            dtype=qrdecode.PATTERN_DTYPE)
+        # The fourth pattern is only close to a discarded pattern.
+        got = qrdecode.discard_duplicate_patterns(patterns)
+        self.assertEqual(got.tolist(), [(10.0, 10.0, 1.0, 1.0),
+                                        (30.0, 10.0, 1.0, 1.0),
+                                        (14.0, 10.0, 1.0, 1.0)])
+
+
+class TestDecodeHints(unittest.TestCase):
+    """Test QR decoding with hints."""
+
+    def run_test(self, image_file, hints, expect_text):
+        img = load_image(image_file)
+        got_bytes = qrdecode.decode_qrcode(img, hints=hints)
+        got_text = got_bytes.decode("iso8859-1")
+        self.assertEqual(got_text, expect_text)
+
+    def test_all_hints(self):
+        hints = qrdecode.QRDecodeHints(versions=2,
+                                       error_correction_level="H",
+                                       mask_pattern=2,
+                                       bbox=(20, 20, 200, 200),
+                                       max_codes=1)
+        self.run_test("Qr-2.png", hints, "Version 2")
+        img = load_image("Qr-2.png")
+        got_bytes = qrdecode.decode_qrcode_hinted(img, hints)
+        self.assertEqual(got_bytes, b"Version 2")
+
+    def test_version_hint(self):
+        hints = qrdecode.QRDecodeHints(versions=(9, 10, 11))
+        self.run_test(
+            "Qr-code-ver-10.png",
+            hints,
+            "VERSION 10 QR CODE, UP TO 174 CHAR AT H LEVEL, WITH 57X57 MODULES AND PLENTY OF ERROR CORRECTION TO GO AROUND.  NOTE THAT THERE ARE ADDITIONAL TRACKING BOXES")
+
+    def test_bbox_hint(self):
+        # Select the version-2 QR code embedded in a version-30 code.
+        hints = qrdecode.QRDecodeHints(bbox=(430, 430, 600, 600))
+        self.run_test("qr_code_embedded.png", hints, "Little code")
+
+    def test_wrong_hints_fallback(self):
+        hints = qrdecode.QRDecodeHints(versions=5,
+                                       error_correction_level="H",
+                                       mask_pattern=7)
+        self.run_test("Qr-1.png", hints, "Ver1")
+
+    def test_hinted_decode_options(self):
+        img = load_image("Qr-code-ver-10.png")
+        hints = qrdecode.QRDecodeHints(versions=10)
+        tracer = qrdecode.QRTracer()
+        decoder = qrdecode.QRDecoder((img.height, img.width),
+                                     hints=hints,
+                                     tracer=tracer,
+                                     supersample=3,
+                                     refine_transform=True)
+        for decode in (
+                lambda: qrdecode.decode_qrcode(img,
+                                               hints=hints,
+                                               supersample=3,
+                                               refine_transform=True,
+                                               tracer=tracer),
+                lambda: decoder.decode(img)):
+            tracer.events = []
+            self.assertTrue(decode().startswith(b"VERSION 10 QR CODE"))
+            events = {event["stage"]: event for event in tracer.events}
+            self.assertEqual(events["sample"]["supersample"], 3)
+            self.assertEqual(events["refine"]["num_alignment"], 6)
+
+    def test_hinted_inverted_mirrored(self):
+        # Inverted and mirrored codes are decoded by the hinted path,
+        # without falling back to a decode without hints.
+        img_data = np.array(load_image("Qr-3.png").convert("L"))
+        hints = qrdecode.QRDecodeHints(versions=3)
+        tracer = qrdecode.QRTracer()
+        for (name, data, options) in (
+                ("inverted", 255 - img_data, {"detect_inverted": True}),
+                ("mirrored", img_data[:, ::-1], {"detect_mirrored": True})):
+            decoder = qrdecode.QRDecoder(img_data.shape, hints=hints,
+                                         tracer=tracer, **options)
+            for decode in (
+                    lambda: qrdecode.decode_qrcode(data, hints=hints,
+                                                   tracer=tracer, **options),
+                    lambda: decoder.decode(data)):
+                with self.subTest(name=name):
+                    tracer.events = []
+                    self.assertEqual(decode(), b"Version 3 QR Code")
+                    stages = [event["stage"] for event in tracer.events]
+                    self.assertEqual(stages.count("quantize"), 1)
+
+    def test_hinted_decode_fails(self):
+        img = load_image("Qr-1.png")
+        hints = qrdecode.QRDecodeHints(versions=5)
+        with self.assertRaises(qrdecode.QRDecodeError):
+            qrdecode.decode_qrcode_hinted(img, hints)
+
+    def test_invalid_hints(self):
+        with self.assertRaises(ValueError):
+            qrdecode.QRDecodeHints(versions=41)
+        with self.assertRaises(ValueError):
+            qrdecode.QRDecodeHints(error_correction_level="X")
+        with self.assertRaises(ValueError):
+            qrdecode.QRDecodeHints(bbox=(10, 10, 5, 20))
+
+
+class TestQRTracker(unittest.TestCase):
+    """Test decoding of video frames with QRTracker."""
+
+    def make_frame(self, image_file, xpos, ypos):
+        """Paste a QR code image into a larger frame."""
+        img = load_image(image_file).convert("L")
+        frame = Image.new("L", (640, 480), 255)
+        frame.paste(img, (xpos, ypos))
+        return frame
+
+    def test_track_small_shift(self):
+        tracker = qrdecode.QRTracker()
+        for i in range(6):
+            frame = self.make_frame("Qr-3.png", 100 + i % 3, 50 + i // 2)
+            got_bytes = tracker.decode(frame)
+            self.assertEqual(got_bytes, b"Version 3 QR Code")
+        self.assertEqual(tracker.frames_detected, 1)
+        self.assertEqual(tracker.frames_tracked, 5)
+        self.assertEqual(tracker.frames_failed, 0)
+
+    def test_track_array_frames(self):
+        for mode in ("L", "RGB"):
+            with self.subTest(mode=mode):
+                tracker = qrdecode.QRTracker()
+                for i in range(4):
+                    frame = self.make_frame("Qr-3.png", 100 + i // 2, 50)
+                    frame = np.array(frame.convert(mode))
+                    self.assertEqual(tracker.decode(frame),
+                                     b"Version 3 QR Code")
+                self.assertEqual(tracker.get_stats(),
+                                 {"skipped": 2, "tracked": 1,
+                                  "detected": 1, "failed": 0})
+
+    def test_track_large_shift(self):
+        tracker = qrdecode.QRTracker()
+        frame = self.make_frame("Qr-3.png", 10, 10)
+        self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        frame = self.make_frame("Qr-3.png", 300, 200)
+        self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        self.assertEqual(tracker.frames_detected, 2)
+        self.assertEqual(tracker.frames_tracked, 0)
+
+    def test_track_changed_code(self):
+        tracker = qrdecode.QRTracker()
+        frame = self.make_frame("Qr-3.png", 100, 50)
+        self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        frame = self.make_frame("Qr-4.png", 100, 50)
+        self.assertEqual(tracker.decode(frame),
+                         b"Version 4 QR Code, up to 50 char")
+        self.assertEqual(tracker.qr_version, 4)
+
+    def test_track_lost(self):
+        tracker = qrdecode.QRTracker()
+        frame = self.make_frame("Qr-3.png", 100, 50)
+        self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        frame = Image.new("L", (640, 480), 255)
+        with self.assertRaises(qrdecode.QRDecodeError):
+            tracker.decode(frame)
+        self.assertEqual(tracker.frames_failed, 1)
+
+    def test_skip_unchanged(self):
+        tracker = qrdecode.QRTracker()
+        frame = self.make_frame("Qr-3.png", 100, 50)
+        for i in range(4):
+            self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        # Changes outside the QR code region are ignored.
+        frame = frame.copy()
+        frame.paste(0, (500, 400, 520, 420))
+        self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        self.assertEqual(tracker.get_stats(),
+                         {"skipped": 4, "tracked": 0,
+                          "detected": 1, "failed": 0})
+        # Changes inside the QR code region are decoded.
+        frame = self.make_frame("Qr-3.png", 101, 50)
+        self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        self.assertEqual(tracker.frames_skipped, 4)
+        self.assertEqual(tracker.frames_tracked, 1)
+
+    def test_no_skip_unchanged(self):
+        tracker = qrdecode.QRTracker(skip_unchanged=False)
+        frame = self.make_frame("Qr-3.png", 100, 50)
+        for i in range(3):
+            self.assertEqual(tracker.decode(frame), b"Version 3 QR Code")
+        self.assertEqual(tracker.frames_skipped, 0)
+        self.assertEqual(tracker.frames_tracked, 2)
+
+
 class TestWithGeneratedQrCodes(unittest.TestCase):
     """Test decoding of programatically generated QR codes.
 
@@ -421,6 +1286,74 @@ class TestWithGeneratedQrCodes(unittest.TestCase):
 
         self.check_qr_code(img, text)
 
+    def test_20m_scale1p83_smooth_supersample(self):
+        # Smooth resampling with non-integer scale factor blurs module
+        # edges. Supersampling should reduce the number of module errors.
+        text = self.gen_text_8bit(100)
+        img = self.gen_qr_code(text, ver=20, errlvl="M", box_size=1)
+        ref_data = qrdecode.quantize_image(img)
+
+        (width, height) = img.size
+        img = img.convert("L").resize((int(1.83 * width),
+                                       int(1.83 * height)),
+                                      resample=Image.BILINEAR)
+
+        img_data = qrdecode.quantize_image(img)
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplet = qrdecode.make_finder_triplets(patterns, img_data)[0]
+        (transform, qr_version) = qrdecode.locate_qr_code(img_data, triplet)
+        self.assertEqual(qr_version, 20)
+
+        # Reference matrix from the unscaled image, with a 4-module border.
+        ref_transform = np.array([[1, 0, 4], [0, 1, 4], [0, 0, 1]])
+        ref_matrix = qrdecode.sample_qr_matrix(ref_data, ref_transform, 20)
+
+        matrix = qrdecode.sample_qr_matrix(img_data, transform, 20)
+        (vmatrix, agreement) = qrdecode.sample_qr_matrix_supersampled(
+            img_data, transform, 20)
+        self.assertEqual(agreement.shape, (97, 97))
+        self.assertLess(2 * np.sum(vmatrix != ref_matrix),
+                        np.sum(matrix != ref_matrix))
+        self.assertTrue(np.all(agreement[vmatrix != matrix] < 1))
+
+        got_bytes = qrdecode.decode_qrcode(img, supersample=3)
+        self.assertEqual(got_bytes.decode("iso8859-1"), text)
+
+    def test_40m_scale1p65_smooth_refine(self):
+        # Sampling far from the finders drifts when the finder-based
+        # transform is slightly off. Alignment patterns correct this.
+        text = self.gen_text_8bit(200)
+        img = self.gen_qr_code(text, ver=40, errlvl="M", box_size=1)
+        ref_data = qrdecode.quantize_image(img)
+
+        (width, height) = img.size
+        img = img.convert("L").resize((int(1.65 * width),
+                                       int(1.65 * height)),
+                                      resample=Image.BILINEAR)
+
+        img_data = qrdecode.quantize_image(img)
+        patterns = qrdecode.find_position_detection_patterns(img_data)
+        triplet = qrdecode.make_finder_triplets(patterns, img_data)[0]
+        (transform, qr_version) = qrdecode.locate_qr_code(img_data, triplet)
+        self.assertEqual(qr_version, 40)
+
+        (refined, num_found) = qrdecode.refine_qr_transform(img_data,
+                                                            transform,
+                                                            qr_version)
+        self.assertEqual(num_found, 46)
+
+        # Reference matrix from the unscaled image, with a 4-module border.
+        ref_transform = np.array([[1, 0, 4], [0, 1, 4], [0, 0, 1]])
+        ref_matrix = qrdecode.sample_qr_matrix(ref_data, ref_transform, 40)
+
+        matrix = qrdecode.sample_qr_matrix(img_data, transform, 40)
+        rmatrix = qrdecode.sample_qr_matrix(img_data, refined, 40)
+        self.assertLess(2 * np.sum(rmatrix != ref_matrix),
+                        np.sum(matrix != ref_matrix))
+
+        got_bytes = qrdecode.decode_qrcode(img, refine_transform=True)
+        self.assertEqual(got_bytes.decode("iso8859-1"), text)
+
     #
     # Test rotated QR codes (only 90, 180, 270 degrees).
     #
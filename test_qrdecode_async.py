@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""Tests for asynchronous QR decoding."""
+
+import os.path
+import asyncio
+import threading
+import unittest
+import numpy as np
+from PIL import Image
+import qrdecode
+import qrdecode_async
+
+
+class BlockingTracer(qrdecode.QRTracer):
+    """Tracer which counts concurrent decodes and can hold a decode
+    at the start of the "find_patterns" stage."""
+
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self.blocked = threading.Event()
+        self.unblock = threading.Event()
+        self.unblock.set()
+
+    def begin(self, stage):
+        if stage == "decode":
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+        elif stage == "find_patterns":
+            self.blocked.set()
+            self.unblock.wait(10)
+            self.unblock.wait(self.delay)
+        return super().begin(stage)
+
+    def emit(self, stage, start, **info):
+        if stage == "decode":
+            with self.lock:
+                self.running -= 1
+        super().emit(stage, start, **info)
+
+
+class TestAsyncDecoder(unittest.TestCase):
+    """Test decoding from asyncio code."""
+
+    testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+    @classmethod
+    def setUpClass(cls):
+        image_path = os.path.join(cls.testdata_dir, "Qr-1.png")
+        cls.image = np.array(Image.open(image_path, "r").convert("L"))
+        cls.expected = qrdecode.decode_qrcode(cls.image)
+        cls.blank = np.full((100, 100), 255, dtype=np.uint8)
+
+    def test_decode(self):
+        async def run():
+            async with qrdecode_async.QRAsyncDecoder(2) as decoder:
+                data = await decoder.decode(self.image)
+                result = await decoder.decode(self.image, return_result=True)
+                with self.assertRaises(qrdecode.QRDecodeError):
+                    await decoder.decode(self.blank)
+            return (data, result)
+        (data, result) = asyncio.run(run())
+        self.assertEqual(data, self.expected)
+        self.assertEqual(result.data, self.expected)
+
+    def test_default_decoder(self):
+        data = asyncio.run(qrdecode_async.decode_qrcode_async(self.image))
+        self.assertEqual(data, self.expected)
+
+    def test_batch(self):
+        images = [self.image, self.blank] * 5
+
+        async def run(ordered):
+            async with qrdecode_async.QRAsyncDecoder(3) as decoder:
+                return [r async for r in decoder.decode_batch(images,
+                                                              ordered)]
+
+        async def generate():
+            for image in images:
+                await asyncio.sleep(0)
+                yield image
+
+        async def run_async_input():
+            async with qrdecode_async.QRAsyncDecoder(2) as decoder:
+                return [r async for r in decoder.decode_batch(generate())]
+
+        expected = [(i, self.expected, None) if i % 2 == 0
+                    else (i, None, "No position detection patterns found")
+                    for i in range(10)]
+        self.assertEqual(asyncio.run(run(True)), expected)
+        self.assertEqual(sorted(asyncio.run(run(False))), expected)
+        self.assertEqual(asyncio.run(run_async_input()), expected)
+
+    def test_concurrency_limit(self):
+        tracer = BlockingTracer(delay=0.02)
+
+        async def run():
+            async with qrdecode_async.QRAsyncDecoder(2) as decoder:
+                return await asyncio.gather(*[
+                    decoder.decode(self.image, tracer=tracer)
+                    for i in range(6)])
+
+        self.assertEqual(asyncio.run(run()), [self.expected] * 6)
+        self.assertEqual(tracer.max_running, 2)
+
+    def test_cancel(self):
+        tracer = BlockingTracer()
+        tracer.unblock.clear()
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            decoder = qrdecode_async.QRAsyncDecoder(1)
+            # The first decode blocks in the worker thread and the
+            # second one waits for a place.
+            first = asyncio.ensure_future(
+                decoder.decode(self.image, tracer=tracer))
+            second = asyncio.ensure_future(decoder.decode(self.image))
+            await loop.run_in_executor(None, tracer.blocked.wait, 10)
+            first.cancel()
+            second.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            with self.assertRaises(asyncio.CancelledError):
+                await second
+            tracer.unblock.set()
+            # The cancelled decode stops and releases its place.
+            data = await asyncio.wait_for(decoder.decode(self.image), 10)
+            await decoder.aclose()
+            return data
+
+        try:
+            self.assertEqual(loop.run_until_complete(run()), self.expected)
+        finally:
+            loop.close()
+        (event,) = [e for e in tracer.events if e["stage"] == "decode"]
+        self.assertEqual(event["error"],
+                         "Decode cancelled before stage make_triplets")
+
+    def test_process_executor(self):
+        async def run():
+            async with qrdecode_async.QRAsyncDecoder(
+                    2, executor="process") as decoder:
+                data = await decoder.decode(self.image)
+                with self.assertRaises(qrdecode.QRDecodeTimeout) as cm:
+                    await decoder.decode(self.image, deadline=-1)
+                return (data, cm.exception)
+        (data, exc) = asyncio.run(run())
+        self.assertEqual(data, self.expected)
+        self.assertEqual(exc.progress["stage"], "quantize")
+
+
+if __name__ == "__main__":
+    unittest.main()
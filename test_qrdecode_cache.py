@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""Tests for the cache of QR decoding results."""
+
+import os.path
+import tempfile
+import threading
+import unittest
+import numpy as np
+from PIL import Image
+import qrdecode
+import qrdecode_cache
+
+
+class TestQRDecodeCache(unittest.TestCase):
+    """Test caching of decoding results."""
+
+    testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+    def load_image(self):
+        image_path = os.path.join(self.testdata_dir, "Qr-3.png")
+        return Image.open(image_path, "r")
+
+    def test_cache_key(self):
+        img = self.load_image()
+        key1 = qrdecode_cache.image_cache_key(img)
+        key2 = qrdecode_cache.image_cache_key(img.copy())
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, qrdecode_cache.image_cache_key(
+            img, (("hints", qrdecode.QRDecodeHints(versions=[3])),)))
+        data = np.array(img.convert("L"))
+        self.assertNotEqual(key1, qrdecode_cache.image_cache_key(data))
+        data2 = data.copy()
+        data2[0, 0] ^= 1
+        self.assertNotEqual(qrdecode_cache.image_cache_key(data),
+                            qrdecode_cache.image_cache_key(data2))
+
+    def test_palette_key(self):
+        img = self.load_image()
+        inverted = img.copy()
+        inverted.putpalette([255 - v for v in img.getpalette()])
+        self.assertEqual(img.tobytes(), inverted.tobytes())
+        self.assertNotEqual(qrdecode_cache.image_cache_key(img),
+                            qrdecode_cache.image_cache_key(inverted))
+        cache = qrdecode_cache.QRDecodeCache()
+        self.assertEqual(cache.decode(img), b"Version 3 QR Code")
+        with self.assertRaises(qrdecode.QRDecodeError):
+            cache.decode(inverted)
+
+    def test_hit_and_miss(self):
+        img = self.load_image()
+        cache = qrdecode_cache.QRDecodeCache()
+        self.assertEqual(cache.decode(img), b"Version 3 QR Code")
+        self.assertEqual(cache.decode(img.copy()), b"Version 3 QR Code")
+        stats = cache.get_stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["entries"], 1)
+
+    def test_decode_options(self):
+        data = 255 - np.array(self.load_image().convert("L"))
+        cache = qrdecode_cache.QRDecodeCache()
+        with self.assertRaises(qrdecode.QRDecodeError):
+            cache.decode(data)
+        self.assertEqual(cache.decode(data, detect_inverted=True),
+                         b"Version 3 QR Code")
+        # Default values are part of the same key as omitted options.
+        with self.assertRaises(qrdecode.QRDecodeError):
+            cache.decode(data, detect_inverted=False, prefilter_step=2)
+        self.assertEqual(cache.decode(data, detect_inverted=True,
+                                      deadline=10),
+                         b"Version 3 QR Code")
+        stats = cache.get_stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["negative_hits"], 1)
+        with self.assertRaises(TypeError):
+            cache.decode(data, inverted=True)
+        with self.assertRaises(ValueError):
+            cache.decode(data, return_result=True)
+
+    def test_timeout_not_cached(self):
+        img = self.load_image()
+        cache = qrdecode_cache.QRDecodeCache()
+        budget = qrdecode.QRDecodeBudget()
+        budget.cancel()
+        with self.assertRaises(qrdecode.QRDecodeCancelled):
+            cache.decode(img, budget=budget)
+        self.assertEqual(cache.decode(img), b"Version 3 QR Code")
+        self.assertEqual(cache.get_stats()["misses"], 2)
+
+    def test_negative_ttl(self):
+        blank = np.full((100, 100), 255, dtype=np.uint8)
+        cache = qrdecode_cache.QRDecodeCache(negative_ttl=60)
+        for i in range(2):
+            with self.assertRaises(qrdecode.QRDecodeError) as cm:
+                cache.decode(blank)
+            self.assertEqual(str(cm.exception),
+                             "No position detection patterns found")
+        self.assertEqual(cache.get_stats()["negative_hits"], 1)
+
+        cache = qrdecode_cache.QRDecodeCache(negative_ttl=-1)
+        for i in range(2):
+            with self.assertRaises(qrdecode.QRDecodeError):
+                cache.decode(blank)
+        self.assertEqual(cache.get_stats()["misses"], 2)
+
+    def test_eviction(self):
+        size = qrdecode_cache.CACHE_ENTRY_OVERHEAD + 10
+        cache = qrdecode_cache.QRDecodeCache(max_bytes=2*size)
+        cache.store(b"a", b"0123456789", None)
+        cache.store(b"b", b"0123456789", None)
+        self.assertIsNotNone(cache.lookup(b"a"))
+        cache.store(b"c", b"0123456789", None)
+        self.assertIsNone(cache.lookup(b"b"))
+        self.assertIsNotNone(cache.lookup(b"a"))
+        self.assertIsNotNone(cache.lookup(b"c"))
+        stats = cache.get_stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["bytes"], 2*size)
+
+    def test_persistent_cache(self):
+        img = self.load_image()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache.db")
+            with qrdecode_cache.QRDecodeCache(path=path) as cache:
+                cache.decode(img)
+            with qrdecode_cache.QRDecodeCache(path=path) as cache:
+                self.assertEqual(cache.decode(img), b"Version 3 QR Code")
+                self.assertEqual(cache.get_stats()["disk_hits"], 1)
+                self.assertEqual(cache.get_stats()["misses"], 0)
+
+    def test_persistent_cache_limits(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache.db")
+            with qrdecode_cache.QRDecodeCache(path=path) as cache:
+                for i in range(5):
+                    cache.store(bytes([i]), None, "error")
+                cache.store(b"data", b"0123456789", None)
+            # Expired failures are deleted when the database is opened.
+            with qrdecode_cache.QRDecodeCache(path=path, negative_ttl=-1,
+                                              max_disk_entries=3) as cache:
+                self.assertIsNone(cache.lookup(b"\x00"))
+                self.assertEqual(cache.get_stats()["disk_evictions"], 5)
+                # The oldest entries are deleted above the size limit.
+                for i in range(qrdecode_cache.DISK_TRIM_INTERVAL):
+                    cache.store(b"new" + bytes([i]), b"0123456789", None)
+                (count,) = cache.db.execute(
+                    "SELECT COUNT(*) FROM qrdecode_cache").fetchone()
+                self.assertEqual(count, 3)
+                self.assertIsNone(cache.lookup(b"data"))
+
+    def test_persistent_cache_threads(self):
+        images = [np.full((20, 20), i, dtype=np.uint8) for i in range(40)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache.db")
+            with qrdecode_cache.QRDecodeCache(path=path) as cache:
+
+                errors = []
+
+                def decode_all():
+                    for image in images:
+                        try:
+                            cache.decode(image)
+                        except qrdecode.QRDecodeError:
+                            pass
+                        except Exception as exc:
+                            errors.append(exc)
+
+                threads = [threading.Thread(target=decode_all)
+                           for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(errors, [])
+                (count,) = cache.db.execute(
+                    "SELECT COUNT(*) FROM qrdecode_cache").fetchone()
+                self.assertEqual(count, len(images))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""Tests for the QR decoding server."""
+
+import os.path
+import json
+import stat
+import base64
+import socket
+import tempfile
+import threading
+import unittest
+import http.client
+import qrdecode_server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, socket_path):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class TestDecodeServer(unittest.TestCase):
+    """Test decoding requests over HTTP."""
+
+    testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = qrdecode_server.QRDecodeService(n_workers=2)
+        cls.server = qrdecode_server.make_server(cls.service, port=0)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+        cls.service.close()
+
+    def request(self, method, path, body=None, headers={}, conn=None):
+        if conn is None:
+            (host, port) = self.server.server_address[:2]
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        result = json.loads(response.read())
+        conn.close()
+        return (response.status, result)
+
+    def read_file(self, image_file):
+        with open(os.path.join(self.testdata_dir, image_file), "rb") as f:
+            return f.read()
+
+    def test_decode_upload(self):
+        (status, result) = self.request("POST", "/decode?metrics=1",
+                                        self.read_file("Qr-2.png"))
+        self.assertEqual(status, 200)
+        self.assertIsNone(result["error"])
+        self.assertEqual(result["text"], "Version 2")
+        self.assertEqual(base64.b64decode(result["data_base64"]),
+                         b"Version 2")
+        self.assertEqual(result["metrics"]["qr_version"], 2)
+        self.assertEqual(result["metrics"]["error_margin"],
+                         result["metrics"]["max_errors"])
+
+    def test_decode_batch(self):
+        request = {"images": [
+            {"path": os.path.join(self.testdata_dir, "Qr-3.png")},
+            {"path": os.path.join(self.testdata_dir, "missing.png")},
+            {"image": base64.b64encode(
+                self.read_file("Qr-1.png")).decode("ascii")},
+            {"image": base64.b64encode(b"not an image").decode("ascii")}]}
+        (status, response) = self.request(
+            "POST", "/decode", json.dumps(request),
+            {"Content-Type": "application/json"})
+        self.assertEqual(status, 200)
+        results = response["results"]
+        self.assertEqual([r["text"] for r in results],
+                         ["Version 3 QR Code", None, "Ver1", None])
+        self.assertTrue(results[1]["error"].startswith("Can not read image"))
+        self.assertTrue(results[3]["error"].startswith("Can not read image"))
+        self.assertEqual(results[2]["source"], "upload")
+
+    def test_metrics(self):
+        self.request("POST", "/decode", self.read_file("Qr-4.png"))
+        (status, metrics) = self.request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertEqual(metrics["workers"], 2)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertGreaterEqual(metrics["images"], 1)
+        self.assertGreater(metrics["decode_ms"]["max"], 0)
+        self.assertGreater(metrics["request_ms"]["max"], 0)
+
+    def test_bad_requests(self):
+        (status, result) = self.request("GET", "/other")
+        self.assertEqual(status, 404)
+        (status, result) = self.request("POST", "/decode", b"{",
+                                        {"Content-Type": "application/json"})
+        self.assertEqual(status, 400)
+        (status, result) = self.request("POST", "/decode",
+                                        json.dumps({"images": 1}),
+                                        {"Content-Type": "application/json"})
+        self.assertEqual(status, 400)
+        # Options in a JSON request must be JSON booleans.
+        for value in ("false", "0", 1, None):
+            with self.subTest(value=value):
+                (status, result) = self.request(
+                    "POST", "/decode",
+                    json.dumps({"images": [], "inverted": value}),
+                    {"Content-Type": "application/json"})
+                self.assertEqual(status, 400)
+                self.assertEqual(result["error"], "Invalid request:"
+                                 " inverted must be true or false")
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, "qrdecode.sock")
+            server = qrdecode_server.make_server(self.service, socket_path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                (status, result) = self.request(
+                    "POST", "/decode", self.read_file("Qr-1.png"),
+                    conn=UnixHTTPConnection(socket_path))
+                (status, health) = self.request(
+                    "GET", "/health", conn=UnixHTTPConnection(socket_path))
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+        self.assertEqual(result["text"], "Ver1")
+        self.assertEqual(health, {"status": "ok"})
+
+    def test_socket_path(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "qrdecode.sock")
+            with open(path, "w") as f:
+                f.write("data")
+            with self.assertRaises(FileExistsError):
+                qrdecode_server.make_server(self.service, path)
+            with open(path) as f:
+                self.assertEqual(f.read(), "data")
+            # A stale socket is replaced.
+            os.unlink(path)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.bind(path)
+            server = qrdecode_server.make_server(self.service, path)
+            server.server_close()
+            # Only the owner can connect to the socket.
+            self.assertEqual(stat.S_IMODE(os.lstat(path).st_mode), 0o600)
+
+    def test_path_requests(self):
+        server = qrdecode_server.make_server(self.service, host="0.0.0.0",
+                                             port=0)
+        server.server_close()
+        self.assertFalse(server.allow_paths)
+        self.assertTrue(self.server.allow_paths)
+        server = qrdecode_server.make_server(self.service, port=0,
+                                             allow_paths=False)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            (host, port) = server.server_address[:2]
+            request = {"images": [{"path": os.path.join(
+                self.testdata_dir, "Qr-3.png")}]}
+            (status, result) = self.request(
+                "POST", "/decode", json.dumps(request),
+                {"Content-Type": "application/json"},
+                conn=http.client.HTTPConnection(host, port, timeout=30))
+            (upload_status, upload) = self.request(
+                "POST", "/decode", self.read_file("Qr-3.png"),
+                conn=http.client.HTTPConnection(host, port, timeout=30))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertEqual(status, 403)
+        self.assertEqual(result["error"], "Path requests are disabled")
+        self.assertEqual(upload_status, 200)
+        self.assertEqual(upload["text"], "Version 3 QR Code")
+
+
+if __name__ == "__main__":
+    unittest.main()
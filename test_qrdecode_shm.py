@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""Tests for multi-process QR decoding with shared memory."""
+
+import os
+import time
+import signal
+import unittest
+import numpy as np
+from PIL import Image
+import qrdecode_shm
+
+
+class TestSharedFrameDecoder(unittest.TestCase):
+    """Test decoding of frames through the shared ring buffer."""
+
+    testdata_dir = os.path.join(os.path.dirname(__file__), "testdata")
+
+    frame_shape = (360, 480)
+
+    def make_frames(self, n_frames):
+        """Return a list of frames, some of which contain no QR code."""
+        image_path = os.path.join(self.testdata_dir, "Qr-3.png")
+        img = np.array(Image.open(image_path, "r").convert("L"))
+        (h, w) = img.shape
+        frames = []
+        for i in range(n_frames):
+            frame = np.full(self.frame_shape, 255, dtype=np.uint8)
+            if i % 3 != 2:
+                frame[10+i:10+i+h, 20+i:20+i+w] = img
+            frames.append(frame)
+        return frames
+
+    def test_decode_frames_in_order(self):
+        frames = self.make_frames(10)
+        with qrdecode_shm.SharedFrameDecoder(self.frame_shape,
+                                             n_slots=3,
+                                             n_workers=2) as decoder:
+            results = list(decoder.decode_frames(frames))
+        self.assertEqual([r[0] for r in results], list(range(10)))
+        for (frame_index, data, error) in results:
+            if frame_index % 3 != 2:
+                self.assertEqual(data, b"Version 3 QR Code")
+                self.assertIsNone(error)
+            else:
+                self.assertIsNone(data)
+                self.assertEqual(error, "No position detection patterns found")
+
+    def test_backpressure(self):
+        frames = self.make_frames(3)
+        with qrdecode_shm.SharedFrameDecoder(self.frame_shape,
+                                             n_slots=2,
+                                             n_workers=1) as decoder:
+            decoder.submit(frames[0])
+            decoder.submit(frames[1])
+            self.assertFalse(decoder.has_free_slot())
+            with self.assertRaises(TimeoutError):
+                decoder.submit(frames[2], timeout=0.1)
+            (frame_index, data, error) = decoder.get_result()
+            self.assertEqual(frame_index, 0)
+            self.assertEqual(data, b"Version 3 QR Code")
+            # Write the next frame directly into the shared slot.
+            (slot, view) = decoder.acquire_slot()
+            view[...] = frames[2]
+            del view
+            decoder.submit_slot(slot)
+            self.assertEqual(decoder.num_pending(), 2)
+            self.assertEqual(decoder.get_result()[0], 1)
+            self.assertEqual(decoder.get_result()[2],
+                             "No position detection patterns found")
+
+    def test_worker_exit(self):
+        frames = self.make_frames(1)
+        with qrdecode_shm.SharedFrameDecoder(self.frame_shape,
+                                             n_slots=2,
+                                             n_workers=1) as decoder:
+            decoder.workers[0].kill()
+            decoder.workers[0].join()
+            decoder.submit(frames[0])
+            with self.assertRaises(RuntimeError):
+                decoder.get_result()
+
+    def test_close_stuck_worker(self):
+        decoder = qrdecode_shm.SharedFrameDecoder(self.frame_shape,
+                                                  n_slots=2,
+                                                  n_workers=2)
+        # A stopped worker behaves like one stuck in a decode.
+        stuck = decoder.workers[0]
+        os.kill(stuck.pid, signal.SIGSTOP)
+        start_time = time.monotonic()
+        decoder.close(timeout=0.5)
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertFalse(stuck.is_alive())
+        self.assertIsNone(decoder.shm)
+
+
+if __name__ == "__main__":
+    unittest.main()
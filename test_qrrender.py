@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Tests for the QR symbol renderer."""
+
+import random
+import unittest
+import numpy as np
+import qrdecode
+import qrrender
+
+
+class TestRenderer(unittest.TestCase):
+    """Test encoding and rendering of QR codes."""
+
+    def make_data(self, rnd, qr_version, error_correction_level):
+        capacity = qrrender.get_data_capacity(qr_version,
+                                              error_correction_level)
+        nbytes = rnd.randint(1, capacity)
+        return bytes(rnd.randrange(256) for i in range(nbytes))
+
+    def test_decode_rendered(self):
+        rnd = random.Random(1)
+        for qr_version in (1, 2, 6, 7, 10, 14, 27, 40):
+            for level in "LMQH":
+                with self.subTest(qr_version=qr_version, level=level):
+                    data = self.make_data(rnd, qr_version, level)
+                    matrix = qrrender.encode_qr_matrix(data, qr_version,
+                                                       level,
+                                                       rnd.randrange(8))
+                    img = qrrender.render_qr_image(matrix, scale=2)
+                    self.assertEqual(qrdecode.decode_qrcode(img), data)
+
+    def test_same_as_qrcode_package(self):
+        try:
+            import qrcode
+            import qrcode.util
+        except ImportError:
+            self.skipTest("qrcode package not installed")
+        rnd = random.Random(2)
+        for qr_version in (1, 3, 7, 9, 10, 21, 40):
+            for level in "LMQH":
+                with self.subTest(qr_version=qr_version, level=level):
+                    data = self.make_data(rnd, qr_version, level)
+                    mask = rnd.randrange(8)
+                    qr = qrcode.QRCode(
+                        version=qr_version,
+                        error_correction={
+                            "L": qrcode.ERROR_CORRECT_L,
+                            "M": qrcode.ERROR_CORRECT_M,
+                            "Q": qrcode.ERROR_CORRECT_Q,
+                            "H": qrcode.ERROR_CORRECT_H
+                        }[level],
+                        mask_pattern=mask,
+                        border=0)
+                    qr.add_data(qrcode.util.QRData(
+                        data, mode=qrcode.util.MODE_8BIT_BYTE))
+                    qr.make(fit=False)
+                    expect = np.array(qr.modules, dtype=np.uint8)
+                    matrix = qrrender.encode_qr_matrix(data, qr_version,
+                                                       level, mask)
+                    np.testing.assert_array_equal(matrix, expect)
+
+    def test_batch(self):
+        payloads = [b"batch %d" % i for i in range(20)]
+        matrices = qrrender.encode_qr_matrices(payloads, 2, "Q", 5)
+        self.assertEqual(matrices.shape, (20, 25, 25))
+        for (payload, matrix) in zip(payloads, matrices):
+            np.testing.assert_array_equal(
+                matrix, qrrender.encode_qr_matrix(payload, 2, "Q", 5))
+        images = qrrender.render_qr_image(matrices, scale=3, border=2)
+        self.assertEqual(images.shape, (20, 87, 87))
+        self.assertEqual(qrdecode.decode_qrcode(images[7]), payloads[7])
+
+    def test_select_mask(self):
+        data = b"Automatic mask selection"
+        matrix = qrrender.encode_qr_matrix(data, error_correction_level="H")
+        (error_correction_level, mask_pattern
+            ) = qrdecode.extract_format_data(matrix)
+        self.assertEqual(error_correction_level, "H")
+        candidates = np.stack([
+            qrrender.encode_qr_matrix(data, 3, "H", mask)
+            for mask in range(8)])
+        penalty = qrrender.get_mask_penalty(candidates)
+        self.assertEqual(penalty[mask_pattern], np.min(penalty))
+        np.testing.assert_array_equal(matrix, candidates[mask_pattern])
+
+    def test_choose_version(self):
+        capacity = qrrender.get_data_capacity(5, "M")
+        matrix = qrrender.encode_qr_matrix(bytes(capacity))
+        self.assertEqual(matrix.shape, (37, 37))
+        matrix = qrrender.encode_qr_matrix(bytes(capacity + 1))
+        self.assertEqual(matrix.shape, (41, 41))
+        with self.assertRaises(ValueError):
+            qrrender.encode_qr_matrix(bytes(capacity + 1), 5, "M")
+        with self.assertRaises(ValueError):
+            qrrender.encode_qr_matrix(bytes(3000), error_correction_level="H")
+        with self.assertRaises(ValueError):
+            qrrender.encode_qr_matrix(b"x", 1, "X")
+
+    def test_render_scale(self):
+        matrix = qrrender.encode_qr_matrix(b"scale", 1, "L", 0)
+        img = qrrender.render_qr_image(matrix, scale=(2.3, 1.9))
+        self.assertEqual(img.shape, (int(29 * 1.9), int(29 * 2.3)))
+        self.assertTrue(np.all(img[:7] == 255))
+        self.assertEqual(qrdecode.decode_qrcode(img), b"scale")
+        img = qrrender.render_qr_image(matrix, scale=1, border=0)
+        np.testing.assert_array_equal(img, 255 * (1 - matrix))
+
+
+if __name__ == "__main__":
+    unittest.main()